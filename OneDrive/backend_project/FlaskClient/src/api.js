@@ -27,3 +27,94 @@ export const loginUser = async (data) => {
     return { error: "Giriş sırasında hata oluştu" };
   }
 };
+
+export const checkUsername = async (username) => {
+  try {
+    const res = await fetch(`${BASE_URL}/users/available/${encodeURIComponent(username)}`);
+    return await res.json();
+  } catch (err) {
+    console.error("Username check failed:", err);
+    return null;
+  }
+};
+
+const storedUser = () => JSON.parse(localStorage.getItem("user"));
+
+// Pages showing the signed-in user re-read it when this fires
+const saveUser = (user) => {
+  if (user) {
+    localStorage.setItem("user", JSON.stringify(user));
+  } else {
+    localStorage.removeItem("user");
+  }
+  window.dispatchEvent(new Event("auth-changed"));
+};
+
+const tokenClaims = (token) => {
+  try {
+    const payload = token.split(".")[1].replace(/-/g, "+").replace(/_/g, "/");
+    return JSON.parse(atob(payload));
+  } catch {
+    return null;
+  }
+};
+
+// Access tokens last 15 minutes; swap them for a new one from the
+// refresh token, or sign out when the session is over
+const refreshToken = async (user) => {
+  try {
+    const res = await fetch(`${BASE_URL}/token/refresh`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ refresh_token: user.refresh_token }),
+    });
+    if (res.ok) {
+      const { token } = await res.json();
+      const refreshed = { ...user, token, role: tokenClaims(token)?.role ?? user.role };
+      saveUser(refreshed);
+      return refreshed;
+    }
+  } catch (err) {
+    console.error("Token refresh failed:", err);
+    return null;
+  }
+  saveUser(null);
+  return null;
+};
+
+const sessionExpired = () =>
+  new Response(JSON.stringify({ error: "Session expired, please log in again" }), { status: 401 });
+
+// fetch() with the signed-in user's access token, refreshed shortly before
+// it expires or once when the server rejects it
+export const authFetch = async (path, options = {}) => {
+  let user = storedUser();
+  if (!user?.token) return sessionExpired();
+  const exp = tokenClaims(user.token)?.exp;
+  if (exp && exp * 1000 - Date.now() < 30_000) {
+    user = await refreshToken(user);
+    if (!user) return sessionExpired();
+  }
+  const send = (token) =>
+    fetch(`${BASE_URL}${path}`, {
+      ...options,
+      headers: { ...options.headers, Authorization: `Bearer ${token}` },
+    });
+  const res = await send(user.token);
+  if (res.status !== 401 && res.status !== 403) return res;
+  user = await refreshToken(user);
+  return user ? send(user.token) : sessionExpired();
+};
+
+export const fetchUsersPage = async ({ cursor, query, limit = 100 }) => {
+  const params = new URLSearchParams({ limit: String(limit) });
+  if (cursor) params.set("cursor", cursor);
+  if (query) params.set("query", query);
+  try {
+    const res = await fetch(`${BASE_URL}/users?${params}`);
+    return await res.json();
+  } catch (err) {
+    console.error("Loading users failed:", err);
+    return null;
+  }
+};
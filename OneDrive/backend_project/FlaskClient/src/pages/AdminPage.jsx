@@ -4,6 +4,13 @@ import { useState, useEffect } from "react";
 function AdminPage() {
   const [user, setUser] = useState(JSON.parse(localStorage.getItem("user")));
 
+  // Signed out or demoted when the access token could not be refreshed
+  useEffect(() => {
+    const reload = () => setUser(JSON.parse(localStorage.getItem("user")));
+    window.addEventListener("auth-changed", reload);
+    return () => window.removeEventListener("auth-changed", reload);
+  }, []);
+
   if (!user || user.role !== "admin") {
     return <h2 style={{
       textAlign: "center",
@@ -1,10 +1,26 @@
-import { useState } from "react";
-import { registerUser } from "../api";
+import { useEffect, useState } from "react";
+import { checkUsername, registerUser } from "../api";
 
 export default function Register() {
   const [form, setForm] = useState({ username: "", password: "", email: "" });
   const [message, setMessage] = useState("");
   const [isLoading, setIsLoading] = useState(false);
+  const [available, setAvailable] = useState(null);
+
+  // Check the username once typing pauses
+  useEffect(() => {
+    setAvailable(null);
+    if (!form.username) return;
+    let cancelled = false;
+    const timer = setTimeout(async () => {
+      const result = await checkUsername(form.username);
+      if (!cancelled && result) setAvailable(result.available);
+    }, 300);
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [form.username]);
 
   const handleChange = (e) => {
     setForm({ ...form, [e.target.name]: e.target.value });
@@ -110,6 +126,15 @@ export default function Register() {
             }
           }}
         />
+        {available !== null && (
+          <span style={{
+            marginTop: "-0.5rem",
+            fontSize: "0.85rem",
+            color: available ? "#4CAF50" : "#ff4646"
+          }}>
+            {available ? "Username is available" : "Username is taken"}
+          </span>
+        )}
         <input 
           name="email"
           placeholder="Email" 
@@ -1,34 +1,47 @@
-import { useEffect, useState } from "react";
+import { useEffect, useRef, useState } from "react";
+import { authFetch, fetchUsersPage } from "../api";
 
 function UserList() {
   const [users, setUsers] = useState([]);
   const [query, setQuery] = useState("");
   const [role, setRole] = useState("");
   const [selectedUser, setSelectedUser] = useState(null);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loading, setLoading] = useState(false);
+  const latestRequest = useRef(0);
 
+  // One page at a time; a cursor appends to the list, no cursor starts over
+  const loadPage = async (cursor) => {
+    const request = ++latestRequest.current;
+    setLoading(true);
+    const data = await fetchUsersPage({ cursor, query });
+    if (request !== latestRequest.current) return; // The search changed meanwhile
+    setLoading(false);
+    if (!data?.users) return;
+    setUsers((loaded) => (cursor ? loaded.concat(data.users) : data.users));
+    setNextCursor(data.next_cursor);
+  };
+
+  // The server filters by username, so a new search reloads the first page
+  useEffect(() => {
+    const timer = setTimeout(() => loadPage(null), 300);
+    return () => clearTimeout(timer);
+  }, [query]);
+
+  // Admin controls follow the stored user, which changes on token refresh or sign-out
   useEffect(() => {
-    fetch("http://127.0.0.1:5000/users")
-      .then((res) => res.json())
-      .then((data) => {
-        setUsers(data);
-        const user = JSON.parse(localStorage.getItem("user"));
-        if (user?.role === "admin") {
-          setRole("admin");
-        }
-      });
+    const syncRole = () => {
+      const user = JSON.parse(localStorage.getItem("user"));
+      setRole(user?.role === "admin" ? "admin" : "");
+    };
+    syncRole();
+    window.addEventListener("auth-changed", syncRole);
+    return () => window.removeEventListener("auth-changed", syncRole);
   }, []);
 
   const handleDelete = (username) => {
-    const currentUser = JSON.parse(localStorage.getItem("user"));
-    
     if (window.confirm(`Are you sure you want to delete user "${username}"?`)) {
-      fetch(`http://127.0.0.1:5000/users/${username}`, {
-        method: "DELETE",
-        headers: {
-          "Content-Type": "application/json",
-        },
-        body: JSON.stringify({ requester: currentUser.username })
-      })
+      authFetch(`/users/${encodeURIComponent(username)}`, { method: "DELETE" })
         .then((res) => res.json())
         .then((data) => {
           if (data.message) {
@@ -45,10 +58,6 @@ function UserList() {
     setSelectedUser(selectedUser?.username === user.username ? null : user);
   };
 
-  const filteredUsers = users.filter((user) =>
-    user.username.toLowerCase().includes(query.toLowerCase())
-  );
-
   return (
     <div style={{ 
       maxWidth: "1000px",
@@ -113,7 +122,7 @@ function UserList() {
           border: "1px solid rgba(76, 175, 80, 0.3)",
           color: "#4CAF50"
         }}>
-          Total Users: {users.length}
+          Users shown: {users.length}{nextCursor ? "+" : ""}
         </div>
       </div>
 
@@ -129,7 +138,7 @@ function UserList() {
           maxHeight: "600px",
           overflowY: "auto"
         }}>
-          {filteredUsers.map((user, i) => (
+          {users.map((user, i) => (
             <div 
               key={i} 
               onClick={() => role === "admin" && handleUserClick(user)}
@@ -209,6 +218,24 @@ function UserList() {
               )}
             </div>
           ))}
+          {nextCursor && (
+            <button
+              onClick={() => loadPage(nextCursor)}
+              disabled={loading}
+              style={{
+                width: "100%",
+                marginTop: "1rem",
+                padding: "0.8em",
+                background: "rgba(100, 108, 255, 0.2)",
+                color: "#9089fc",
+                border: "1px solid rgba(100, 108, 255, 0.3)",
+                borderRadius: "6px",
+                cursor: loading ? "default" : "pointer"
+              }}
+            >
+              {loading ? "Loading..." : "Load more"}
+            </button>
+          )}
         </div>
 
         {selectedUser && (
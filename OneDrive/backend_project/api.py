@@ -1,135 +1,126 @@
-from flask import Flask, request, jsonify
+import io
+import time
+
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
-from user_auth import UserRepository, User, UserRole
+import metrics
+from audit import EventStream
+from user_auth import UserRepository, configure_logging
+from service import UserService, Result, bearer_token, client_address, record_request, split_result
 
 app = Flask(__name__)
-CORS(app, origins="*", methods=["GET", "POST", "DELETE", "PUT", "OPTIONS"], allow_headers="*")
+CORS(app, origins="*", methods=["GET", "POST", "DELETE", "PUT", "OPTIONS"], allow_headers="*",
+     expose_headers=["ETag", "Retry-After"])
 
+configure_logging()
 
 repo = UserRepository()
+service = UserService(repo)
 
-@app.route("/users", methods=["GET"])
-def get_all_users():
-    users = repo.get_all_users()
-    return jsonify([
-        {
-            "username": u.username,
-            "email": u.email,
-            "role": u.role,
-            "created_at": u.created_at  
-        } for u in users
-    ])
 
+def reply(result: Result):
+    body, status, headers = split_result(result)
+    if isinstance(body, (dict, list)):
+        return jsonify(body), status, headers
+    if isinstance(body, EventStream):
+        # Werkzeug closes the stream when the client goes away
+        return Response(body, status=status, headers=headers, mimetype="text/event-stream")
+    return Response(body, status=status, headers=headers, mimetype="application/json")
 
-@app.route("/register", methods=["POST"])
-def register():
-    data = request.get_json()
-    username = data.get("username")
-    password = data.get("password")
-    email = data.get("email")
 
-    if not all([username, password, email]):
-        return jsonify({"error": "Missing fields"}), 400
+def request_data() -> dict:
+    return request.get_json(silent=True) or {}
 
-    if not User.validate_password(password):
-        return jsonify({"error": "Weak password"}), 400
 
-    if not User.validate_email(email):
-        return jsonify({"error": "Invalid email"}), 400
+def request_token():
+    return bearer_token(request.headers.get("Authorization"))
 
-    user = User(username, password, email)
-    success = repo.register(user)
 
-    if not success:
-        return jsonify({"error": "Username already exists"}), 409
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
 
-    return jsonify({"message": "User registered successfully"}), 201
 
+@app.after_request
+def record_metrics(response):
+    if "started" in g:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        record_request(request.method, route, response.status_code, time.perf_counter() - g.started)
+    return response
 
-@app.route("/users/<username>", methods=["DELETE"])
-def delete_user(username):
-    data = request.get_json()
-    requester = data.get("requester")
 
-    user = repo.get_user(requester)
-    if not user or user.role != UserRole.ADMIN:
-        return jsonify({"error": "Unauthorized operation"}), 403
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(service.metrics(), content_type=metrics.CONTENT_TYPE)
 
-    success = repo.delete_user(username)
-    if success:
-        return jsonify({"message": "User deleted"}), 200
-    return jsonify({"error": "User not found"}), 404
+
+@app.route("/register", methods=["POST"])
+def register():
+    return reply(service.register(request_data()))
+
+
+@app.route("/users/<username>", methods=["DELETE"])
+def delete_user(username):
+    return reply(service.delete_user(request_token(), username))
 
 
 @app.route("/users/<username>", methods=["PUT"])
 def update_user(username):
-    data = request.get_json()
-    email = data.get("email")
-    password = data.get("password")
-    requester=data.get("requester")
+    return reply(service.update_user(request_token(), username, request_data()))
 
-    user = repo.get_user(requester)
-    if not user or user.role != UserRole.ADMIN:
-        return jsonify({"error": "Unauthorized operation"}), 403
 
-    success = repo.update_user(username, email=email, password=password)
-    if success:
-        return jsonify({"message": "User updated"}), 200
-    return jsonify({"error": "User not found"}), 404
+@app.route("/users/bulk", methods=["POST"])
+def bulk_import():
+    fmt = service.import_format(request.content_type, request.args.get("format"))
+    stream = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+    return reply(service.bulk_import(request_token(), stream, fmt))
 
 
 @app.route("/users", methods=["GET"])
 def get_users():
-    query = request.args.get("query", "").lower()
-    result = [
-        {
-            "username": u.username,
-            "email": u.email,
-            "role": u.role,
-            "created_at": u.created_at.isoformat()
-        }
-        for u in repo.get_all_users()
-        if query in u.username.lower()
-    ]
-    return jsonify(result), 200
+    return reply(service.list_users(request.args, request.headers.get("If-None-Match")))
+
+
+@app.route("/users/search", methods=["GET"])
+def search_users():
+    return reply(service.search_users(request.args))
+
+
+@app.route("/users/available/<username>", methods=["GET"])
+def username_available(username):
+    return reply(service.username_available(username))
 
 
 @app.route("/admin/users", methods=["POST"])
 def get_users_admin():
-    data = request.get_json()
-    username = data.get("username")
+    return reply(service.admin_users(request_token(), request.args, request.headers.get("If-None-Match")))
+
 
-    user = next((u for u in repo.users if u.username == username), None)
-    if user and user.role == UserRole.ADMIN:
-        return jsonify([
-            {
-                "username": u.username,
-                "email": u.email,
-                "role": u.role,
-                "created_at": u.created_at.isoformat()
-            } for u in repo.get_all_users()
-        ]), 200
-    return jsonify({"error": "Unauthorized"}), 403
+@app.route("/admin/users/batch", methods=["POST"])
+def batch_users():
+    return reply(service.batch_users(request_token(), request_data()))
 
 
+@app.route("/admin/audit/stream", methods=["GET"])
+def audit_stream():
+    return reply(service.audit_stream(request_token(), request.args, request.headers.get("Last-Event-ID")))
+
 
 @app.route("/login", methods=["POST"])
 def login():
-    data = request.get_json()
-    username = data.get("username")
-    password = data.get("password")
+    client = client_address(request.remote_addr, request.headers.get("X-Forwarded-For"))
+    return reply(service.login(request_data(), client))
+
+
+@app.route("/token/refresh", methods=["POST"])
+def refresh_token():
+    return reply(service.refresh_token(request_data()))
 
-    user = next((u for u in repo.users if u.username == username), None)
-    if user and user.verify_password(password):
-        return jsonify({
-            "message": "Login successful",
-            "username": user.username,
-            "email": user.email,
-            "role": user.role.value
-        }), 200
 
-    return jsonify({"error": "Invalid credentials"}), 401
+@app.route("/logout", methods=["POST"])
+def logout():
+    return reply(service.logout(request_token(), request_data()))
+
 
 if __name__ == "__main__":
     app.run(debug=True)
-
@@ -0,0 +1,303 @@
+"""ASGI version of the API in api.py.
+
+Run it with any ASGI server, for example::
+
+    uvicorn asgi_api:app --workers 4
+
+The event loop only parses requests and writes responses. Everything that
+can block (password hashing, file and database I/O) runs in a thread pool,
+so thousands of idle keep-alive connections cost the loop nothing. The
+endpoint logic is shared with the Flask app through ``UserService``.
+"""
+import asyncio
+import io
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+import metrics
+from audit import EventStream
+from user_auth import Config, UserRepository, configure_logging
+from service import UserService, Result, bearer_token, client_address, record_request, split_result
+
+configure_logging()
+
+repo = UserRepository()
+service = UserService(repo)
+executor = ThreadPoolExecutor(max_workers=Config.ASGI_EXECUTOR_WORKERS, thread_name_prefix="asgi-worker")
+
+CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-methods", b"GET, POST, DELETE, PUT, OPTIONS"),
+    (b"access-control-allow-headers", b"*"),
+    (b"access-control-expose-headers", b"ETag, Retry-After"),
+]
+
+
+class RequestBody(io.RawIOBase):
+    """The request body as a blocking file, received chunk by chunk as it is read.
+
+    For handlers running on the executor: each read that needs more data
+    waits for the event loop to ``receive()`` the next message.
+    """
+
+    def __init__(self, receive, loop: asyncio.AbstractEventLoop):
+        self._receive = receive
+        self._loop = loop
+        self._pending = memoryview(b"")
+        self._done = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending and not self._done:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message["type"] == "http.disconnect":
+                raise ConnectionError("Client disconnected")
+            self._pending = memoryview(message.get("body", b""))
+            self._done = not message.get("more_body")
+        count = min(len(buffer), len(self._pending))
+        buffer[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+
+class Request:
+    def __init__(self, scope: Dict, body: bytes, params: Dict[str, str], stream: Optional[RequestBody] = None):
+        self.params = params
+        self.args = dict(parse_qsl(scope.get("query_string", b"").decode()))
+        self.headers = {name.decode().lower(): value.decode() for name, value in scope.get("headers", [])}
+        self.body = body
+        self.stream = stream
+        peer = scope.get("client")
+        self.client = client_address(peer[0] if peer else None, self.headers.get("x-forwarded-for"))
+
+    @property
+    def token(self) -> Optional[str]:
+        return bearer_token(self.headers.get("authorization"))
+
+    @property
+    def data(self) -> Dict:
+        try:
+            data = json.loads(self.body) if self.body else {}
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+
+Handler = Callable[[Request], Result]
+ROUTES: List[Tuple[str, "re.Pattern[str]", Handler]] = []
+
+
+def route(path: str, method: str, streams_body: bool = False):
+    """Register a handler; ``<name>`` segments become path parameters.
+
+    Handlers that ``streams_body`` read ``req.stream`` instead of ``req.body``.
+    """
+    pattern = re.compile("^" + re.sub(r"<(\w+)>", r"(?P<\1>[^/]+)", path) + "$")
+
+    def decorator(fn: Handler) -> Handler:
+        fn.route = path
+        fn.streams_body = streams_body
+        ROUTES.append((method, pattern, fn))
+        return fn
+    return decorator
+
+
+@route("/register", "POST")
+def register(req: Request) -> Result:
+    return service.register(req.data)
+
+
+@route("/users/bulk", "POST", streams_body=True)
+def bulk_import(req: Request) -> Result:
+    fmt = service.import_format(req.headers.get("content-type"), req.args.get("format"))
+    stream = io.TextIOWrapper(io.BufferedReader(req.stream), encoding="utf-8", newline="")
+    return service.bulk_import(req.token, stream, fmt)
+
+
+@route("/users/<username>", "DELETE")
+def delete_user(req: Request) -> Result:
+    return service.delete_user(req.token, req.params["username"])
+
+
+@route("/users/<username>", "PUT")
+def update_user(req: Request) -> Result:
+    return service.update_user(req.token, req.params["username"], req.data)
+
+
+@route("/users", "GET")
+def get_users(req: Request) -> Result:
+    return service.list_users(req.args, req.headers.get("if-none-match"))
+
+
+@route("/users/search", "GET")
+def search_users(req: Request) -> Result:
+    return service.search_users(req.args)
+
+
+@route("/users/available/<username>", "GET")
+def username_available(req: Request) -> Result:
+    return service.username_available(req.params["username"])
+
+
+@route("/admin/users", "POST")
+def get_users_admin(req: Request) -> Result:
+    return service.admin_users(req.token, req.args, req.headers.get("if-none-match"))
+
+
+@route("/admin/users/batch", "POST")
+def batch_users(req: Request) -> Result:
+    return service.batch_users(req.token, req.data)
+
+
+@route("/admin/audit/stream", "GET")
+def audit_stream(req: Request) -> Result:
+    return service.audit_stream(req.token, req.args, req.headers.get("last-event-id"))
+
+
+@route("/login", "POST")
+def login(req: Request) -> Result:
+    return service.login(req.data, req.client)
+
+
+@route("/token/refresh", "POST")
+def refresh_token(req: Request) -> Result:
+    return service.refresh_token(req.data)
+
+
+@route("/logout", "POST")
+def logout(req: Request) -> Result:
+    return service.logout(req.token, req.data)
+
+
+@route("/metrics", "GET")
+def get_metrics(req: Request) -> Result:
+    return service.metrics(), 200
+
+
+def match(method: str, path: str) -> Tuple[Optional[Handler], Dict[str, str], bool]:
+    """Find the handler for a request; the flag says whether the path exists at all"""
+    path_exists = False
+    for route_method, pattern, handler in ROUTES:
+        found = pattern.match(path)
+        if found:
+            path_exists = True
+            if route_method == method:
+                return handler, found.groupdict(), True
+    return None, {}, path_exists
+
+
+async def read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def send_body(send, status: int, payload: bytes, content_type: bytes, extra_headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type), (b"content-length", str(len(payload)).encode()),
+                    *CORS_HEADERS, *extra_headers],
+    })
+    await send({"type": "http.response.body", "body": payload})
+
+
+async def send_json(send, status: int, body, extra_headers=()):
+    await send_body(send, status, json.dumps(body).encode(), b"application/json", extra_headers)
+
+
+async def send_text(send, status: int, text: str, content_type: str, extra_headers=()):
+    await send_body(send, status, text.encode(), content_type.encode(), extra_headers)
+
+
+async def send_events(send, receive, status: int, events: EventStream, loop, extra_headers=()):
+    """Stream Server-Sent Events until the stream ends or the client disconnects.
+
+    Waiting for the next event holds an executor thread for up to one
+    heartbeat, which is fine for a handful of admin consoles.
+    """
+    async def watch_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        events.close()
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    chunks = iter(events)
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/event-stream"), *CORS_HEADERS, *extra_headers],
+        })
+        while True:
+            chunk = await loop.run_in_executor(executor, next, chunks, None)
+            if chunk is None:
+                break
+            await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        events.close()
+        watcher.cancel()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            executor.shutdown(wait=False)
+            repo.audit.close()
+            repo.backend.flush()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    method = scope["method"]
+    if method == "OPTIONS":
+        await send({"type": "http.response.start", "status": 204, "headers": CORS_HEADERS})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    started = time.perf_counter()
+    handler, params, path_exists = match(method, scope["path"])
+    if handler is None:
+        status = 405 if path_exists else 404
+        await send_json(send, status, {"error": "Method not allowed" if path_exists else "Not found"})
+        record_request(method, "unmatched", status, time.perf_counter() - started)
+        return
+
+    loop = asyncio.get_running_loop()
+    if handler.streams_body:
+        req = Request(scope, b"", params, RequestBody(receive, loop))
+    else:
+        req = Request(scope, await read_body(receive), params)
+    body, status, headers = split_result(await loop.run_in_executor(executor, partial(handler, req)))
+    extra_headers = [(name.lower().encode(), value.encode()) for name, value in headers]
+    if isinstance(body, (dict, list)):
+        await send_json(send, status, body, extra_headers)
+    elif isinstance(body, bytes):
+        await send_body(send, status, body, b"application/json", extra_headers)
+    elif isinstance(body, str):
+        # Plain text bodies are the Prometheus metrics page
+        await send_text(send, status, body, metrics.CONTENT_TYPE, extra_headers)
+    else:
+        await send_events(send, receive, status, body, loop, extra_headers)
+    record_request(method, handler.route, status, time.perf_counter() - started)
@@ -0,0 +1,224 @@
+"""Authentication audit log.
+
+Handlers call ``AuditLog.record``, which puts the event in a fixed-size ring
+buffer and returns: no disk I/O happens on the request path. A background
+thread wakes every ``flush_interval`` seconds and appends everything
+recorded since its last pass to the log file as one gzip member of JSON
+lines, so the file reads back with ``zcat`` or ``gzip.open``. Once the file
+would grow past ``max_bytes`` it is rotated to ``<file>.1`` (and older
+files shift up, keeping ``backups`` of them). Worker processes can share
+one file: appends and rotations happen under an exclusive lock on
+``<file>.lock``.
+
+If events arrive faster than the writer drains them, the oldest unwritten
+ones are overwritten; they are counted in ``audit_events_dropped_total``
+rather than slowing requests down. ``EventStream`` follows the same buffer
+for the admin Server-Sent Events endpoint, again without touching disk.
+
+Each event is a dict with ``id`` (``<pid>-<sequence>``), ``time`` (UTC),
+``event``, ``outcome``, ``username`` and whatever details were given.
+"""
+import atexit
+import gzip
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from metrics import REGISTRY
+
+try:
+    import fcntl
+except ImportError:  # Windows: only one worker process may write the file
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+AUDIT_EVENTS = REGISTRY.counter("audit_events_total", "Audit events recorded", ["event", "outcome"])
+AUDIT_DROPPED = REGISTRY.counter("audit_events_dropped_total",
+                                 "Audit events overwritten in the ring buffer before they were written")
+AUDIT_WRITE_ERRORS = REGISTRY.counter("audit_write_errors_total", "Failed writes of audit batches")
+
+
+@contextmanager
+def _locked(path: str):
+    with open(path, "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+class AuditLog:
+    """Ring buffer of recent audit events, written to ``path`` in the background.
+
+    With no ``path`` events are only kept in memory for streaming.
+    """
+
+    def __init__(self, path: Optional[str], capacity: int = 10_000, flush_interval: float = 1.0,
+                 max_bytes: int = 10 * 1024 * 1024, backups: int = 5):
+        self.path = path
+        self.lock_path = f"{path}.lock" if path else None
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.pid = os.getpid()
+        # Event number n lives in slot n % capacity; seq is the newest
+        self._events: List[Optional[Dict]] = [None] * capacity
+        self.seq = 0
+        self._written = 0
+        self._changed = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start the background writer; whatever is left is written at exit"""
+        if self.path and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def record(self, event: str, username: Optional[str], outcome: str = "success", **details):
+        """Add an event to the buffer; ``None`` details are left out"""
+        entry = {"time": datetime.now(timezone.utc).isoformat(timespec="milliseconds"), "event": event,
+                 "outcome": outcome, "username": username}
+        entry.update((key, value) for key, value in details.items() if value is not None)
+        AUDIT_EVENTS.inc(event=event, outcome=outcome)
+        with self._changed:
+            self.seq += 1
+            entry["id"] = f"{self.pid}-{self.seq}"
+            self._events[self.seq % self.capacity] = entry
+            self._changed.notify_all()
+
+    def since(self, seq: int, timeout: Optional[float] = None,
+              stopped: Callable[[], bool] = lambda: False) -> Tuple[List[Dict], int, int]:
+        """Events after number ``seq``: (events, newest number, how many were overwritten).
+
+        With ``timeout``, waits up to that long for an event when there is
+        none yet, unless ``stopped()`` says to give up.
+        """
+        with self._changed:
+            if timeout and self.seq <= seq and not stopped():
+                self._changed.wait(timeout)
+            oldest = max(self.seq - self.capacity + 1, 1)
+            start = max(seq + 1, oldest)
+            events = [self._events[number % self.capacity] for number in range(start, self.seq + 1)]
+            return events, self.seq, start - seq - 1
+
+    def wake(self):
+        """Let every ``since`` call that is waiting return"""
+        with self._changed:
+            self._changed.notify_all()
+
+    def flush(self):
+        """Write every event recorded so far"""
+        if not self.path:
+            return
+        with self._write_lock:
+            events, newest, dropped = self.since(self._written)
+            if dropped:
+                AUDIT_DROPPED.inc(dropped)
+                logger.warning("Dropped %d audit events the writer could not keep up with", dropped)
+            if not events:
+                return
+            lines = "".join(json.dumps(event, separators=(",", ":")) + "\n" for event in events)
+            try:
+                self._append(gzip.compress(lines.encode()))
+            except OSError as e:
+                # Try again next time with whatever is still in the buffer;
+                # the dropped events are already counted
+                AUDIT_WRITE_ERRORS.inc()
+                logger.error("Cannot write audit log %s: %s", self.path, e)
+                self._written = newest - len(events)
+                return
+            self._written = newest
+
+    @property
+    def closed(self) -> bool:
+        return self._stop.is_set()
+
+    def close(self):
+        self._stop.set()
+        self.wake()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def _append(self, payload: bytes):
+        with _locked(self.lock_path):
+            try:
+                size = os.path.getsize(self.path)
+            except FileNotFoundError:
+                size = 0
+            if size and size + len(payload) > self.max_bytes:
+                self._rotate()
+            with open(self.path, "ab") as file:
+                file.write(payload)
+                file.flush()
+                os.fsync(file.fileno())
+
+    def _rotate(self):
+        # Caller holds the file lock
+        if self.backups < 1:
+            os.remove(self.path)
+            return
+        for number in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{number}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{number + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+
+class EventStream:
+    """Server-Sent Events for an ``AuditLog``, as text chunks.
+
+    Starts with up to ``backlog`` recent events, or the ones after
+    ``last_event_id`` when a client reconnects to the same worker, then
+    follows new events. A comment goes out every ``heartbeat`` seconds
+    without events, and the stream ends once ``authorized()`` turns false
+    or ``close`` is called.
+    """
+
+    def __init__(self, log: AuditLog, backlog: int, last_event_id: Optional[str],
+                 authorized: Callable[[], bool], heartbeat: float = 15.0):
+        self.log = log
+        self.authorized = authorized
+        self.heartbeat = heartbeat
+        self._closed = threading.Event()
+        self._seq = max(log.seq - backlog, 0)
+        pid, _, seq = (last_event_id or "").partition("-")
+        if pid == str(log.pid) and seq.isdigit():
+            self._seq = int(seq)
+
+    def __iter__(self) -> Iterator[str]:
+        yield "retry: 3000\n\n"
+        while not self._stopped():
+            events, self._seq, dropped = self.log.since(self._seq, self.heartbeat, self._stopped)
+            if self._stopped() or not self.authorized():
+                return
+            chunks = []
+            if dropped:
+                chunks.append(f"event: dropped\ndata: {json.dumps({'count': dropped})}\n\n")
+            for event in events:
+                chunks.append(f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event)}\n\n")
+            yield "".join(chunks) or ": keep-alive\n\n"
+
+    def close(self):
+        self._closed.set()
+        self.log.wake()
+
+    def _stopped(self) -> bool:
+        return self._closed.is_set() or self.log.closed
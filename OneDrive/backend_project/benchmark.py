@@ -0,0 +1,308 @@
+"""Repository microbenchmarks at several dataset sizes.
+
+    python benchmark.py                                  # 1k, 100k and 1M users
+    python benchmark.py --sizes 1000 100000 --backend sqlite
+    python benchmark.py --layout columnar
+    python benchmark.py --save-baseline                  # store results as the baseline
+    python benchmark.py --baseline benchmark_baseline.json --tolerance 0.2
+
+Each size runs in a fresh process against a synthetic dataset in a
+temporary directory, so peak RSS is per size and nothing touches the real
+users file. For every operation the suite reports ops/sec and p50/p99
+latency. Results are written as JSON; when a baseline is given, operations
+that got slower than the tolerance allows are listed and the exit status
+is 1.
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_SIZES = (1_000, 100_000, 1_000_000)
+DEFAULT_OUTPUT = "benchmark_results.json"
+DEFAULT_BASELINE = "benchmark_baseline.json"
+PASSWORD = "Bench123!"
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def measure(operation: Callable[[int], None], ops: int, setup: Optional[Callable[[int], None]] = None) -> Dict:
+    """Run ``operation(i)`` ``ops`` times and summarize the latencies.
+
+    ``setup(i)`` runs before each call and is not timed.
+    """
+    latencies = []
+    for i in range(ops):
+        if setup:
+            setup(i)
+        started = time.perf_counter()
+        operation(i)
+        latencies.append(time.perf_counter() - started)
+    total = sum(latencies)
+    latencies.sort()
+    return {
+        "ops": ops,
+        "seconds": round(total, 6),
+        "ops_per_sec": round(ops / total, 2) if total else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 4),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 4),
+    }
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def write_users(path: str, count: int, password_hash: Optional[str]):
+    """Write ``count`` synthetic users as a JSON array, one at a time.
+
+    With ``password_hash`` the users are in the current format (all sharing
+    that hash, which keeps setup fast); without it they are legacy users
+    with plain-text passwords.
+    """
+    created_at = datetime.now().isoformat()
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("[")
+        for i in range(count):
+            record = {"username": f"user{i:07d}", "email": f"user{i:07d}@example.com",
+                      "role": "admin" if i == 0 else "user"}
+            if password_hash:
+                record["password_hash"] = password_hash
+                record["created_at"] = created_at
+            else:
+                record["password"] = PASSWORD
+            file.write(("," if i else "") + "\n" + json.dumps(record))
+        file.write("\n]\n")
+
+
+def seed_sqlite(path: str, count: int, password_hash: str, batch_size: int = 10_000):
+    from storage import SQLiteBackend
+    from user_auth import User
+
+    backend = SQLiteBackend(path, User.from_dict)
+    backend.load()
+    created_at = datetime.now().isoformat()
+    for start in range(0, count, batch_size):
+        backend.add_many([
+            User.from_dict({"username": f"user{i:07d}", "email": f"user{i:07d}@example.com",
+                            "role": "admin" if i == 0 else "user",
+                            "password_hash": password_hash, "created_at": created_at})
+            for i in range(start, min(start + batch_size, count))
+        ])
+    backend.close()
+
+
+def run_size(size: int, options: Dict) -> Dict:
+    """Benchmark one dataset size; runs in its own process"""
+    from migration import write_format_marker
+    from user_auth import Config, User, UserRepository, password_hasher
+
+    workdir = tempfile.mkdtemp(prefix=f"bench-{size}-")
+    Config.STORAGE_BACKEND = options["backend"]
+    Config.MEMORY_LAYOUT = options["layout"]
+    Config.USER_FILE = os.path.join(workdir, "users.json")
+    Config.JOURNAL_FILE = os.path.join(workdir, "users.log")
+    Config.SNAPSHOT_FILE = os.path.join(workdir, "users.snap")
+    Config.SQLITE_FILE = os.path.join(workdir, "users.db")
+    Config.SESSION_BACKEND = "memory"
+    Config.TOKEN_SECRET_FILE = os.path.join(workdir, "token_secret.key")
+    Config.AUDIT_FILE = os.path.join(workdir, "audit.jsonl.gz")
+
+    password_hash = password_hasher().hash(PASSWORD)
+    if options["backend"] == "sqlite":
+        seed_sqlite(Config.SQLITE_FILE, size, password_hash)
+    else:
+        write_users(Config.USER_FILE, size, password_hash)
+        write_format_marker(Config.USER_FILE)
+
+    rng = random.Random(size)
+    metrics = {}
+    # The repository is chatty; keep its output out of the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if options["layout"] == "mmap":
+            # Time starts from an existing snapshot, as a restarted worker would
+            UserRepository().backend.close()
+        started = time.perf_counter()
+        repo = UserRepository()
+        elapsed = time.perf_counter() - started
+        metrics["loadUsers"] = {"ops": 1, "seconds": round(elapsed, 6), "users": size,
+                                "users_per_sec": round(size / elapsed, 2) if elapsed else 0.0}
+
+        metrics["get_user"] = measure(
+            lambda i: repo.get_user(f"user{rng.randrange(size):07d}"), options["lookups"])
+
+        target = repo.get_user(f"user{size - 1:07d}")
+        metrics["verify_password"] = measure(lambda i: target.verify_password(PASSWORD), options["hash_ops"])
+
+        metrics["register"] = measure(
+            lambda i: repo.register(User(f"new{i:07d}", PASSWORD, f"new{i:07d}@example.com")), options["hash_ops"])
+
+        # Give every save something to write
+        metrics["savetoFile"] = measure(
+            lambda i: repo.savetoFile(), options["saves"],
+            setup=lambda i: repo.backend.update(target, {"email": f"saved{i}@example.com"}))
+
+        admin_token = repo.sessions.create(f"user{0:07d}")
+        metrics["list_users"] = measure(lambda i: repo.list_users(admin_token), options["listings"])
+
+        legacy_count = min(size, options["migrate_users"])
+        Config.USER_FILE = os.path.join(workdir, "legacy.json")
+        write_users(Config.USER_FILE, legacy_count, None)
+        started = time.perf_counter()
+        repo.migrate_legacy_users()
+        elapsed = time.perf_counter() - started
+        metrics["migrate_legacy_users"] = {"ops": 1, "seconds": round(elapsed, 6), "users": legacy_count,
+                                           "users_per_sec": round(legacy_count / elapsed, 2) if elapsed else 0.0}
+
+        repo.backend.close()
+        repo.audit.close()
+    password_hasher().shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {"size": size, "peak_rss_mb": peak_rss_mb(), "metrics": metrics}
+
+
+def _child(size: int, options: Dict, conn):
+    try:
+        conn.send(("ok", run_size(size, options)))
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+
+def run_isolated(size: int, options: Dict) -> Dict:
+    """Run ``run_size`` in a fresh process so peak RSS belongs to this size only"""
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_child, args=(size, options, sender))
+    process.start()
+    sender.close()
+    try:
+        status, payload = receiver.recv()
+    except EOFError:
+        status, payload = "error", f"benchmark process exited with code {process.exitcode}"
+    process.join()
+    if status != "ok":
+        raise RuntimeError(f"Benchmark at {size} users failed: {payload}")
+    return payload
+
+
+def throughput(metric: Dict) -> float:
+    return metric.get("ops_per_sec", metric.get("users_per_sec", 0.0))
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Describe every operation that regressed by more than ``tolerance``"""
+    regressions = []
+    for size, current in results["results"].items():
+        previous = baseline.get("results", {}).get(size)
+        if not previous:
+            continue
+        for name, metric in current["metrics"].items():
+            before = previous["metrics"].get(name)
+            if not before:
+                continue
+            if throughput(before) and throughput(metric) < throughput(before) * (1 - tolerance):
+                regressions.append(f"{name} @ {size}: {throughput(metric):.1f}/s, baseline {throughput(before):.1f}/s")
+            if before.get("p99_ms") and metric["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+                regressions.append(f"{name} @ {size}: p99 {metric['p99_ms']}ms, baseline {before['p99_ms']}ms")
+    return regressions
+
+
+def print_report(results: Dict):
+    for size, result in results["results"].items():
+        print(f"\n{int(size):,} users (peak RSS {result['peak_rss_mb']} MB)")
+        print(f"{'operation':<22} {'ops/sec':>12} {'p50 ms':>10} {'p99 ms':>10}")
+        for name, metric in result["metrics"].items():
+            print(f"{name:<22} {throughput(metric):>12.1f} {metric.get('p50_ms', ''):>10} {metric.get('p99_ms', ''):>10}")
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark UserRepository at several dataset sizes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="number of users per run")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--layout", choices=("objects", "columnar", "mmap"), default="objects",
+                        help="in-memory layout of the json backend")
+    parser.add_argument("--lookups", type=int, default=10_000, help="get_user calls per size")
+    parser.add_argument("--hash-ops", type=int, default=20, help="register and verify_password calls per size")
+    parser.add_argument("--saves", type=int, default=5, help="savetoFile calls per size")
+    parser.add_argument("--listings", type=int, default=3, help="list_users calls per size")
+    parser.add_argument("--migrate-users", type=int, default=1000, help="legacy users migrated per size")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="where to write the JSON results")
+    parser.add_argument("--baseline", help=f"compare against this results file (e.g. {DEFAULT_BASELINE})")
+    parser.add_argument("--save-baseline", action="store_true", help=f"also write the results to {DEFAULT_BASELINE}")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before failing (0.25 = 25%%)")
+    args = parser.parse_args(argv)
+
+    from user_auth import Config
+
+    options = {
+        "backend": args.backend,
+        "layout": args.layout,
+        "lookups": args.lookups,
+        "hash_ops": args.hash_ops,
+        "saves": args.saves,
+        "listings": args.listings,
+        "migrate_users": args.migrate_users,
+    }
+    results = {
+        "created_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "password_hash_algorithm": Config.PASSWORD_HASH_ALGORITHM,
+        "options": options,
+        "results": {},
+    }
+    for size in args.sizes:
+        print(f"Benchmarking {size:,} users...")
+        results["results"][str(size)] = run_isolated(size, options)
+
+    print_report(results)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=4)
+    print(f"\nResults written to {args.output}")
+    if args.save_baseline:
+        with open(DEFAULT_BASELINE, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=4)
+        print(f"Baseline written to {DEFAULT_BASELINE}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) against {args.baseline}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nNo regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,182 @@
+"""Memory-mapped bloom filter of breached passwords.
+
+    python breached.py build pwned-passwords-sha1.txt            # writes breached_passwords.bloom
+    python breached.py build rockyou.txt --plaintext --fp-rate 0.0001
+    python breached.py check 'Password123'
+
+The corpus is one password per line, either as a SHA-1 hex digest (the
+"HASH" or "HASH:COUNT" lines of the Pwned Passwords download) or, with
+``--plaintext``, as the password itself. Only SHA-1 digests go into the
+filter, so it never holds a readable password.
+
+File layout (little endian)::
+
+    header     magic, number of hash functions, number of bits, number of
+               passwords added
+    bits       the filter, bit i in byte i // 8
+
+Lookups hash the password once and derive every bit position from that
+digest, so a check costs one SHA-1 and a handful of byte reads. The file is
+opened with mmap, so worker processes share its pages through the page
+cache instead of each loading a copy. A bloom filter can report a password
+that was never added (at the rate chosen when building), but never misses
+one that was.
+"""
+import argparse
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"PWBLOOM1"
+_HEADER = struct.Struct("<8sIQQ")
+DEFAULT_PATH = "breached_passwords.bloom"
+DEFAULT_FP_RATE = 0.001
+
+BREACHED_REJECTIONS = REGISTRY.counter("breached_password_rejections_total",
+                                       "Passwords rejected because they appear in the breach filter")
+
+
+def _positions(digest: bytes, hashes: int, bits: int) -> Iterator[int]:
+    # Double hashing (Kirsch-Mitzenmacher): two 64-bit halves of one digest
+    # stand in for ``hashes`` independent hash functions
+    first, second = struct.unpack_from("<QQ", digest)
+    second |= 1
+    for i in range(hashes):
+        yield (first + i * second) % bits
+
+
+def filter_size(count: int, fp_rate: float) -> Tuple[int, int]:
+    """Bits and hash functions for ``count`` passwords at ``fp_rate``"""
+    count = max(count, 1)
+    bits = max(64, math.ceil(-count * math.log(fp_rate) / math.log(2) ** 2))
+    hashes = max(1, round(bits / count * math.log(2)))
+    return bits, hashes
+
+
+def corpus_digests(lines: Iterable[str], plaintext: bool = False) -> Iterator[bytes]:
+    """SHA-1 digests of the passwords in a corpus file; unreadable lines are skipped"""
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if plaintext:
+            if line:
+                yield hashlib.sha1(line.encode()).digest()
+            continue
+        try:
+            digest = bytes.fromhex(line.split(":", 1)[0].strip())
+        except ValueError:
+            continue
+        if len(digest) == 20:
+            yield digest
+
+
+def build_filter(path: str, digests: Iterable[bytes], count: int, fp_rate: float = DEFAULT_FP_RATE) -> int:
+    """Write a filter holding ``digests`` atomically and return how many were added.
+
+    ``count`` sizes the filter; adding more than that raises the false
+    positive rate above ``fp_rate``.
+    """
+    bits, hashes = filter_size(count, fp_rate)
+    table = bytearray((bits + 7) // 8)
+    added = 0
+    for digest in digests:
+        for position in _positions(digest, hashes, bits):
+            table[position >> 3] |= 1 << (position & 7)
+        added += 1
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(_HEADER.pack(MAGIC, hashes, bits, added))
+        file.write(table)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    return added
+
+
+class BreachedPasswords:
+    """Read-only view of a filter file written by ``build_filter``"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.hashes, self.bits, self.count = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a breached password filter")
+        if len(self._map) < _HEADER.size + (self.bits + 7) // 8:
+            raise ValueError(f"{path} is truncated")
+
+    def contains_digest(self, digest: bytes) -> bool:
+        table, offset = self._map, _HEADER.size
+        for position in _positions(digest, self.hashes, self.bits):
+            if not table[offset + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __contains__(self, password: str) -> bool:
+        return self.contains_digest(hashlib.sha1(password.encode()).digest())
+
+
+def open_filter(path: str) -> Optional[BreachedPasswords]:
+    """The filter at ``path``, or None (with a warning) if it cannot be used"""
+    if not path or not os.path.exists(path):
+        logger.warning("No breached password filter at %s; breached passwords are not rejected", path)
+        return None
+    try:
+        return BreachedPasswords(path)
+    except (OSError, ValueError, struct.error) as e:
+        logger.error("Cannot use breached password filter %s: %s", path, e)
+        return None
+
+
+def _count_lines(path: str) -> int:
+    count = 0
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            count += block.count(b"\n")
+    return count + 1
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Build or query the breached password filter")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Build a filter from a local corpus file")
+    build.add_argument("corpus", help="One SHA-1 hex digest (optionally HASH:COUNT) or password per line")
+    build.add_argument("-o", "--output", default=DEFAULT_PATH)
+    build.add_argument("--plaintext", action="store_true", help="Lines are passwords rather than SHA-1 digests")
+    build.add_argument("--fp-rate", type=float, default=DEFAULT_FP_RATE, help="Target false positive rate")
+    check = commands.add_parser("check", help="Look passwords up in a filter")
+    check.add_argument("passwords", nargs="+")
+    check.add_argument("-f", "--filter", default=DEFAULT_PATH)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        if not 0 < args.fp_rate < 1:
+            parser.error("--fp-rate must be between 0 and 1")
+        # Size the filter from a quick first pass over the file
+        count = _count_lines(args.corpus)
+        with open(args.corpus, "r", encoding="utf-8", errors="replace") as corpus:
+            added = build_filter(args.output, corpus_digests(corpus, args.plaintext), count, args.fp_rate)
+        bits, hashes = filter_size(count, args.fp_rate)
+        print(f"Added {added} passwords to {args.output} ({bits // 8 // 1024} KiB, {hashes} hash functions)")
+        return 0
+
+    breached = BreachedPasswords(args.filter)
+    found = False
+    for password in args.passwords:
+        hit = password in breached
+        found = found or hit
+        print(f"{password}: {'breached' if hit else 'not found'}")
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
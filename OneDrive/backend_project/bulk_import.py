@@ -0,0 +1,157 @@
+"""Bulk user import from CSV or JSONL.
+
+Used by ``POST /users/bulk`` and from the command line::
+
+    python user_auth.py import users.csv
+    python user_auth.py import users.jsonl --report errors.json
+
+Each row needs ``username``, ``password`` and ``email``; ``role`` is optional.
+Rows are validated as they are read, passwords are hashed in parallel
+batches on the password hasher's process pool, and every accepted user is
+committed with a single write at the end.
+"""
+import argparse
+import csv
+import json
+import sys
+import time
+from typing import Dict, Iterator, List, Set, TextIO, Tuple
+
+from user_auth import UserRepository, User, UserRole, ValidationError, password_hasher
+
+FORMATS = ("csv", "jsonl")
+HASH_BATCH_SIZE = 1000
+
+
+def read_rows(stream: TextIO, fmt: str) -> Iterator[Tuple[int, Dict]]:
+    """Yield (row number, fields) pairs; unreadable rows carry an "error" field"""
+    if fmt == "csv":
+        for number, row in enumerate(csv.DictReader(stream), start=1):
+            yield number, row
+    elif fmt == "jsonl":
+        for number, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield number, {"error": "Invalid JSON"}
+                continue
+            yield number, row if isinstance(row, dict) else {"error": "Row is not an object"}
+    else:
+        raise ValueError(f"Unknown import format: {fmt}")
+
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.errors: List[Dict] = []
+        self.seconds = 0.0
+
+    def fail(self, row: int, username, error: str):
+        self.errors.append({"row": row, "username": username, "error": error})
+
+    def to_dict(self) -> Dict:
+        return {
+            "imported": self.imported,
+            "failed": len(self.errors),
+            "seconds": round(self.seconds, 3),
+            "errors": self.errors
+        }
+
+
+def _check_row(repo: UserRepository, row: Dict, usernames: Set[str], emails: Set[str]) -> str:
+    """Return why a row cannot be imported, or an empty string"""
+    if "error" in row:
+        return row["error"]
+    username, password, email = row.get("username"), row.get("password"), row.get("email")
+    if not all([username, password, email]):
+        return "Missing fields"
+    role = row.get("role")
+    if not all(isinstance(value, str) for value in (username, password, email)) or \
+            (role is not None and not isinstance(role, str)):
+        return "Fields must be strings"
+    if role and role not in [choice.value for choice in UserRole]:
+        return "Invalid role"
+    if not User.validate_email(email):
+        return "Invalid email"
+    if not User.validate_password(password):
+        return "Weak password"
+    email_key = email.strip().lower()
+    if username in usernames or repo.get_user(username):
+        return "Username already exists"
+    if email_key in emails or repo.get_user_by_email(email):
+        return "Email already registered"
+    usernames.add(username)
+    emails.add(email_key)
+    return ""
+
+
+def _build_users(batch: List[Dict]) -> List[User]:
+    hashes = password_hasher().hash_many(row["password"] for row in batch)
+    users = []
+    for row, password_hash in zip(batch, hashes):
+        user = User(row["username"], "", row["email"], row.get("role") or UserRole.USER)
+        user.password_hash = password_hash
+        users.append(user)
+    return users
+
+
+def import_users(repo: UserRepository, stream: TextIO, fmt: str) -> ImportReport:
+    """Validate, hash and store every row of ``stream`` in one commit"""
+    report = ImportReport()
+    started = time.perf_counter()
+    usernames: Set[str] = set()
+    emails: Set[str] = set()
+    users: List[User] = []
+    batch: List[Dict] = []
+    for number, row in read_rows(stream, fmt):
+        error = _check_row(repo, row, usernames, emails)
+        if error:
+            report.fail(number, row.get("username"), error)
+            continue
+        batch.append(row)
+        if len(batch) >= HASH_BATCH_SIZE:
+            users.extend(_build_users(batch))
+            batch = []
+    if batch:
+        users.extend(_build_users(batch))
+    if users:
+        try:
+            repo.add_users(users)
+        except ValidationError as e:
+            # Someone else took a name or email while we were hashing
+            for user in users:
+                report.fail(0, user.username, str(e))
+            users = []
+    report.imported = len(users)
+    report.seconds = time.perf_counter() - started
+    return report
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog="user_auth.py import", description="Bulk import users from CSV or JSONL")
+    parser.add_argument("file", help="input file, or - for stdin")
+    parser.add_argument("--format", choices=FORMATS, help="input format (default: from the file extension)")
+    parser.add_argument("--report", help="write the per-row error report to this JSON file")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ("csv" if args.file.endswith(".csv") else "jsonl")
+    repo = UserRepository()
+    if args.file == "-":
+        report = import_users(repo, sys.stdin, fmt)
+    else:
+        with open(args.file, "r", encoding="utf-8", newline="") as stream:
+            report = import_users(repo, stream, fmt)
+    password_hasher().shutdown()
+
+    result = report.to_dict()
+    print(f"Imported {result['imported']} users, {result['failed']} failed, in {result['seconds']}s")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as file:
+            json.dump(result["errors"], file, indent=4)
+        print(f"Error report written to {args.report}")
+    else:
+        for error in result["errors"]:
+            print(f"Row {error['row']} ({error['username']}): {error['error']}")
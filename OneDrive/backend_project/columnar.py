@@ -0,0 +1,270 @@
+"""Column-oriented in-memory user storage.
+
+``JsonFileBackend`` keeps one ``User`` object per user. ``ColumnarBackend``
+keeps the same data in parallel columns instead: lists of usernames, emails
+and packed password hashes, a bytearray of role codes and an int64 array of
+creation times. The indexes map to row numbers, and the ``User`` objects
+handed out are short-lived views that read and write their row, so callers
+keep using the normal ``User`` API.
+
+Per user this drops the object header and attribute storage of a ``User``,
+and full scans (listing, role lookups) walk compact arrays instead of
+chasing a pointer per user.
+"""
+from array import array
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+from journal import UserJournal
+from passwords import pack_hash, unpack_hash
+from storage import JsonFileBackend, decode_timestamp, encode_timestamp, normalize_email
+
+# Marks a created_at that is kept as text, and a freed row's role
+_NO_TIMESTAMP = -(2 ** 63)
+_NO_ROLE = 255
+
+
+class UserTable:
+    """Users stored column by column and addressed by row number"""
+
+    def __init__(self):
+        self.usernames: List[Optional[str]] = []
+        self.emails: List[Optional[str]] = []
+        self.hashes: List[Any] = []
+        self.roles = bytearray()
+        self.created = array("q")
+        # created_at values that are not plain ISO timestamps, by row
+        self.created_text: Dict[int, str] = {}
+        self.role_values: List[Any] = []
+        self.role_codes: Dict[Any, int] = {}
+        self.free_rows: List[int] = []
+
+    def role_code(self, role) -> int:
+        code = self.role_codes.get(role)
+        if code is None:
+            if len(self.role_values) >= _NO_ROLE:
+                raise ValueError("Too many distinct roles")
+            code = self.role_codes[role] = len(self.role_values)
+            self.role_values.append(role)
+        return code
+
+    def insert(self, user) -> int:
+        """Copy a user into a free row and return the row number"""
+        if self.free_rows:
+            row = self.free_rows.pop()
+            self.usernames[row] = user.username
+            self.emails[row] = user.email
+            self.hashes[row] = None
+            self.roles[row] = 0
+            self.created[row] = 0
+        else:
+            row = len(self.usernames)
+            self.usernames.append(user.username)
+            self.emails.append(user.email)
+            self.hashes.append(None)
+            self.roles.append(0)
+            self.created.append(0)
+        self.set_password_hash(row, user.password_hash)
+        self.set_role(row, user.role)
+        self.set_created_at(row, user.created_at)
+        return row
+
+    def remove(self, row: int):
+        self.usernames[row] = None
+        self.emails[row] = None
+        self.hashes[row] = None
+        self.roles[row] = _NO_ROLE
+        self.created_text.pop(row, None)
+        self.free_rows.append(row)
+
+    def rows_with_role(self, role) -> Iterator[int]:
+        code = self.role_codes.get(role)
+        if code is None:
+            return
+        # bytearray.find scans in C, so this stays fast over millions of rows
+        marker = bytes([code])
+        row = self.roles.find(marker)
+        while row != -1:
+            yield row
+            row = self.roles.find(marker, row + 1)
+
+    def password_hash(self, row: int) -> Optional[str]:
+        return unpack_hash(self.hashes[row])
+
+    def set_password_hash(self, row: int, value: Optional[str]):
+        self.hashes[row] = pack_hash(value)
+
+    def role(self, row: int):
+        return self.role_values[self.roles[row]]
+
+    def set_role(self, row: int, role):
+        self.roles[row] = self.role_code(role)
+
+    def created_at(self, row: int) -> Optional[str]:
+        value = self.created[row]
+        if value == _NO_TIMESTAMP:
+            return self.created_text.get(row)
+        return decode_timestamp(value)
+
+    def set_created_at(self, row: int, value: Optional[str]):
+        encoded = encode_timestamp(value)
+        if isinstance(encoded, int):
+            self.created[row] = encoded
+            self.created_text.pop(row, None)
+        else:
+            self.created[row] = _NO_TIMESTAMP
+            if encoded is None:
+                self.created_text.pop(row, None)
+            else:
+                self.created_text[row] = encoded
+
+
+def make_view_class(user_class: type) -> type:
+    """A ``user_class`` subclass whose attributes live in a ``UserTable`` row"""
+
+    class UserView(user_class):
+        __slots__ = ("_table", "_row")
+
+        def __init__(self, table: UserTable, row: int):
+            self._table = table
+            self._row = row
+
+        @property
+        def username(self) -> str:
+            return self._table.usernames[self._row]
+
+        @username.setter
+        def username(self, value: str):
+            self._table.usernames[self._row] = value
+
+        @property
+        def email(self) -> str:
+            return self._table.emails[self._row]
+
+        @email.setter
+        def email(self, value: str):
+            self._table.emails[self._row] = value
+
+        @property
+        def role(self):
+            table = self._table
+            return table.role_values[table.roles[self._row]]
+
+        @role.setter
+        def role(self, value):
+            self._table.set_role(self._row, value)
+
+        @property
+        def password_hash(self) -> Optional[str]:
+            return unpack_hash(self._table.hashes[self._row])
+
+        @password_hash.setter
+        def password_hash(self, value: Optional[str]):
+            self._table.set_password_hash(self._row, value)
+
+        @property
+        def created_at(self) -> Optional[str]:
+            return self._table.created_at(self._row)
+
+        @created_at.setter
+        def created_at(self, value: Optional[str]):
+            self._table.set_created_at(self._row, value)
+
+        def __repr__(self) -> str:
+            return f"<{user_class.__name__} view {self.username!r} row={self._row}>"
+
+    UserView.__name__ = UserView.__qualname__ = f"{user_class.__name__}View"
+    return UserView
+
+
+class ColumnarBackend(JsonFileBackend):
+    """``JsonFileBackend`` with users kept in a ``UserTable``.
+
+    The username and email indexes hold row numbers rather than objects.
+    Usernames can never change through ``update`` (they are the key), so a
+    row keeps its number until the user is deleted.
+    """
+
+    def __init__(self, path: str, user_factory: Callable[[Dict], Any], user_class: type,
+                 journal: Optional[UserJournal] = None, shards: int = 1, load_workers: int = 0):
+        super().__init__(path, user_factory, journal, shards, load_workers)
+        self.table = UserTable()
+        self.view_class = make_view_class(user_class)
+
+    def _view(self, row: Optional[int]):
+        return None if row is None else self.view_class(self.table, row)
+
+    def _get(self, username: str):
+        with self.lock.read():
+            return self._view(self.users_by_username.get(username))
+
+    def _get_by_email(self, email: str):
+        with self.lock.read():
+            return self._view(self.users_by_email.get(normalize_email(email)))
+
+    def users_with_role(self, role) -> List:
+        with self.lock.read():
+            return [self._view(row) for row in self.table.rows_with_role(role)]
+
+    def iter_users(self, after: Optional[str] = None) -> Iterator:
+        view, table = self.view_class, self.table
+        for row in super().iter_users(after):
+            yield view(table, row)
+
+    def _remove_user(self, user):
+        # Persist before this: the row, and so the view, is blank afterwards
+        row = self.users_by_username.get(user.username)
+        self._unindex_user(user)
+        if row is not None:
+            self.table.remove(row)
+
+    def _all_users(self) -> List:
+        # Rows are freed and reused once the lock is released, so remember
+        # whose row each one was
+        return list(self.users_by_username.items())
+
+    def _users_of(self, usernames: Set[str]) -> List:
+        return [(username, self.users_by_username[username]) for username in usernames]
+
+    def _records(self, users: List) -> List[Dict]:
+        data = []
+        chunk_size = 1024
+        for start in range(0, len(users), chunk_size):
+            with self.lock.read():
+                for username, row in users[start:start + chunk_size]:
+                    # A user deleted since the capture is left out; the
+                    # delete is in the journal after the snapshot anyway
+                    if self.table.usernames[row] == username:
+                        data.append(self._view(row).to_dict())
+        return data
+
+    def _index_user(self, user, keep_sorted: bool = True):
+        if isinstance(user, self.view_class) and user._table is self.table:
+            row = user._row
+        else:
+            row = self.table.insert(user)
+        username = self.table.usernames[row]
+        if username not in self.users_by_username:
+            self._add_sorted(username, keep_sorted)
+        self.users_by_username[username] = row
+        email = self.table.emails[row]
+        email_key = normalize_email(email)
+        # Share the email string when it is already normalized
+        self.users_by_email[email if email_key == email else email_key] = row
+
+    def _unindex_user(self, user):
+        row = self.users_by_username.pop(user.username, None)
+        if row is None:
+            return
+        self._remove_sorted(user.username)
+        email_key = normalize_email(user.email)
+        if self.users_by_email.get(email_key) == row:
+            del self.users_by_email[email_key]
+
+    def _index_record(self, record: Dict):
+        username = record["username"] if record["op"] == "delete" else record["user"]["username"]
+        row = self.users_by_username.get(username)
+        if row is not None:
+            self._unindex_user(self._view(row))
+            self.table.remove(row)
+        if record["op"] != "delete":
+            self._index_user(self.user_factory(record["user"]))
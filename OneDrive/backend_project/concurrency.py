@@ -0,0 +1,177 @@
+"""Locking and write batching for the in-memory backends.
+
+``ReadWriteLock`` lets any number of lookups run together while a change
+to the indexes has them to itself. ``GroupCommit`` turns a burst of
+concurrent durable writes into one: each writer queues its item, and
+whichever thread finds no write in progress writes everything queued so
+far while the others wait for it.
+"""
+import threading
+from typing import Any, Callable, Dict, List
+
+from metrics import REGISTRY
+
+BATCH_SIZE = REGISTRY.histogram("group_commit_batch_size", "Changes made durable by one write", ["name"],
+                                buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+
+class _Guard:
+    __slots__ = ("_acquire", "_release")
+
+    def __init__(self, acquire: Callable[[], None], release: Callable[[], None]):
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        self._acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._release()
+        return False
+
+
+class ReadWriteLock:
+    """Shared reads, exclusive writes.
+
+    Use ``with lock.read():`` and ``with lock.write():``. Waiting writers
+    hold back new readers so a steady stream of lookups cannot starve them.
+    A thread may re-enter the lock it holds, and the writing thread may also
+    read, but a reader cannot upgrade to writing.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._readers = 0
+        self._writers_waiting = 0
+        self._writer = None
+        self._write_depth = 0
+        # Read depth per thread that holds the lock for reading
+        self._depths: Dict[int, int] = {}
+        self._read_guard = _Guard(self.acquire_read, self.release_read)
+        self._write_guard = _Guard(self.acquire_write, self.release_write)
+
+    def read(self) -> _Guard:
+        return self._read_guard
+
+    def write(self) -> _Guard:
+        return self._write_guard
+
+    def held(self) -> bool:
+        """Whether the calling thread holds the lock, for reading or writing"""
+        me = threading.get_ident()
+        return self._writer == me or me in self._depths
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        depth = self._depths.get(me)
+        if depth is not None:
+            self._depths[me] = depth + 1
+            return
+        if self._writer != me:
+            with self._lock:
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+                self._readers += 1
+        self._depths[me] = 1
+
+    def release_read(self):
+        me = threading.get_ident()
+        depth = self._depths[me] - 1
+        if depth:
+            self._depths[me] = depth
+            return
+        del self._depths[me]
+        if self._writer == me:
+            return
+        with self._lock:
+            self._readers -= 1
+            if not self._readers and self._writers_waiting:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            self._write_depth += 1
+            return
+        with self._lock:
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._write_depth = 1
+
+    def release_write(self):
+        self._write_depth -= 1
+        if self._write_depth:
+            return
+        with self._lock:
+            self._writer = None
+            self._cond.notify_all()
+
+
+class _Batch:
+    __slots__ = ("items", "done", "error")
+
+    def __init__(self):
+        self.items: List[Any] = []
+        self.done = False
+        self.error = None
+
+
+class GroupCommit:
+    """Coalesces concurrent writes of queued items.
+
+    ``submit`` queues an item and returns a ticket; ``wait(ticket)`` returns
+    once a ``write(items)`` call that included it has finished, or raises
+    what that call raised. ``write`` only ever runs in one thread at a time.
+    """
+
+    def __init__(self, write: Callable[[List[Any]], None], name: str):
+        self._write = write
+        self.name = name
+        self._cond = threading.Condition(threading.Lock())
+        self._open = _Batch()
+        self._writing = False
+
+    def submit(self, item: Any) -> _Batch:
+        with self._cond:
+            self._open.items.append(item)
+            return self._open
+
+    def wait(self, ticket: _Batch):
+        with self._cond:
+            while not ticket.done:
+                if self._writing:
+                    self._cond.wait()
+                else:
+                    self._lead()
+        if ticket.error is not None:
+            raise ticket.error
+
+    def drain(self):
+        """Write everything submitted so far and wait for it"""
+        with self._cond:
+            ticket = self._open
+        self.wait(ticket)
+
+    def _lead(self):
+        # Called with the condition held and no write in progress
+        batch, self._open = self._open, _Batch()
+        self._writing = True
+        self._cond.release()
+        try:
+            if batch.items:
+                self._write(batch.items)
+                BATCH_SIZE.observe(len(batch.items), name=self.name)
+        except Exception as e:
+            batch.error = e
+        finally:
+            self._cond.acquire()
+            self._writing = False
+            batch.done = True
+            self._cond.notify_all()
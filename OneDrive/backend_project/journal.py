@@ -0,0 +1,396 @@
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional
+
+from concurrency import GroupCommit
+from metrics import REGISTRY
+
+try:
+    import fcntl
+except ImportError:  # Windows: no locking between processes
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+FOLLOW_APPLIED = REGISTRY.counter("journal_follow_applied_total", "Changes applied from other workers")
+FOLLOW_RESYNCS = REGISTRY.counter("journal_follow_resyncs_total",
+                                  "Times this worker fell a whole compaction behind and reread the users file")
+FOLLOW_LAG_BYTES = REGISTRY.gauge("journal_follow_lag_bytes", "Journal bytes written by other workers not yet applied")
+FOLLOW_LAG_SECONDS = REGISTRY.gauge("journal_follow_lag_seconds",
+                                    "Seconds since this worker was last caught up with the journal (0 when it is)")
+
+
+def _flock(file, exclusive: bool = True, blocking: bool = True) -> bool:
+    if fcntl is None:
+        return True
+    flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    try:
+        fcntl.flock(file.fileno(), flags if blocking else flags | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def _funlock(file):
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+def _parse(data: bytes, path: str) -> Iterator[Dict]:
+    for line in data.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            # A torn write from a crash
+            logger.warning("Skipping unreadable journal record in %s", path)
+
+
+class UserJournal:
+    """Append-only log of user mutations, shared by every worker process.
+
+    Every mutation is written as one compact JSON line. Once enough records
+    have piled up, a background thread folds them into the snapshot file and
+    starts a fresh log. On startup the snapshot is loaded first and the log is
+    replayed on top of it; records are idempotent (full user state or delete),
+    so replaying a record that is already in the snapshot is harmless.
+
+    Records are written under an exclusive lock on ``<log>.lock``, right after
+    the writer has caught up with the log, so sequence numbers are global and
+    checks made under the lock hold across processes. Durability waits on
+    ``wait``: with ``fsync`` on, records written by concurrent threads share
+    one fsync.
+
+    Each worker also follows the log: a background thread notices new bytes
+    (by size and inode) and hands other workers' records to the backend, so
+    changes spread without reloading anything. Each log starts with a
+    ``rotate`` header carrying its generation; a worker that slept through a
+    whole generation rereads the users file instead. Without ``fcntl``
+    (Windows), only a single worker process is supported.
+    """
+
+    def __init__(self, path: str, compact_threshold: int = 1000, fsync: bool = False,
+                 poll_interval: float = 0.05):
+        self.path = path
+        self.rotated_path = path + ".compacting"
+        self.compact_threshold = compact_threshold
+        self.fsync = fsync
+        self.poll_interval = poll_interval
+        self.writer_id = secrets.token_hex(4)
+        self.seq = 0
+        self.gen = 0
+        self.pending = 0
+        self.synced_at = time.monotonic()
+        self._lock = threading.RLock()
+        self._exclusive_depth = 0
+        self._append_lock = open(path + ".lock", "a+b")
+        self._compaction_lock = open(path + ".compact.lock", "a+b")
+        self._syncs = GroupCommit(self._fsync, "journal")
+        self._fd: Optional[int] = None
+        self._writer_ino = None
+        self._reader = None
+        self._reader_ino = None
+        self._read_offset = 0
+        self._awaiting_gen: Optional[int] = None
+        self._capture: Optional[Callable[[], Any]] = None
+        self._write: Optional[Callable[[Any], None]] = None
+        self._hold: Optional[Callable[[], ContextManager]] = None
+        self._sync: Optional[Callable[[], None]] = None
+        self._compact_requested = threading.Event()
+        FOLLOW_LAG_BYTES.set_function(self.behind)
+        FOLLOW_LAG_SECONDS.set_function(self.lag_seconds)
+
+    @contextmanager
+    def loading(self):
+        """Keep other workers from compacting while the users file and log are read"""
+        _flock(self._compaction_lock, exclusive=False)
+        try:
+            yield
+        finally:
+            _funlock(self._compaction_lock)
+
+    def replay(self) -> Iterator[Dict]:
+        """Yield every record left over from previous runs, oldest first.
+
+        Afterwards the log stays open for ``follow`` at the point replay
+        reached.
+        """
+        if os.path.exists(self.rotated_path):
+            with open(self.rotated_path, "rb") as file:
+                records = list(self._records(file.read(), self.rotated_path))
+            yield from (record for record in records if record["op"] != "rotate")
+        if not os.path.exists(self.path):
+            open(self.path, "ab").close()
+        with self._lock:
+            self._open_reader()
+            records = list(self._read_records())
+        yield from (record for record in records if record["op"] != "rotate")
+
+    def start(self, capture: Callable[[], Any], write: Callable[[Any], None],
+              hold: Callable[[], ContextManager], sync: Callable[[], None]):
+        """Start background compaction and following.
+
+        ``hold`` returns a context in which the data cannot change and every
+        record in the log has been applied; ``capture`` is called inside it
+        and returns a cheap point-in-time view of the data. ``write``
+        persists that view as the new snapshot and runs outside it. ``sync``
+        applies records other workers have appended.
+        """
+        self._capture = capture
+        self._write = write
+        self._hold = hold
+        self._sync = sync
+        if os.path.exists(self.rotated_path) and _flock(self._compaction_lock, blocking=False):
+            # A previous compaction did not finish (no worker is running one);
+            # everything has been replayed into memory, so write it out.
+            try:
+                with self._hold():
+                    snapshot = self._capture()
+                self._write(snapshot)
+                os.remove(self.rotated_path)
+            finally:
+                _funlock(self._compaction_lock)
+        threading.Thread(target=self._compact_loop, name="journal-compactor", daemon=True).start()
+        threading.Thread(target=self._follow_loop, name="journal-follower", daemon=True).start()
+        if self.pending >= self.compact_threshold:
+            self._compact_requested.set()
+
+    @contextmanager
+    def exclusive(self):
+        """Hold the log against writers in this and every other worker"""
+        with self._lock:
+            self._exclusive_depth += 1
+            if self._exclusive_depth == 1:
+                _flock(self._append_lock)
+            try:
+                yield
+            finally:
+                self._exclusive_depth -= 1
+                if not self._exclusive_depth:
+                    _funlock(self._append_lock)
+
+    def append(self, op: str, **fields):
+        """Write one record and return a ticket to ``wait`` on"""
+        return self.append_many([{"op": op, **fields}])
+
+    def append_many(self, records: List[Dict]):
+        """Write several records at once and return a ticket to ``wait`` on"""
+        with self.exclusive():
+            self._open_writer()
+            lines = []
+            for record in records:
+                self.seq += 1
+                lines.append(json.dumps({"w": self.writer_id, "seq": self.seq, **record}, separators=(",", ":")))
+            data = ("\n".join(lines) + "\n").encode()
+            end = os.fstat(self._fd).st_size
+            self._write_all(data)
+            if self._reader is not None and self._read_offset == end and self._reader_ino == self._writer_ino:
+                # Nothing unread before our own records; no need to read them back
+                self._read_offset += len(data)
+            self.pending += len(records)
+            if self.pending >= self.compact_threshold:
+                self._compact_requested.set()
+            return self._syncs.submit(None) if self.fsync else None
+
+    def wait(self, ticket):
+        """Block until the records behind ``ticket`` are durable"""
+        if ticket is not None:
+            self._syncs.wait(ticket)
+
+    def follow(self, apply: Callable[[Dict], None], resync: Callable[[List[Dict]], None]) -> int:
+        """Apply records other workers have written since the last call.
+
+        ``resync(rotated_records)`` is called instead when a whole log
+        generation was missed; it must rebuild the data from the users file
+        and then apply ``rotated_records``. Returns the number of records
+        applied.
+        """
+        with self._lock:
+            if self._reader is None:
+                return 0
+            applied = self._apply(self._read_records(), apply, resync)
+            try:
+                rotated = os.stat(self.path).st_ino != self._reader_ino
+            except FileNotFoundError:
+                rotated = False  # Caught mid-rotation; the next call sees the new log
+            if rotated:
+                # Nothing is written to a log once it has been rotated out
+                applied += self._apply(self._read_records(), apply, resync)
+                self._reader.close()
+                self._open_reader()
+                self._awaiting_gen = self.gen + 1
+                self.pending = 0
+                applied += self._apply(self._read_records(), apply, resync)
+            self.synced_at = time.monotonic()
+            if applied:
+                FOLLOW_APPLIED.inc(applied)
+            return applied
+
+    def behind(self) -> int:
+        """How many bytes of the log this worker has not read yet"""
+        reader_ino = self._reader_ino
+        if reader_ino is None:
+            return 0
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return 0
+        if stat.st_ino != reader_ino:
+            return max(stat.st_size, 1)
+        return max(stat.st_size - self._read_offset, 0)
+
+    def lag_seconds(self) -> float:
+        return time.monotonic() - self.synced_at if self.behind() else 0.0
+
+    def compact(self, force: bool = False):
+        """Fold the current log into the snapshot.
+
+        ``force`` writes the snapshot even if nothing was logged. Skipped if
+        another worker is compacting already.
+        """
+        if self._capture is None or self._write is None:
+            return
+        if not _flock(self._compaction_lock, blocking=False):
+            return
+        try:
+            with self._hold(), self.exclusive():
+                if self.pending == 0 and not force:
+                    return
+                # Queued fsyncs belong to the log being rotated out
+                self._syncs.drain()
+                self._close_writer()
+                if os.path.exists(self.rotated_path):
+                    # An earlier compaction failed part way; keep its records
+                    if os.path.exists(self.path):
+                        with open(self.path, "rb") as src, open(self.rotated_path, "ab") as dst:
+                            dst.write(src.read())
+                        os.remove(self.path)
+                elif os.path.exists(self.path):
+                    os.replace(self.path, self.rotated_path)
+                self.gen += 1
+                self._open_writer()
+                self._write_all((json.dumps({"op": "rotate", "gen": self.gen}) + "\n").encode())
+                if self._reader is not None:
+                    self._reader.close()
+                self._open_reader()
+                self._read_offset = os.fstat(self._fd).st_size
+                self.pending = 0
+                snapshot = self._capture()
+            self._write(snapshot)
+            if os.path.exists(self.rotated_path):
+                os.remove(self.rotated_path)
+        finally:
+            _funlock(self._compaction_lock)
+
+    def _apply(self, records: Iterator[Dict], apply: Callable[[Dict], None],
+               resync: Callable[[List[Dict]], None]) -> int:
+        applied = 0
+        for record in records:
+            if self._awaiting_gen is not None:
+                expected, self._awaiting_gen = self._awaiting_gen, None
+                if record.get("op") != "rotate" or record.get("gen") != expected:
+                    logger.warning("Missed a journal generation; rereading the users file")
+                    FOLLOW_RESYNCS.inc()
+                    rotated = []
+                    if os.path.exists(self.rotated_path):
+                        with open(self.rotated_path, "rb") as file:
+                            rotated = [record for record in _parse(file.read(), self.rotated_path)
+                                       if record["op"] != "rotate"]
+                    resync(rotated)
+                    applied += 1
+            if record.get("op") == "rotate":
+                self.gen = record["gen"]
+            elif record.get("w") != self.writer_id:
+                apply(record)
+                applied += 1
+        return applied
+
+    def _records(self, data: bytes, path: str) -> Iterator[Dict]:
+        for record in _parse(data, path):
+            if record["op"] == "rotate":
+                self.gen = record["gen"]
+            else:
+                self.seq = max(self.seq, record.get("seq", 0))
+                self.pending += 1
+            yield record
+
+    def _read_records(self) -> Iterator[Dict]:
+        """Records in the followed log past the last complete line read"""
+        self._reader.seek(self._read_offset)
+        data = self._reader.read()
+        end = data.rfind(b"\n") + 1
+        self._read_offset += end
+        return self._records(data[:end], self.path)
+
+    def _open_reader(self):
+        self._reader = open(self.path, "rb")
+        self._reader_ino = os.fstat(self._reader.fileno()).st_ino
+        self._read_offset = 0
+
+    def _open_writer(self):
+        # Another worker may have rotated the log since we last wrote
+        try:
+            current = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            current = None
+        if self._fd is not None and current == self._writer_ino:
+            return
+        if self._fd is not None and self.fsync:
+            # Queued fsyncs are for records in the old file
+            self._syncs.drain()
+        self._close_writer()
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._writer_ino = os.fstat(self._fd).st_ino
+        with open(self.path, "rb") as file:
+            file.seek(0, os.SEEK_END)
+            if file.tell():
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    # Finish a line torn by a crash so it cannot swallow ours
+                    self._write_all(b"\n")
+
+    def _write_all(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]
+
+    def _fsync(self, items: List):
+        # No lock: the writer is only closed once queued fsyncs have drained
+        fd = self._fd
+        if fd is not None:
+            os.fsync(fd)
+
+    def _close_writer(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._writer_ino = None
+
+    def _compact_loop(self):
+        while True:
+            self._compact_requested.wait()
+            self._compact_requested.clear()
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error("Journal compaction failed: %s", e)
+
+    def _follow_loop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                if self.behind():
+                    self._sync()
+                else:
+                    self.synced_at = time.monotonic()
+                if self.pending >= self.compact_threshold:
+                    self._compact_requested.set()
+            except Exception as e:
+                logger.error("Following the journal failed: %s", e)
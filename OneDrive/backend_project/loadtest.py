@@ -0,0 +1,420 @@
+"""HTTP load test of the Flask API with latency gates.
+
+    python loadtest.py                                   # every profile, 10s each
+    python loadtest.py --profile login_storm --concurrency 32 --duration 30
+    python loadtest.py --users 100000 --layout columnar
+    python loadtest.py --thresholds loadtest_thresholds.json
+
+The app from api.py is started in a separate process on a free local port,
+inside a temporary directory seeded with ``--users`` synthetic users
+(``user0000000`` is an admin), so the real users file, sessions and token
+secret are never touched. Each traffic profile then runs for ``--duration``
+seconds from ``--concurrency`` threads, each holding one keep-alive
+connection. Requests made during the ``--warmup`` period are not counted.
+
+Profiles are weighted mixes of requests:
+
+    login_storm          POST /login, one in ten with a wrong password
+    registration_burst   GET /users/available/<name> then POST /register
+    admin_polling        POST /admin/users and GET /users, revalidating ETags
+    mixed                all of the above plus GET /users/search
+
+Login throttling is lifted on the server unless ``--throttle`` is given, so
+a login storm measures password checks rather than 429s.
+
+For every route the report gives requests/sec, p50/p95/p99 latency and the
+error rate (unexpected statuses and failed connections). Results are
+written as JSON. ``--thresholds`` names a JSON file of limits per profile
+and route; ``"*"`` matches any profile or route, and the most specific
+entry wins::
+
+    {
+        "*": {"*": {"max_error_rate": 0.01, "p99_ms": 1000}},
+        "login_storm": {"POST /login": {"p95_ms": 250, "min_rps": 40}}
+    }
+
+Limits are ``p50_ms``, ``p95_ms`` and ``p99_ms`` (maximum latency),
+``min_rps`` and ``max_error_rate``. The exit status is 1 if any is crossed.
+"""
+import argparse
+import contextlib
+import http.client
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from benchmark import PASSWORD, percentile, write_users
+
+DEFAULT_OUTPUT = "loadtest_results.json"
+DEFAULT_USERS = 10_000
+ADMIN = "user0000000"
+
+# Registered usernames stay unique across workers and profiles
+_new_users = itertools.count(1)
+
+
+class Client:
+    """One keep-alive connection to the server under test"""
+
+    def __init__(self, port: int, timeout: float):
+        self.connection = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+        self.etags: Dict[str, str] = {}
+
+    def request(self, method: str, path: str, body: Optional[Dict] = None,
+                headers: Optional[Dict[str, str]] = None) -> Tuple[int, bytes]:
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        try:
+            self.connection.request(method, path, payload, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            # Reconnect on the next request
+            self.connection.close()
+            raise
+        etag = response.getheader("ETag")
+        if etag:
+            self.etags[path] = etag
+        return response.status, data
+
+    def revalidate(self, method: str, path: str, headers: Optional[Dict[str, str]] = None) -> int:
+        """Request ``path`` with the ETag it last returned, like a polling client"""
+        headers = dict(headers or {})
+        if path in self.etags:
+            headers["If-None-Match"] = self.etags[path]
+        return self.request(method, path, headers=headers)[0]
+
+    def close(self):
+        self.connection.close()
+
+
+class Worker:
+    """State of one load generating thread"""
+
+    def __init__(self, client: Client, worker_id: int, options: Dict):
+        self.client = client
+        self.id = worker_id
+        self.options = options
+        self.rng = random.Random(worker_id)
+        # Checked for availability; the next registration uses it
+        self.checked: Optional[str] = None
+        # Filled by the first admin request
+        self.admin_token: Optional[str] = None
+
+    def random_user(self) -> str:
+        return f"user{self.rng.randrange(self.options['users']):07d}"
+
+    def next_username(self) -> str:
+        username, self.checked = self.checked, None
+        return username or f"lt{os.getpid()}n{next(_new_users)}"
+
+    def admin_headers(self) -> Dict[str, str]:
+        if self.admin_token is None:
+            status, data = self.client.request("POST", "/login", {"username": ADMIN, "password": PASSWORD})
+            if status != 200:
+                raise RuntimeError(f"Admin login failed with status {status}")
+            self.admin_token = json.loads(data)["token"]
+        return {"Authorization": f"Bearer {self.admin_token}"}
+
+
+# An action makes one request and returns whether its status was expected
+Action = Callable[[Worker], bool]
+
+
+def login(worker: Worker) -> bool:
+    status, _ = worker.client.request("POST", "/login", {"username": worker.random_user(), "password": PASSWORD})
+    return status == 200 or (status == 429 and worker.options["throttle"])
+
+
+def login_failed(worker: Worker) -> bool:
+    status, _ = worker.client.request("POST", "/login", {"username": worker.random_user(), "password": "Wrong123!"})
+    return status == 401 or (status == 429 and worker.options["throttle"])
+
+
+def username_available(worker: Worker) -> bool:
+    username = worker.next_username()
+    status, _ = worker.client.request("GET", f"/users/available/{username}")
+    worker.checked = username
+    return status == 200
+
+
+def register(worker: Worker) -> bool:
+    username = worker.next_username()
+    status, _ = worker.client.request("POST", "/register",
+                                      {"username": username, "password": PASSWORD, "email": f"{username}@example.com"})
+    return status == 201
+
+
+def list_users(worker: Worker) -> bool:
+    return worker.client.revalidate("GET", "/users?limit=50") in (200, 304)
+
+
+def search_users(worker: Worker) -> bool:
+    prefix = worker.random_user()[:worker.rng.randint(5, 9)]
+    return worker.client.request("GET", f"/users/search?prefix={prefix}")[0] == 200
+
+
+def admin_users(worker: Worker) -> bool:
+    return worker.client.revalidate("POST", "/admin/users", worker.admin_headers()) in (200, 304)
+
+
+ROUTES: Dict[Action, str] = {
+    login: "POST /login",
+    login_failed: "POST /login",
+    username_available: "GET /users/available/<username>",
+    register: "POST /register",
+    list_users: "GET /users",
+    search_users: "GET /users/search",
+    admin_users: "POST /admin/users",
+}
+
+# Profile name -> (action, weight) pairs
+PROFILES: Dict[str, List[Tuple[Action, int]]] = {
+    "login_storm": [(login, 9), (login_failed, 1)],
+    "registration_burst": [(username_available, 1), (register, 1)],
+    "admin_polling": [(admin_users, 1), (list_users, 1)],
+    "mixed": [(login, 3), (login_failed, 1), (register, 1), (list_users, 4), (search_users, 2), (admin_users, 1)],
+}
+
+
+def serve(options: Dict, conn):
+    """Seed a temporary directory and serve api.py from it until told to stop"""
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    try:
+        from migration import write_format_marker
+        from user_auth import Config, password_hasher
+
+        # Every relative path in Config now lands in the temporary directory
+        Config.BREACHED_PASSWORD_FILTER = os.path.abspath(Config.BREACHED_PASSWORD_FILTER)
+        os.chdir(workdir)
+        Config.STORAGE_BACKEND = options["backend"]
+        Config.MEMORY_LAYOUT = options["layout"]
+        if not options["throttle"]:
+            Config.LOGIN_RATE_PER_USER = Config.LOGIN_RATE_PER_CLIENT = sys.maxsize
+        if options["backend"] == "sqlite":
+            from benchmark import seed_sqlite
+            seed_sqlite(Config.SQLITE_FILE, options["users"], password_hasher().hash(PASSWORD))
+        else:
+            write_users(Config.USER_FILE, options["users"], password_hasher().hash(PASSWORD))
+            write_format_marker(Config.USER_FILE)
+
+        from werkzeug.serving import make_server
+        # The repository prints as it works and werkzeug logs every request
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            import api
+            logging.getLogger("werkzeug").setLevel(logging.WARNING)
+            server = make_server("127.0.0.1", 0, api.app, threaded=True)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            conn.send(("ok", server.server_port))
+            conn.recv()
+            server.shutdown()
+            api.repo.backend.close()
+        password_hasher().shutdown()
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_worker(worker: Worker, actions: List[Tuple[Action, int]], measure_from: float, until: float,
+               samples: Dict[str, List[float]], statuses: Dict[str, List[int]]):
+    """Send requests until ``until``, recording those started after ``measure_from``"""
+    choices = [action for action, _ in actions]
+    weights = [weight for _, weight in actions]
+    if admin_users in choices:
+        try:
+            worker.admin_headers()  # Log in before the clock starts
+        except (OSError, http.client.HTTPException, RuntimeError, ValueError):
+            pass  # Counted as errors by admin_users
+    while True:
+        action = worker.rng.choices(choices, weights)[0]
+        started = time.perf_counter()
+        if started >= until:
+            break
+        try:
+            ok = action(worker)
+        except (OSError, http.client.HTTPException, RuntimeError, ValueError):
+            ok = False
+        if started >= measure_from:
+            route = ROUTES[action]
+            samples.setdefault(route, []).append(time.perf_counter() - started)
+            # [requests, errors]
+            counts = statuses.setdefault(route, [0, 0])
+            counts[0] += 1
+            counts[1] += not ok
+    worker.client.close()
+
+
+def run_profile(name: str, port: int, options: Dict) -> Dict:
+    """Drive one traffic profile and summarize latency and errors per route"""
+    threads = []
+    per_thread = []
+    start = time.perf_counter()
+    measure_from = start + options["warmup"]
+    until = measure_from + options["duration"]
+    for i in range(options["concurrency"]):
+        worker = Worker(Client(port, options["timeout"]), i, options)
+        samples: Dict[str, List[float]] = {}
+        statuses: Dict[str, List[int]] = {}
+        per_thread.append((samples, statuses))
+        thread = threading.Thread(target=run_worker,
+                                  args=(worker, PROFILES[name], measure_from, until, samples, statuses))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = max(time.perf_counter() - measure_from, 1e-9)
+
+    routes = {}
+    total = 0
+    for route in sorted({route for samples, _ in per_thread for route in samples}):
+        latencies = sorted(latency for samples, _ in per_thread for latency in samples.get(route, ()))
+        requests = sum(statuses[route][0] for _, statuses in per_thread if route in statuses)
+        errors = sum(statuses[route][1] for _, statuses in per_thread if route in statuses)
+        total += requests
+        routes[route] = {
+            "requests": requests,
+            "rps": round(requests / elapsed, 2),
+            "errors": errors,
+            "error_rate": round(errors / requests, 4) if requests else 0.0,
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        }
+    return {"seconds": round(elapsed, 3), "requests": total, "rps": round(total / elapsed, 2), "routes": routes}
+
+
+def limits_for(thresholds: Dict, profile: str, route: str) -> Dict:
+    """Merge the limits that apply to a route, most specific last"""
+    limits = {}
+    for profile_key, route_key in (("*", "*"), ("*", route), (profile, "*"), (profile, route)):
+        limits.update(thresholds.get(profile_key, {}).get(route_key, {}))
+    return limits
+
+
+def check_thresholds(results: Dict, thresholds: Dict) -> List[str]:
+    """Describe every route result that crosses its limits"""
+    failures = []
+    for profile, result in results["profiles"].items():
+        for route, metric in result["routes"].items():
+            limits = limits_for(thresholds, profile, route)
+            where = f"{profile} {route}"
+            for key in ("p50_ms", "p95_ms", "p99_ms"):
+                if key in limits and metric[key] > limits[key]:
+                    failures.append(f"{where}: {key[:-3]} {metric[key]}ms, limit {limits[key]}ms")
+            if "min_rps" in limits and metric["rps"] < limits["min_rps"]:
+                failures.append(f"{where}: {metric['rps']} req/s, limit {limits['min_rps']} req/s")
+            if "max_error_rate" in limits and metric["error_rate"] > limits["max_error_rate"]:
+                failures.append(f"{where}: error rate {metric['error_rate']:.2%}, limit {limits['max_error_rate']:.2%}")
+    return failures
+
+
+def print_report(results: Dict):
+    for profile, result in results["profiles"].items():
+        print(f"\n{profile}: {result['requests']:,} requests in {result['seconds']}s ({result['rps']} req/s)")
+        print(f"{'route':<34} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>8}")
+        for route, metric in result["routes"].items():
+            print(f"{route:<34} {metric['rps']:>9.1f} {metric['p50_ms']:>9} {metric['p95_ms']:>9} "
+                  f"{metric['p99_ms']:>9} {metric['errors']:>8}")
+
+
+def start_server(options: Dict):
+    """Start ``serve`` in a fresh process and return it with its port and control pipe"""
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe()
+    process = context.Process(target=serve, args=(options, sender))
+    process.start()
+    try:
+        status, payload = receiver.recv()
+    except EOFError:
+        status, payload = "error", f"server process exited with code {process.exitcode}"
+    if status != "ok":
+        process.join()
+        raise RuntimeError(f"Could not start the server: {payload}")
+    return process, payload, receiver
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Load test the Flask API and gate on latency thresholds")
+    parser.add_argument("--profile", choices=sorted(PROFILES), nargs="+", default=list(PROFILES),
+                        help="traffic profiles to run, in order")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent connections")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per profile")
+    parser.add_argument("--warmup", type=float, default=1.0, help="unmeasured seconds before each profile")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds before a request fails")
+    parser.add_argument("--users", type=int, default=DEFAULT_USERS, help="users seeded before the run")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--layout", choices=("objects", "columnar", "mmap"), default="objects",
+                        help="in-memory layout of the json backend")
+    parser.add_argument("--throttle", action="store_true", help="keep the configured login rate limits")
+    parser.add_argument("--thresholds", help="JSON file of latency, throughput and error limits")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    thresholds = {}
+    if args.thresholds:
+        with open(args.thresholds, "r", encoding="utf-8") as file:
+            thresholds = json.load(file)
+    options = {
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "warmup": args.warmup,
+        "timeout": args.timeout,
+        "users": args.users,
+        "backend": args.backend,
+        "layout": args.layout,
+        "throttle": args.throttle,
+    }
+    results = {
+        "created_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "options": options,
+        "profiles": {},
+    }
+
+    print(f"Starting the API with {args.users:,} users...")
+    process, port, control = start_server(options)
+    try:
+        for name in args.profile:
+            print(f"Running {name} with {args.concurrency} connections for {args.duration}s...")
+            results["profiles"][name] = run_profile(name, port, options)
+    finally:
+        control.send("stop")
+        process.join()
+
+    print_report(results)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=4)
+    print(f"\nResults written to {args.output}")
+
+    failures = check_thresholds(results, thresholds)
+    if failures:
+        print(f"\n{len(failures)} threshold(s) crossed:")
+        for line in failures:
+            print(f"  {line}")
+        return 1
+    if thresholds:
+        print(f"\nAll thresholds in {args.thresholds} met")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,216 @@
+import itertools
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO
+
+from passwords import PasswordHasher
+
+logger = logging.getLogger(__name__)
+
+# Bump when the stored user format changes
+FORMAT_VERSION = 2
+
+
+def marker_path(user_file: str) -> str:
+    return user_file + ".format"
+
+
+def has_format_marker(user_file: str) -> bool:
+    """True if ``user_file`` is known to be in the current format"""
+    try:
+        with open(marker_path(user_file), "r", encoding="utf-8") as file:
+            return file.read().strip() == str(FORMAT_VERSION)
+    except OSError:
+        return False
+
+
+def write_format_marker(user_file: str):
+    with open(marker_path(user_file), "w", encoding="utf-8") as file:
+        file.write(str(FORMAT_VERSION))
+
+
+def iter_json_array(stream: TextIO, chunk_size: int = 1 << 16) -> Iterator[Any]:
+    """Yield the elements of a top-level JSON array without reading it all.
+
+    Only the element being decoded is held in memory. An empty or
+    whitespace-only input yields nothing.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+
+    def fill() -> bool:
+        nonlocal buffer, pos, eof
+        if eof:
+            return False
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        return True
+
+    def peek() -> str:
+        """Skip whitespace and return the next character, or "" at the end"""
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if not fill():
+                return ""
+
+    first = peek()
+    if first == "":
+        return
+    if first != "[":
+        raise ValueError("Expected a JSON array")
+    pos += 1
+    if peek() == "]":
+        return
+    while True:
+        peek()
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Element is cut off at the end of the buffer; read more
+                if not fill():
+                    raise
+                continue
+            if end == len(buffer) and fill():
+                continue  # A number may continue in the next chunk
+            break
+        pos = end
+        yield item
+        separator = peek()
+        if separator == ",":
+            pos += 1
+        elif separator == "]":
+            return
+        else:
+            raise ValueError("Malformed JSON array")
+
+
+def first_element(path: str) -> Optional[Any]:
+    """The first element of the JSON array in ``path``, or None if it is empty"""
+    with open(path, "r", encoding="utf-8") as file:
+        return next(iter_json_array(file), None)
+
+
+class LegacyMigration:
+    """Converts a legacy users file (plain-text passwords) to the hashed format.
+
+    Users are read one at a time, hashed in parallel batches and appended to
+    ``<target>.migrating``. After every batch the output is synced and a
+    checkpoint records how far the run got, so an interrupted migration
+    resumes from the last finished batch instead of starting over.
+    """
+
+    def __init__(self, source: str, target: str, hasher: PasswordHasher, batch_size: int = 500,
+                 roles: Iterable[str] = ("admin", "user"), default_role: str = "user"):
+        self.source = source
+        self.target = target
+        self.hasher = hasher
+        self.batch_size = batch_size
+        self.roles = set(roles)
+        self.default_role = default_role
+        self.output_path = target + ".migrating"
+        self.checkpoint_path = target + ".migrate-checkpoint"
+
+    def _load_checkpoint(self) -> Optional[Dict]:
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as file:
+                checkpoint = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if (checkpoint.get("source") != self.source
+                or checkpoint.get("source_size") != os.path.getsize(self.source)
+                or not os.path.exists(self.output_path)):
+            return None
+        return checkpoint
+
+    def _save_checkpoint(self, checkpoint: Dict):
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(checkpoint, file)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _convert(self, batch: List[Dict]) -> List[Dict]:
+        """Hash a batch of legacy users, skipping (and reporting) bad records"""
+        valid = []
+        for user_data in batch:
+            try:
+                role = user_data.get("role", self.default_role)
+                if role not in self.roles:
+                    raise ValueError(f"Invalid role {role!r}")
+                valid.append((user_data["username"], user_data["password"], user_data["email"], role))
+            except (KeyError, ValueError, AttributeError) as e:
+                username = user_data.get("username") if isinstance(user_data, dict) else None
+                logger.warning("Error migrating user %s: %s", username, e)
+        hashes = self.hasher.hash_many(password for _, password, _, _ in valid)
+        now = datetime.now().isoformat()
+        return [
+            {"username": username, "password_hash": password_hash, "email": email, "role": role, "created_at": now}
+            for (username, _, email, role), password_hash in zip(valid, hashes)
+        ]
+
+    def run(self) -> Dict:
+        """Write the converted users to ``output_path`` and return run statistics"""
+        checkpoint = self._load_checkpoint()
+        if checkpoint:
+            logger.info("Resuming migration after %d users", checkpoint["items_done"])
+            out = open(self.output_path, "r+b")
+            out.truncate(checkpoint["output_bytes"])
+            out.seek(checkpoint["output_bytes"])
+        else:
+            checkpoint = {"source": self.source, "source_size": os.path.getsize(self.source),
+                          "items_done": 0, "written": 0, "output_bytes": 0}
+            out = open(self.output_path, "wb")
+            out.write(b"[")
+
+        started = time.perf_counter()
+        processed = 0
+        try:
+            with open(self.source, "r", encoding="utf-8") as src:
+                items = itertools.islice(iter_json_array(src), checkpoint["items_done"], None)
+                while True:
+                    batch = list(itertools.islice(items, self.batch_size))
+                    if not batch:
+                        break
+                    for record in self._convert(batch):
+                        separator = b",\n" if checkpoint["written"] else b"\n"
+                        out.write(separator + json.dumps(record).encode())
+                        checkpoint["written"] += 1
+                    out.flush()
+                    os.fsync(out.fileno())
+                    checkpoint["items_done"] += len(batch)
+                    checkpoint["output_bytes"] = out.tell()
+                    self._save_checkpoint(checkpoint)
+                    processed += len(batch)
+                    rate = processed / max(time.perf_counter() - started, 1e-9)
+                    logger.info("Migrated %d users (%.0f users/s)", checkpoint["items_done"], rate)
+            out.write(b"\n]\n")
+            out.flush()
+            os.fsync(out.fileno())
+        finally:
+            out.close()
+
+        elapsed = time.perf_counter() - started
+        return {
+            "processed": processed,
+            "written": checkpoint["written"],
+            "failed": checkpoint["items_done"] - checkpoint["written"],
+            "seconds": elapsed,
+            "users_per_second": processed / elapsed if elapsed else 0.0,
+        }
+
+    def discard(self):
+        """Remove the output and checkpoint files"""
+        for path in (self.output_path, self.checkpoint_path):
+            if os.path.exists(path):
+                os.remove(path)
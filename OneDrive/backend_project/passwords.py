@@ -0,0 +1,162 @@
+import hashlib
+import hmac
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Union
+
+from metrics import REGISTRY
+
+# Stored formats:
+#   scrypt$<n>$<r>$<p>$<salt hex>$<hash hex>
+#   pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>
+#   <salt hex>:<sha256 hex>  (legacy, verified but always rehashed)
+SCRYPT = "scrypt"
+PBKDF2_SHA256 = "pbkdf2_sha256"
+ALGORITHMS = (SCRYPT, PBKDF2_SHA256)
+
+
+def hash_password(password: str, algorithm: str, params: Dict[str, int]) -> str:
+    """Hash a password with a fresh salt and return the encoded string"""
+    salt = secrets.token_bytes(16)
+    if algorithm == SCRYPT:
+        n, r, p = params["n"], params["r"], params["p"]
+        digest = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=_scrypt_maxmem(n, r, p))
+        return f"{SCRYPT}${n}${r}${p}${salt.hex()}${digest.hex()}"
+    if algorithm == PBKDF2_SHA256:
+        iterations = params["iterations"]
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+        return f"{PBKDF2_SHA256}${iterations}${salt.hex()}${digest.hex()}"
+    raise ValueError(f"Unknown password hash algorithm: {algorithm}")
+
+
+def verify_password(password: str, encoded: str) -> bool:
+    """Check a password against any supported stored format"""
+    if not encoded:
+        return False
+    parts = encoded.split("$")
+    try:
+        if parts[0] == SCRYPT:
+            n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+            salt, expected = bytes.fromhex(parts[4]), bytes.fromhex(parts[5])
+            digest = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                                    maxmem=_scrypt_maxmem(n, r, p), dklen=len(expected))
+        elif parts[0] == PBKDF2_SHA256:
+            iterations = int(parts[1])
+            salt, expected = bytes.fromhex(parts[2]), bytes.fromhex(parts[3])
+            digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations, len(expected))
+        else:
+            salt, expected_hex = encoded.split(":")
+            expected = bytes.fromhex(expected_hex)
+            digest = hashlib.sha256((password + salt).encode()).digest()
+    except (ValueError, IndexError):
+        return False
+    return hmac.compare_digest(digest, expected)
+
+
+def needs_rehash(encoded: str, algorithm: str, params: Dict[str, int]) -> bool:
+    """True if the stored hash is legacy or uses other settings than configured"""
+    parts = encoded.split("$")
+    if parts[0] != algorithm:
+        return True
+    if algorithm == SCRYPT:
+        return [int(x) for x in parts[1:4]] != [params["n"], params["r"], params["p"]]
+    return int(parts[1]) != params["iterations"]
+
+
+def pack_hash(encoded: Optional[str]) -> Union[bytes, str, None]:
+    """Compact in-memory form of an encoded hash.
+
+    ``scrypt$16384$8$1$<salt hex>$<hash hex>`` becomes the parameter prefix,
+    a NUL, the salt length and the raw salt and digest bytes, about half the
+    size of the string. Anything that would not round-trip exactly (legacy
+    hashes, unusual hex) is kept as the original string.
+    """
+    if not encoded or "$" not in encoded:
+        return encoded
+    prefix, _, rest = encoded.rpartition("$")
+    prefix, _, salt_hex = prefix.rpartition("$")
+    try:
+        salt, digest = bytes.fromhex(salt_hex), bytes.fromhex(rest)
+    except ValueError:
+        return encoded
+    if salt.hex() != salt_hex or digest.hex() != rest or len(salt) > 255 or "\0" in prefix:
+        return encoded
+    return prefix.encode() + b"$\0" + bytes([len(salt)]) + salt + digest
+
+
+def unpack_hash(packed: Union[bytes, str, None]) -> Optional[str]:
+    """The encoded hash string for a value produced by ``pack_hash``"""
+    if not isinstance(packed, bytes):
+        return packed
+    split = packed.index(0)
+    salt_end = split + 2 + packed[split + 1]
+    return f"{packed[:split].decode()}{packed[split + 2:salt_end].hex()}${packed[salt_end:].hex()}"
+
+
+def _scrypt_maxmem(n: int, r: int, p: int) -> int:
+    # scrypt needs about 128 * n * r * p bytes; leave headroom over that
+    return 2 * 128 * n * r * p + 1024 * 1024
+
+
+HASH_SECONDS = REGISTRY.histogram("password_hash_seconds", "Time to hash one password, including queueing")
+VERIFY_SECONDS = REGISTRY.histogram("password_verify_seconds", "Time to verify one password, including queueing")
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords, optionally on a pool of worker processes.
+
+    Key derivation is deliberately CPU heavy. Running it in separate processes
+    lets it use every core and keeps it from holding up the request threads of
+    the calling process. ``max_pending`` bounds how much work can be queued so
+    a burst of logins cannot build an unbounded backlog.
+    """
+
+    def __init__(self, algorithm: str = SCRYPT, params: Optional[Dict[str, int]] = None,
+                 workers: int = 0, max_pending: Optional[int] = None):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown password hash algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.params = params or {}
+        self.workers = workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+        self._pending = threading.BoundedSemaphore(max_pending or max(workers, 1) * 4)
+
+    def _run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        with self._pending:
+            return self._get_pool().submit(fn, *args).result()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def hash(self, password: str) -> str:
+        with HASH_SECONDS.time():
+            return self._run(hash_password, password, self.algorithm, self.params)
+
+    def verify(self, password: str, encoded: str) -> bool:
+        with VERIFY_SECONDS.time():
+            return self._run(verify_password, password, encoded)
+
+    def needs_rehash(self, encoded: str) -> bool:
+        return needs_rehash(encoded, self.algorithm, self.params)
+
+    def hash_many(self, passwords: Iterable[str]) -> List[str]:
+        """Hash a batch of passwords, spread across the worker processes"""
+        passwords = list(passwords)
+        if self.workers <= 0 or len(passwords) < 2:
+            return [hash_password(p, self.algorithm, self.params) for p in passwords]
+        count = len(passwords)
+        return list(self._get_pool().map(hash_password, passwords, [self.algorithm] * count,
+                                         [self.params] * count, chunksize=max(1, count // (self.workers * 4))))
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
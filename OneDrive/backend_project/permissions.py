@@ -0,0 +1,139 @@
+"""Role based permissions compiled to bitsets.
+
+Each role's permission names are turned into one integer mask when the
+engine is built, so a check is ``mask & permission == permission``.
+``Authorizer`` resolves a caller's token to a ``Grant`` (username and mask)
+once and keeps it until the token expires or the user's role changes, so
+later requests with the same token skip the lookup entirely.
+"""
+import threading
+import time
+from collections import OrderedDict
+from enum import IntFlag
+from typing import Callable, Dict, Iterable, NamedTuple, Optional, Set, Tuple
+
+from metrics import REGISTRY
+
+DECISIONS = REGISTRY.counter("authorization_decisions_total", "Permission checks", ["permission", "result"])
+GRANT_LOOKUPS = REGISTRY.counter("authorization_grant_lookups_total", "Token to grant resolutions", ["result"])
+
+
+class Permission(IntFlag):
+    LIST_USERS = 1
+    MANAGE_USERS = 2
+    CHANGE_ROLES = 4
+    IMPORT_USERS = 8
+    VIEW_AUDIT = 16
+
+
+class PermissionEngine:
+    """Permission masks per role, compiled from ``{role: [permission names]}``"""
+
+    def __init__(self, role_permissions: Dict[str, Iterable[str]]):
+        self.masks: Dict[str, int] = {}
+        for role, names in role_permissions.items():
+            mask = 0
+            for name in names:
+                try:
+                    mask |= Permission[name.upper()]
+                except KeyError:
+                    raise ValueError(f"Unknown permission {name!r} for role {role!r}")
+            self.masks[role] = mask
+
+    def mask(self, role: str) -> int:
+        """The role's permissions; unknown roles have none"""
+        return self.masks.get(getattr(role, "value", role), 0)
+
+
+class Grant(NamedTuple):
+    username: str
+    mask: int
+    expires: float
+    # Access token claims, re-checked against revocations on every use
+    claims: Optional[Dict] = None
+
+    def allows(self, permission: Permission) -> bool:
+        return self.mask & permission == permission
+
+
+# Resolves a token to (username, role, expiry, claims or None), or None
+Identify = Callable[[str], Optional[Tuple[str, str, float, Optional[Dict]]]]
+
+
+class Authorizer:
+    """Cached token -> ``Grant`` resolution.
+
+    ``identify`` does the real work (verifying a signed token or looking up
+    a session and its user) and runs once per token. ``revoked(claims)``, if
+    given, is still asked on every use so logouts and revocations from other
+    workers take effect immediately. ``forget_user`` drops a user's grants
+    when their role changes or they are deleted.
+    """
+
+    def __init__(self, engine: PermissionEngine, identify: Identify,
+                 revoked: Optional[Callable[[Dict], bool]] = None, cache_size: int = 10_000):
+        self.engine = engine
+        self.identify = identify
+        self.revoked = revoked
+        self.cache_size = cache_size
+        self._grants: "OrderedDict[str, Grant]" = OrderedDict()
+        self._tokens_by_user: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def grant(self, token: Optional[str]) -> Optional[Grant]:
+        """The caller behind ``token``, or None if it is not valid"""
+        if not token:
+            return None
+        with self._lock:
+            grant = self._grants.get(token)
+            if grant is not None:
+                self._grants.move_to_end(token)
+        if grant is not None:
+            if grant.expires > time.time() and not (self.revoked and grant.claims and self.revoked(grant.claims)):
+                GRANT_LOOKUPS.inc(result="hit")
+                return grant
+            self.forget(token)
+            return None
+        GRANT_LOOKUPS.inc(result="miss")
+        identity = self.identify(token)
+        if identity is None:
+            return None
+        username, role, expires, claims = identity
+        grant = Grant(username, self.engine.mask(role), expires, claims)
+        with self._lock:
+            self._grants[token] = grant
+            self._tokens_by_user.setdefault(username, set()).add(token)
+            if len(self._grants) > self.cache_size:
+                evicted, old = self._grants.popitem(last=False)
+                self._unlink(old.username, evicted)
+        return grant
+
+    def allows(self, token: Optional[str], permission: Permission) -> bool:
+        grant = self.grant(token)
+        allowed = grant is not None and grant.allows(permission)
+        DECISIONS.inc(permission=permission.name.lower(), result="allow" if allowed else "deny")
+        return allowed
+
+    def forget_user(self, username: str):
+        with self._lock:
+            for token in self._tokens_by_user.pop(username, ()):
+                self._grants.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self._grants.clear()
+            self._tokens_by_user.clear()
+
+    def forget(self, token: str):
+        with self._lock:
+            grant = self._grants.pop(token, None)
+            if grant is not None:
+                self._unlink(grant.username, token)
+
+    def _unlink(self, username: str, token: str):
+        # Caller holds the lock
+        tokens = self._tokens_by_user.get(username)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[username]
@@ -0,0 +1,101 @@
+"""Case-insensitive username prefix index for autocomplete.
+
+Usernames are kept as ``(lowercased, username)`` pairs in one sorted list,
+so the matches for a prefix are a contiguous run found by binary search:
+a lookup costs O(log n) plus the matches it returns, however many users
+there are. Inserts and removals shift the list like ``sorted_usernames`` in
+the JSON backend does.
+"""
+import bisect
+import threading
+from typing import Callable, Iterable, List, Optional, Tuple
+
+
+def _insert(keys: List[Tuple[str, str]], username: str):
+    key = (username.lower(), username)
+    position = bisect.bisect_left(keys, key)
+    if position == len(keys) or keys[position] != key:
+        keys.insert(position, key)
+
+
+def _remove(keys: List[Tuple[str, str]], username: str):
+    key = (username.lower(), username)
+    position = bisect.bisect_left(keys, key)
+    if position < len(keys) and keys[position] == key:
+        del keys[position]
+
+
+class PrefixIndex:
+    """Sorted usernames, built from ``source`` on first use.
+
+    ``source`` returns every username. ``add`` and ``discard`` keep the
+    index current; ``invalidate`` drops it so the next search rebuilds it.
+    Changes made while a build is reading ``source`` are replayed on top of
+    the result.
+    """
+
+    def __init__(self, source: Callable[[], Iterable[str]]):
+        self._source = source
+        self._keys: Optional[List[Tuple[str, str]]] = None
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        # Changes seen during a build, or None when no build is running
+        self._pending: Optional[List[Tuple[bool, str]]] = None
+        self._stale_build = False
+
+    def add(self, username: str):
+        with self._lock:
+            if self._keys is not None:
+                _insert(self._keys, username)
+            if self._pending is not None:
+                self._pending.append((True, username))
+
+    def discard(self, username: str):
+        with self._lock:
+            if self._keys is not None:
+                _remove(self._keys, username)
+            if self._pending is not None:
+                self._pending.append((False, username))
+
+    def invalidate(self):
+        with self._lock:
+            self._keys = None
+            self._stale_build = self._pending is not None
+
+    def search(self, prefix: str, limit: int) -> List[str]:
+        """Up to ``limit`` usernames starting with ``prefix`` (any case), in order"""
+        prefix = prefix.lower()
+        while True:
+            with self._lock:
+                if self._keys is not None:
+                    keys = self._keys
+                    position = bisect.bisect_left(keys, (prefix,))
+                    matches = []
+                    while position < len(keys) and len(matches) < limit and keys[position][0].startswith(prefix):
+                        matches.append(keys[position][1])
+                        position += 1
+                    return matches
+            self._build()
+
+    def _build(self):
+        with self._build_lock:
+            with self._lock:
+                if self._keys is not None:
+                    return
+                self._pending = []
+                self._stale_build = False
+            # The source may take the storage backend's locks, so read it
+            # without holding ours
+            try:
+                keys = sorted((username.lower(), username) for username in self._source())
+            except BaseException:
+                with self._lock:
+                    self._pending = None
+                raise
+            with self._lock:
+                pending, self._pending = self._pending, None
+                if self._stale_build:
+                    return  # Invalidated mid-build; the caller builds again
+                for added, username in pending:
+                    (_insert if added else _remove)(keys, username)
+                self._keys = keys
@@ -0,0 +1,85 @@
+"""Pre-serialized listing responses, valid for one repository version.
+
+Every change to the users bumps ``UserRepository.version``. Listings are
+serialized once per version and query and served from here until the next
+change, so polling clients cost a dictionary lookup. ETags are a hash of
+the body rather than the version number, so they stay meaningful across
+restarts and when a change does not alter a particular listing.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Hashable, NamedTuple, Optional
+
+from metrics import REGISTRY
+
+LOOKUPS = REGISTRY.counter("response_cache_lookups_total", "Listing response cache lookups", ["endpoint", "result"])
+
+
+class CachedResponse(NamedTuple):
+    etag: str
+    body: bytes
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header value covers ``etag`` (weak comparison)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return any((tag[2:] if tag.startswith("W/") else tag) == etag for tag in candidates)
+
+
+class ResponseCache:
+    """Least recently used responses of the current version.
+
+    Bodies larger than ``max_bytes`` are served but never kept.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._version = None
+        self._entries: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _switch(self, version: int):
+        # Caller holds the lock
+        if version != self._version:
+            self._entries.clear()
+            self._bytes = 0
+            self._version = version
+
+    def get(self, version: int, key: Hashable) -> Optional[CachedResponse]:
+        with self._lock:
+            if version != self._version:
+                return None
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, version: int, key: Hashable, body: bytes) -> CachedResponse:
+        entry = CachedResponse(make_etag(body), body)
+        if self.max_entries <= 0 or len(body) > self.max_bytes:
+            return entry
+        with self._lock:
+            # A response built for an older version than the cache holds is stale
+            if self._version is not None and version < self._version:
+                return entry
+            self._switch(version)
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous.body)
+            self._entries[key] = entry
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.body)
+        return entry
@@ -0,0 +1,317 @@
+import base64
+import binascii
+import functools
+import json
+from typing import Any, Callable, Dict, Hashable, List, Mapping, Optional, TextIO, Tuple, Union
+
+from audit import EventStream
+from metrics import REGISTRY
+from permissions import Permission
+from response_cache import LOOKUPS, ResponseCache, etag_matches
+from throttle import retry_after_header
+from user_auth import Config, UserRepository, User, ValidationError
+from bulk_import import FORMATS, import_users
+
+# Handlers return (body, status) or (body, status, headers). The body is a
+# JSON-serializable value, already-encoded JSON bytes, the metrics page as
+# text, or an audit EventStream.
+Headers = List[Tuple[str, str]]
+Result = Union[Tuple[Any, int], Tuple[Any, int, Headers]]
+
+REQUESTS = REGISTRY.counter("http_requests_total", "HTTP requests handled", ["method", "route", "status"])
+REQUEST_SECONDS = REGISTRY.histogram("http_request_duration_seconds", "Time to handle an HTTP request",
+                                     ["method", "route"])
+USERS = REGISTRY.gauge("users", "Number of stored users")
+SESSIONS = REGISTRY.gauge("active_sessions", "Number of live refresh sessions")
+
+
+def record_request(method: str, route: str, status: int, seconds: float):
+    """Count a finished request; ``route`` is the route pattern, not the raw path"""
+    REQUESTS.inc(method=method, route=route, status=status)
+    REQUEST_SECONDS.observe(seconds, method=method, route=route)
+
+
+def user_summary(u: User) -> dict:
+    return {
+        "username": u.username,
+        "email": u.email,
+        "role": u.role.value,
+        "created_at": u.created_at
+    }
+
+
+def requires(permission: Permission, error: str = "Unauthorized operation"):
+    """Answer 403 unless the method's access token grants ``permission``.
+
+    Used on ``UserService`` methods taking the token as their first
+    argument, so both the Flask and ASGI routes are covered.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, token: Optional[str], *args, **kwargs) -> Result:
+            if not self.repo.access.allows(token, permission):
+                return {"error": error}, 403
+            return method(self, token, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def split_result(result: Result) -> Tuple[Any, int, Headers]:
+    body, status, *headers = result
+    return body, status, headers[0] if headers else []
+
+
+def client_address(peer: Optional[str], forwarded_for: Optional[str]) -> Optional[str]:
+    """The caller's address, from X-Forwarded-For if Config trusts it"""
+    if Config.TRUST_FORWARDED_FOR and forwarded_for:
+        return forwarded_for.split(",")[0].strip()
+    return peer
+
+
+def bearer_token(authorization: Optional[str]) -> Optional[str]:
+    auth = authorization or ""
+    return auth[len("Bearer "):] if auth.startswith("Bearer ") else None
+
+
+def encode_cursor(username: str) -> str:
+    return base64.urlsafe_b64encode(username.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[str]:
+    if not cursor:
+        return None
+    try:
+        username = base64.b64decode(cursor + "=" * (-len(cursor) % 4), altchars=b"-_", validate=True).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+    # Only accept what encode_cursor produces, so a mangled cursor is an error and not page 1
+    if encode_cursor(username) != cursor:
+        raise ValueError("Invalid cursor")
+    return username
+
+
+class UserService:
+    """The HTTP API's behaviour, independent of the web framework.
+
+    Both the Flask app (api.py) and the ASGI app (asgi_api.py) translate
+    requests into calls on this class, so the two servers cannot drift apart.
+    ``token`` arguments are the raw bearer token from the Authorization header.
+    """
+
+    def __init__(self, repo: UserRepository):
+        self.repo = repo
+        self.responses = ResponseCache(Config.RESPONSE_CACHE_ENTRIES, Config.RESPONSE_CACHE_BYTES)
+        USERS.set_function(repo.backend.count)
+        SESSIONS.set_function(repo.sessions.count)
+
+    @staticmethod
+    def metrics() -> str:
+        """Every metric of this process in the Prometheus text format"""
+        return REGISTRY.render()
+
+    def claims(self, token: Optional[str]) -> Optional[dict]:
+        """Claims of an access token, if it is valid"""
+        return self.repo.tokens.verify(token) if token else None
+
+    def actor(self, token: Optional[str]) -> Optional[str]:
+        """Username behind an access token, for the audit log"""
+        grant = self.repo.access.grant(token)
+        return grant.username if grant else None
+
+    def register(self, data: Dict) -> Result:
+        username = data.get("username")
+        password = data.get("password")
+        email = data.get("email")
+
+        if not all([username, password, email]):
+            error = "Missing fields"
+        elif not User.validate_password(password):
+            error = "Weak password"
+        elif not User.validate_email(email):
+            error = "Invalid email"
+        else:
+            error = None
+        if error:
+            self.repo.audit.record("register", username, "failure", reason=error)
+            return {"error": error}, 400
+
+        user = User(username, password, email)
+        success = self.repo.register(user)
+
+        if not success:
+            return {"error": "Username or email already exists"}, 409
+
+        return {"message": "User registered successfully"}, 201
+
+    @requires(Permission.MANAGE_USERS)
+    def delete_user(self, token: Optional[str], username: str) -> Result:
+        success = self.repo.delete_user(username, self.actor(token))
+        if success:
+            return {"message": "User deleted"}, 200
+        return {"error": "User not found"}, 404
+
+    @requires(Permission.MANAGE_USERS)
+    def update_user(self, token: Optional[str], username: str, data: Dict) -> Result:
+        email = data.get("email")
+        password = data.get("password")
+
+        try:
+            success = self.repo.update_user(username, email=email, password=password)
+        except ValidationError as e:
+            return {"error": str(e)}, 409
+        if success:
+            return {"message": "User updated"}, 200
+        return {"error": "User not found"}, 404
+
+    @requires(Permission.MANAGE_USERS)
+    def batch_users(self, token: Optional[str], data: Dict) -> Result:
+        """Apply many admin operations at once; nothing is changed unless all are valid"""
+        operations = data.get("operations")
+        if not isinstance(operations, list) or not operations:
+            return {"error": "Missing operations"}, 400
+        changes_roles = any(isinstance(op, dict) and op.get("op") == "change_role" for op in operations)
+        if changes_roles and not self.repo.access.allows(token, Permission.CHANGE_ROLES):
+            return {"error": "Unauthorized operation"}, 403
+        if len(operations) > Config.ADMIN_BATCH_MAX:
+            return {"error": f"At most {Config.ADMIN_BATCH_MAX} operations per batch"}, 413
+        try:
+            applied, results = self.repo.apply_batch(operations, self.actor(token))
+        except ValidationError as e:
+            return {"error": str(e)}, 409
+        return {"applied": applied, "results": results}, 200 if applied else 400
+
+    @requires(Permission.IMPORT_USERS)
+    def bulk_import(self, token: Optional[str], stream: TextIO, fmt: str) -> Result:
+        """Import many users from CSV or JSONL and report per-row errors"""
+        if fmt not in FORMATS:
+            return {"error": f"Unsupported format, use one of: {', '.join(FORMATS)}"}, 400
+        return import_users(self.repo, stream, fmt).to_dict(), 200
+
+    @staticmethod
+    def import_format(content_type: Optional[str], requested: Optional[str]) -> str:
+        """Pick the bulk import format from ?format= or the Content-Type"""
+        if requested:
+            return requested
+        return "csv" if "csv" in (content_type or "") else "jsonl"
+
+    def _cached(self, endpoint: str, key: Hashable, build: Callable[[], bytes],
+                if_none_match: Optional[str], cache_control: str) -> Result:
+        """Serve a listing from the response cache, or 304 if the client has it"""
+        version = self.repo.version
+        entry = self.responses.get(version, (endpoint, key))
+        if entry is None:
+            LOOKUPS.inc(endpoint=endpoint, result="miss")
+            entry = self.responses.put(version, (endpoint, key), build())
+        else:
+            LOOKUPS.inc(endpoint=endpoint, result="hit")
+        headers = [("ETag", entry.etag), ("Cache-Control", cache_control)]
+        if etag_matches(if_none_match, entry.etag):
+            return b"", 304, headers
+        return entry.body, 200, headers
+
+    def list_users(self, args: Mapping[str, str], if_none_match: Optional[str] = None) -> Result:
+        """One page of users in username order"""
+        return self._users_page("users", args, if_none_match, "no-cache")
+
+    def _users_page(self, endpoint: str, args: Mapping[str, str], if_none_match: Optional[str],
+                    cache_control: str) -> Result:
+        query = args.get("query", "").lower()
+        try:
+            limit = int(args.get("limit", Config.USERS_PAGE_SIZE))
+            after = decode_cursor(args.get("cursor"))
+        except ValueError:
+            return {"error": "Invalid limit or cursor"}, 400
+        limit = max(1, min(limit, Config.USERS_MAX_PAGE_SIZE))
+
+        def build() -> bytes:
+            users = (u for u in self.repo.iter_users(after) if query in u.username.lower())
+            chunks = ['{"users":[']
+            last = None
+            for count, user in enumerate(users):
+                if count == limit:
+                    break
+                chunks.append(("," if count else "") + json.dumps(user_summary(user)))
+                last = user
+            else:
+                last = None  # Ran out of users, this is the final page
+            next_cursor = encode_cursor(last.username) if last else None
+            chunks.append('],"next_cursor":' + json.dumps(next_cursor) + '}')
+            return "".join(chunks).encode()
+
+        return self._cached(endpoint, (query, limit, after), build, if_none_match, cache_control)
+
+    def search_users(self, args: Mapping[str, str]) -> Result:
+        """Usernames starting with ?prefix=, for autocomplete"""
+        prefix = args.get("prefix", "")
+        if not prefix:
+            return {"error": "Missing prefix"}, 400
+        try:
+            limit = int(args.get("limit", Config.USERS_SEARCH_LIMIT))
+        except ValueError:
+            return {"error": "Invalid limit"}, 400
+        limit = max(1, min(limit, Config.USERS_MAX_PAGE_SIZE))
+        return {"usernames": self.repo.search_usernames(prefix, limit)}, 200
+
+    def username_available(self, username: str) -> Result:
+        return {"username": username, "available": self.repo.is_username_available(username)}, 200
+
+    @requires(Permission.LIST_USERS, "Unauthorized")
+    def admin_users(self, token: Optional[str], args: Mapping[str, str],
+                    if_none_match: Optional[str] = None) -> Result:
+        """One page of users, like ``list_users`` but only for admins"""
+        return self._users_page("admin_users", args, if_none_match, "private, no-cache")
+
+    @requires(Permission.VIEW_AUDIT, "Unauthorized")
+    def audit_stream(self, token: Optional[str], args: Mapping[str, str],
+                     last_event_id: Optional[str] = None) -> Result:
+        """Recent and live audit events as Server-Sent Events, straight from memory.
+
+        The stream ends as soon as the token stops granting access.
+        """
+        try:
+            backlog = int(args.get("backlog", Config.AUDIT_STREAM_BACKLOG))
+        except ValueError:
+            return {"error": "Invalid backlog"}, 400
+        backlog = max(0, min(backlog, Config.AUDIT_BUFFER_SIZE))
+        events = EventStream(self.repo.audit, backlog, last_event_id,
+                             lambda: self.repo.access.allows(token, Permission.VIEW_AUDIT),
+                             Config.AUDIT_STREAM_HEARTBEAT)
+        return events, 200, [("Cache-Control", "no-cache"), ("X-Accel-Buffering", "no")]
+
+    def login(self, data: Dict, client: Optional[str] = None) -> Result:
+        username = data.get("username")
+        password = data.get("password")
+
+        retry_after = self.repo.throttle.check(username, client)
+        if retry_after:
+            self.repo.audit.record("login", username, "throttled", client=client)
+            return {"error": "Too many login attempts"}, 429, [retry_after_header(retry_after)]
+
+        user = self.repo.authenticate(username, password, client)
+        if user:
+            return {
+                "message": "Login successful",
+                "token": self.repo.tokens.issue(user.username, user.role.value),
+                "refresh_token": self.repo.sessions.create(user.username),
+                "username": user.username,
+                "email": user.email,
+                "role": user.role.value
+            }, 200
+
+        return {"error": "Invalid credentials"}, 401
+
+    def refresh_token(self, data: Dict) -> Result:
+        session = self.repo.sessions.get(data.get("refresh_token", ""))
+        user = self.repo.get_user(session["username"]) if session else None
+        if not user:
+            return {"error": "No valid session found"}, 401
+        return {"token": self.repo.tokens.issue(user.username, user.role.value)}, 200
+
+    def logout(self, token: Optional[str], data: Dict) -> Result:
+        claims = self.claims(token)
+        if claims:
+            self.repo.tokens.revoke(claims)
+        ended = data.get("refresh_token") and self.repo.sessions.delete(data["refresh_token"])
+        if claims or ended:
+            return {"message": "Logged out"}, 200
+        return {"error": "No valid session found"}, 401
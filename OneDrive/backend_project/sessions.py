@@ -0,0 +1,212 @@
+import heapq
+import secrets
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from storage import ConnectionPool
+
+
+class SessionStore(ABC):
+    """Login sessions keyed by an opaque token.
+
+    Sessions expire ``ttl`` seconds after they were last renewed. Using a
+    session renews it (sliding expiry) once more than half of its lifetime has
+    passed, so an active user stays logged in without a write on every
+    request. At most ``max_sessions`` are kept; beyond that the least recently
+    used session is evicted.
+    """
+
+    def __init__(self, ttl: float, max_sessions: int):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+
+    @staticmethod
+    def new_token() -> str:
+        return secrets.token_hex(32)
+
+    @abstractmethod
+    def create(self, username: str) -> str:
+        """Start a session and return its token"""
+
+    @abstractmethod
+    def get(self, token: str) -> Optional[Dict]:
+        """Return ``{"username", "expires"}`` for a live session, renewing it"""
+
+    @abstractmethod
+    def delete(self, token: str) -> Optional[str]:
+        """End a session, returning the username it belonged to"""
+
+    @abstractmethod
+    def purge_expired(self) -> int:
+        """Drop every expired session and return how many were removed"""
+
+    @abstractmethod
+    def count(self) -> int:
+        """Number of stored sessions"""
+
+    def _needs_renewal(self, expires: float, now: float) -> bool:
+        return expires - now < self.ttl / 2
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions kept in this process.
+
+    An expiry heap makes purging O(log n) per expired session; heap entries
+    left behind by renewals or eviction are skipped when popped. An ordered
+    dict tracks recency for LRU eviction.
+    """
+
+    def __init__(self, ttl: float, max_sessions: int):
+        super().__init__(ttl, max_sessions)
+        self._sessions: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._expiry_heap: List[Tuple[float, str]] = []
+        self._lock = threading.Lock()
+
+    def create(self, username: str) -> str:
+        token = self.new_token()
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            while len(self._sessions) >= self.max_sessions:
+                self._sessions.popitem(last=False)
+            self._store(token, username, now + self.ttl)
+        return token
+
+    def get(self, token: str) -> Optional[Dict]:
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            session = self._sessions.get(token)
+            if session is None:
+                return None
+            username, expires = session
+            if self._needs_renewal(expires, now):
+                expires = now + self.ttl
+                self._store(token, username, expires)
+            self._sessions.move_to_end(token)
+        return {"username": username, "expires": expires}
+
+    def delete(self, token: str) -> Optional[str]:
+        with self._lock:
+            session = self._sessions.pop(token, None)
+        return session[0] if session else None
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._purge(time.time())
+
+    def count(self) -> int:
+        return len(self._sessions)
+
+    def _store(self, token: str, username: str, expires: float):
+        self._sessions[token] = (username, expires)
+        heapq.heappush(self._expiry_heap, (expires, token))
+        if len(self._expiry_heap) > 2 * len(self._sessions) + 1024:
+            # Too many stale entries from renewals and evictions; rebuild
+            self._expiry_heap = [(exp, tok) for tok, (_, exp) in self._sessions.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def _purge(self, now: float) -> int:
+        removed = 0
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expires, token = heapq.heappop(heap)
+            session = self._sessions.get(token)
+            if session is not None and session[1] == expires:
+                del self._sessions[token]
+                removed += 1
+        return removed
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions kept in an SQLite database shared by every worker process.
+
+    Expired sessions are removed with a range delete on the indexed expiry
+    column, at most once every ``purge_interval`` seconds. Recency for
+    eviction is the time of the last renewal.
+    """
+
+    _SQL_SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS sessions (
+            token TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            expires REAL NOT NULL,
+            last_used REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)",
+        "CREATE INDEX IF NOT EXISTS sessions_last_used ON sessions (last_used)",
+        "CREATE INDEX IF NOT EXISTS sessions_username ON sessions (username)",
+        # COUNT(*) scans the table, so keep a running total for the size cap
+        "CREATE TABLE IF NOT EXISTS session_stats (id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER NOT NULL)",
+        "INSERT OR IGNORE INTO session_stats (id, total) SELECT 0, COUNT(*) FROM sessions",
+        """CREATE TRIGGER IF NOT EXISTS sessions_inserted AFTER INSERT ON sessions
+           BEGIN UPDATE session_stats SET total = total + 1 WHERE id = 0; END""",
+        """CREATE TRIGGER IF NOT EXISTS sessions_deleted AFTER DELETE ON sessions
+           BEGIN UPDATE session_stats SET total = total - 1 WHERE id = 0; END""",
+    )
+    _SQL_INSERT = "INSERT INTO sessions (token, username, expires, last_used) VALUES (?, ?, ?, ?)"
+    _SQL_GET = "SELECT username, expires FROM sessions WHERE token = ? AND expires > ?"
+    _SQL_RENEW = "UPDATE sessions SET expires = ?, last_used = ? WHERE token = ?"
+    _SQL_DELETE = "DELETE FROM sessions WHERE token = ? RETURNING username"
+    _SQL_PURGE = "DELETE FROM sessions WHERE expires <= ?"
+    _SQL_COUNT = "SELECT total FROM session_stats WHERE id = 0"
+    _SQL_EVICT = "DELETE FROM sessions WHERE token IN (SELECT token FROM sessions ORDER BY last_used LIMIT ?)"
+
+    def __init__(self, path: str, ttl: float, max_sessions: int, purge_interval: float = 30.0):
+        super().__init__(ttl, max_sessions)
+        self.pool = ConnectionPool(path)
+        self.purge_interval = purge_interval
+        self._last_purge = 0.0
+        conn = self.pool.connection()
+        with conn:
+            for statement in self._SQL_SCHEMA:
+                conn.execute(statement)
+
+    def create(self, username: str) -> str:
+        token = self.new_token()
+        now = time.time()
+        self._maybe_purge(now)
+        conn = self.pool.connection()
+        with conn:
+            excess = conn.execute(self._SQL_COUNT).fetchone()[0] - self.max_sessions + 1
+            if excess > 0:
+                conn.execute(self._SQL_EVICT, (excess,))
+            conn.execute(self._SQL_INSERT, (token, username, now + self.ttl, now))
+        return token
+
+    def get(self, token: str) -> Optional[Dict]:
+        now = time.time()
+        self._maybe_purge(now)
+        conn = self.pool.connection()
+        row = conn.execute(self._SQL_GET, (token, now)).fetchone()
+        if row is None:
+            return None
+        username, expires = row["username"], row["expires"]
+        if self._needs_renewal(expires, now):
+            expires = now + self.ttl
+            with conn:
+                conn.execute(self._SQL_RENEW, (expires, now, token))
+        return {"username": username, "expires": expires}
+
+    def delete(self, token: str) -> Optional[str]:
+        conn = self.pool.connection()
+        with conn:
+            row = conn.execute(self._SQL_DELETE, (token,)).fetchone()
+        return row["username"] if row else None
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        self._last_purge = now
+        conn = self.pool.connection()
+        with conn:
+            return conn.execute(self._SQL_PURGE, (now,)).rowcount
+
+    def count(self) -> int:
+        return self.pool.connection().execute(self._SQL_COUNT).fetchone()[0]
+
+    def _maybe_purge(self, now: float):
+        if now - self._last_purge >= self.purge_interval:
+            self.purge_expired()
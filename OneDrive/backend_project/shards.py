@@ -0,0 +1,190 @@
+"""Users spread over several JSON files by username hash.
+
+    python shards.py 8                          # split users.json into 8 shards
+    python shards.py 16 --file data/users.json
+    python shards.py 1                          # back to a single users.json
+
+A sharded store replaces ``users.json`` with N shard files, each a JSON
+array like the single file, and a small manifest naming them::
+
+    users.manifest.json    {"format": 1, "hash": "crc32", "generation": 2,
+                            "shards": ["users.2-000.json", "users.2-001.json", ...]}
+
+A user lives in shard ``crc32(username) % N``. The JSON backend parses the
+shards in parallel worker processes at startup and rewrites only the shards
+a change touched.
+
+Resharding writes a new generation of shard files and only then replaces
+the manifest, so a crash leaves either the old layout or the new one
+complete. Stop every server first. Journal records are left alone: they
+name users, not files, and apply to the new layout at the next start.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from migration import has_format_marker
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FORMAT = 1
+
+
+def manifest_path(path: str) -> str:
+    root, _ = os.path.splitext(path)
+    return f"{root}.manifest.json"
+
+
+def shard_path(path: str, generation: int, index: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}.{generation}-{index:03d}{ext or '.json'}"
+
+
+def shard_of(username: str, count: int) -> int:
+    """Index of the shard holding ``username`` in a store of ``count`` shards"""
+    return zlib.crc32(username.encode()) % count if count > 1 else 0
+
+
+def read_manifest(path: str) -> Optional[Tuple[int, List[str]]]:
+    """Generation and shard files of the sharded store at ``path``, or None if it is a single file"""
+    manifest = manifest_path(path)
+    if not os.path.exists(manifest):
+        return None
+    with open(manifest, "r", encoding="utf-8") as file:
+        data = json.load(file)
+    if data.get("format") != MANIFEST_FORMAT or data.get("hash") != "crc32" or not data.get("shards"):
+        raise ValueError(f"{manifest} is not a shard manifest this version understands")
+    directory = os.path.dirname(manifest)
+    return data["generation"], [os.path.join(directory, name) for name in data["shards"]]
+
+
+def write_records(path: str, data: List[Dict], sync: bool = False):
+    """Replace the JSON array at ``path`` atomically"""
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as file:
+        json.dump(data, file, indent=4)
+        if sync:
+            file.flush()
+            os.fsync(file.fileno())
+    os.replace(tmp_file, path)
+
+
+def _write_manifest(path: str, generation: int, files: List[str]):
+    manifest = manifest_path(path)
+    tmp_file = manifest + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as file:
+        json.dump({"format": MANIFEST_FORMAT, "hash": "crc32", "generation": generation,
+                   "shards": [os.path.basename(name) for name in files]}, file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_file, manifest)
+
+
+def open_layout(path: str, count: int) -> Tuple[List[str], bool]:
+    """The files of the store at ``path``, and whether it was just created.
+
+    An existing manifest or single file decides the layout; ``count``
+    shards are only used for a new store.
+    """
+    manifest = read_manifest(path)
+    if manifest is not None:
+        files = manifest[1]
+        if len(files) != count:
+            logger.info("%s has %d shards (configured: %d); run shards.py to change that",
+                        manifest_path(path), len(files), count)
+        return files, False
+    if os.path.exists(path):
+        if count > 1:
+            logger.info("%s is a single file (configured: %d shards); run shards.py to split it", path, count)
+        return [path], False
+
+    logger.info("File %s does not exist, creating new file", path)
+    if count <= 1:
+        write_records(path, [])
+        return [path], True
+    files = [shard_path(path, 1, index) for index in range(count)]
+    for name in files:
+        write_records(name, [])
+    _write_manifest(path, 1, files)
+    return files, True
+
+
+def read_shard(path: str) -> List:
+    with open(path, "r", encoding="utf-8") as file:
+        content = file.read().strip()
+    return json.loads(content) if content else []
+
+
+def read_shards(files: List[str], workers: int = 0) -> Iterator[List]:
+    """The records of each file, in order, parsed by up to ``workers`` processes.
+
+    Results arrive as soon as the next file is parsed, so the caller can
+    index one shard while the rest are still being read.
+    """
+    workers = min(workers, len(files))
+    if workers <= 1:
+        for name in files:
+            yield read_shard(name)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(read_shard, files)
+
+
+def reshard(path: str, count: int) -> int:
+    """Rewrite the store at ``path`` as ``count`` shards (1 for a single file).
+
+    Returns the number of users. Of duplicate usernames the last record is
+    kept, as a load would.
+    """
+    manifest = read_manifest(path)
+    generation, old_files = manifest if manifest else (0, [path] if os.path.exists(path) else [])
+    users: Dict[str, Dict] = {}
+    for records in read_shards(old_files):
+        for data in records:
+            if isinstance(data, dict) and "username" in data:
+                users[data["username"]] = data
+    buckets: List[List[Dict]] = [[] for _ in range(count)]
+    for username, data in users.items():
+        buckets[shard_of(username, count)].append(data)
+
+    if count == 1:
+        files = [path]
+        write_records(path, buckets[0], sync=True)
+        if manifest:
+            os.remove(manifest_path(path))
+    else:
+        files = [shard_path(path, generation + 1, index) for index in range(count)]
+        for name, records in zip(files, buckets):
+            write_records(name, records, sync=True)
+        _write_manifest(path, generation + 1, files)
+    for name in old_files:
+        if name not in files and os.path.exists(name):
+            os.remove(name)
+    return len(users)
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Split the users file into shards, or merge shards back")
+    parser.add_argument("shards", type=int, help="number of shard files; 1 keeps a single file")
+    parser.add_argument("--file", default="users.json", help="the users file (Config.USER_FILE)")
+    args = parser.parse_args(argv)
+    if args.shards < 1:
+        parser.error("the number of shards must be at least 1")
+
+    exists = os.path.exists(args.file) or read_manifest(args.file) is not None
+    if exists and not has_format_marker(args.file):
+        print(f"{args.file} has not been checked for legacy users; run 'python user_auth.py migrate' first")
+        return 1
+    count = reshard(args.file, args.shards)
+    layout = manifest_path(args.file) if args.shards > 1 else args.file
+    print(f"Wrote {count} users to {args.shards} shard(s), see {layout}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,407 @@
+"""Binary user snapshot with memory-mapped indexes, for fast cold starts.
+
+File layout (little endian)::
+
+    header     magic, count, size and mtime of the JSON file it mirrors,
+               and the offsets of the sections below
+    records    each user as compact JSON, in username order
+    names      username index: (record offset, record length,
+               name offset, name length) per user, sorted by username
+    emails     email index: (email offset, email length, position in the
+               username index) per user, sorted by normalized email
+    blobs      the username and normalized email bytes the indexes point at
+
+A process opens the file with mmap and binary searches the indexes, so
+start-up cost does not depend on the number of users and a user is only
+decoded when it is first asked for. ``SnapshotBackend`` serves the JSON
+backend's API from a snapshot plus an in-memory overlay of changes.
+"""
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from journal import UserJournal
+from metrics import REGISTRY
+from migration import iter_json_array
+from shards import manifest_path, read_manifest
+from storage import JsonFileBackend, LOAD_SECONDS, WRITE_SECONDS, normalize_email
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"USRSNAP1"
+_HEADER = struct.Struct("<8sQQQQQQQ")
+_NAME_ENTRY = struct.Struct("<QIQI")
+_EMAIL_ENTRY = struct.Struct("<QII")
+
+SNAPSHOT_LOOKUPS = REGISTRY.counter("snapshot_lookups_total", "Users decoded from the snapshot on first access")
+
+
+def source_signature(path: str) -> Tuple[int, int]:
+    """Size and modification time identifying a version of the JSON file"""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def write_snapshot(path: str, records: Iterable[Tuple[str, bytes]], source: Callable[[], Tuple[int, int]]):
+    """Write a snapshot atomically from ``(username, compact JSON)`` pairs.
+
+    ``records`` must be in username order. ``source`` is called once they
+    are all written and returns the ``source_signature`` of the JSON file
+    holding the same users.
+    """
+    # Workers starting together may each rebuild the snapshot
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    names: List[Tuple[int, int, bytes]] = []
+    emails: List[Tuple[bytes, int]] = []
+    with open(tmp_path, "wb") as file:
+        file.write(b"\0" * _HEADER.size)
+        offset = _HEADER.size
+        for username, record in records:
+            email = json.loads(record).get("email") or ""
+            emails.append((normalize_email(email).encode(), len(names)))
+            names.append((offset, len(record), username.encode()))
+            file.write(record)
+            offset += len(record)
+
+        emails.sort()
+        names_offset = offset
+        blob_offset = names_offset + len(names) * _NAME_ENTRY.size + len(emails) * _EMAIL_ENTRY.size
+        blob = bytearray()
+        for record_offset, record_length, name in names:
+            file.write(_NAME_ENTRY.pack(record_offset, record_length, blob_offset + len(blob), len(name)))
+            blob += name
+        emails_offset = names_offset + len(names) * _NAME_ENTRY.size
+        for email, position in emails:
+            file.write(_EMAIL_ENTRY.pack(blob_offset + len(blob), len(email), position))
+            blob += email
+        file.write(blob)
+
+        size, mtime = source()
+        file.seek(0)
+        file.write(_HEADER.pack(MAGIC, len(names), size, mtime,
+                                _HEADER.size, names_offset, emails_offset, blob_offset))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+class SnapshotIndex:
+    """Read-only, memory-mapped view of a snapshot file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.count, source_size, source_mtime, _, self._names,
+         self._emails, _) = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a user snapshot")
+        self.source = (source_size, source_mtime)
+
+    def _name_entry(self, position: int) -> Tuple[int, int, bytes]:
+        record_offset, record_length, name_offset, name_length = _NAME_ENTRY.unpack_from(
+            self._map, self._names + position * _NAME_ENTRY.size)
+        return record_offset, record_length, self._map[name_offset:name_offset + name_length]
+
+    def _email_entry(self, position: int) -> Tuple[bytes, int]:
+        email_offset, email_length, name_position = _EMAIL_ENTRY.unpack_from(
+            self._map, self._emails + position * _EMAIL_ENTRY.size)
+        return self._map[email_offset:email_offset + email_length], name_position
+
+    def _search(self, key: bytes, entry: Callable[[int], tuple], key_index: int) -> int:
+        """Position of the first entry whose key is >= ``key``"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if entry(middle)[key_index] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def record(self, position: int) -> Dict:
+        record_offset, record_length, _ = self._name_entry(position)
+        return json.loads(self._map[record_offset:record_offset + record_length])
+
+    def username(self, position: int) -> str:
+        return self._name_entry(position)[2].decode()
+
+    def raw_record(self, position: int) -> bytes:
+        record_offset, record_length, _ = self._name_entry(position)
+        return self._map[record_offset:record_offset + record_length]
+
+    def find(self, username: str) -> Optional[int]:
+        """Position of ``username`` in the username index, or None"""
+        key = username.encode()
+        position = self._search(key, self._name_entry, 2)
+        if position < self.count and self._name_entry(position)[2] == key:
+            return position
+        return None
+
+    def find_email(self, email: str) -> Optional[int]:
+        """Username index position of the user with this normalized email"""
+        key = normalize_email(email).encode()
+        position = self._search(key, self._email_entry, 0)
+        if position < self.count:
+            found, name_position = self._email_entry(position)
+            if found == key:
+                return name_position
+        return None
+
+    def usernames(self, after: Optional[str] = None) -> Iterator[Tuple[str, int]]:
+        """(username, position) pairs in username order, starting after ``after``"""
+        position = 0
+        if after is not None:
+            position = self._search(after.encode(), self._name_entry, 2)
+            if position < self.count and self._name_entry(position)[2] == after.encode():
+                position += 1
+        for position in range(position, self.count):
+            yield self._name_entry(position)[2].decode(), position
+
+
+class SnapshotBackend(JsonFileBackend):
+    """JSON file storage served lazily from a binary snapshot.
+
+    On start-up only the snapshot is mapped; users are decoded on first
+    access and cached. The inherited in-memory indexes hold only users
+    added or changed since the snapshot was written. ``deleted``
+    lists users removed since then; it may name users the snapshot never
+    had, because a snapshot being written can still contain them. Compaction
+    writes the JSON file and a new snapshot together.
+
+    If the snapshot is missing or was written for a different version of the
+    JSON file, it is rebuilt from the JSON file once. The snapshot mirrors a
+    single JSON file, so sharded stores are not supported.
+    """
+
+    def __init__(self, path: str, snapshot_path: str, user_factory: Callable[[Dict], Any],
+                 journal: Optional[UserJournal] = None):
+        super().__init__(path, user_factory, journal)
+        self.snapshot_path = snapshot_path
+        self.base: Optional[SnapshotIndex] = None
+        self.deleted: Set[str] = set()
+        self._count = 0
+        # Users decoded from the snapshot. Lookups fill it side by side under
+        # the read lock, so it is kept apart from the indexes and guarded by
+        # its own lock
+        self._decoded: Dict[str, Any] = {}
+        self._decode_lock = threading.Lock()
+
+    @LOAD_SECONDS.time(backend="snapshot")
+    def load(self) -> bool:
+        if read_manifest(self.path) is not None:
+            raise ValueError(f"{manifest_path(self.path)} describes a sharded store, which the mmap layout "
+                             "cannot serve; merge it with 'python shards.py 1' or use another layout")
+        with self.journal.loading() if self.journal else nullcontext():
+            created = not os.path.exists(self.path)
+            if created:
+                logger.info("File %s does not exist, creating new file", self.path)
+                with open(self.path, "w", encoding="utf-8") as file:
+                    json.dump([], file)
+            self.base = self._open_snapshot()
+            self._count = self.base.count
+            logger.info("Mapped %d users from %s", self.base.count, self.snapshot_path)
+            self._replay()
+        if self.journal:
+            self.journal.start(self._all_users, self._write_snapshot, self._changing, self.sync)
+        return created
+
+    def _open_snapshot(self) -> SnapshotIndex:
+        source = source_signature(self.path)
+        try:
+            index = SnapshotIndex(self.snapshot_path)
+            if index.source == source:
+                return index
+            logger.info("Snapshot %s is out of date, rebuilding it", self.snapshot_path)
+        except (OSError, ValueError, struct.error):
+            logger.info("No usable snapshot at %s, building it", self.snapshot_path)
+        with open(self.path, "r", encoding="utf-8") as file:
+            records = [(data["username"], json.dumps(data, separators=(",", ":")).encode())
+                       for data in iter_json_array(file)
+                       if isinstance(data, dict) and "username" in data]
+        records.sort(key=lambda item: item[0])
+        # Keep the last record of any duplicate username, like a full load would
+        unique = {username: record for username, record in records}
+        write_snapshot(self.snapshot_path, sorted(unique.items()), lambda: source)
+        return SnapshotIndex(self.snapshot_path)
+
+    def _from_base(self, username: str):
+        """Decode a snapshot user, or take it from the cache"""
+        if self.base is None or username in self.deleted:
+            return None
+        position = self.base.find(username)
+        if position is None:
+            return None
+        with self._decode_lock:
+            user = self._decoded.get(username)
+        if user is not None:
+            return user
+        SNAPSHOT_LOOKUPS.inc()
+        user = self.user_factory(self.base.record(position))
+        with self._decode_lock:
+            # Another thread may have got here first
+            return self._decoded.setdefault(username, user)
+
+    def _get(self, username: str):
+        with self.lock.read():
+            user = self.users_by_username.get(username)
+            if user is not None:
+                return user
+            return self._from_base(username)
+
+    def _get_by_email(self, email: str):
+        with self.lock.read():
+            user = self.users_by_email.get(normalize_email(email))
+            if user is not None:
+                return user
+            position = self.base.find_email(email) if self.base else None
+            if position is None:
+                return None
+            user = self._get(self.base.username(position))
+            # The snapshot may be stale for users changed since it was written
+            if user is not None and normalize_email(user.email) == normalize_email(email):
+                return user
+            return None
+
+    def users_with_role(self, role) -> List:
+        return [user for user in self.iter_users() if user.role == role]
+
+    def iter_users(self, after: Optional[str] = None) -> Iterator:
+        """Merge snapshot users with in-memory ones, without caching the scan"""
+        base = self.base.usernames(after) if self.base else iter(())
+        memory = super().iter_users(after)
+        base_next = next(base, None)
+        memory_next = next(memory, None)
+        while base_next is not None or memory_next is not None:
+            if memory_next is not None and (base_next is None or memory_next.username <= base_next[0]):
+                if base_next is not None and memory_next.username == base_next[0]:
+                    base_next = next(base, None)
+                yield memory_next
+                memory_next = next(memory, None)
+                continue
+            username, position = base_next
+            base_next = next(base, None)
+            if username in self.deleted:
+                continue
+            user = self.users_by_username.get(username)
+            yield user if user is not None else self.user_factory(self.base.record(position))
+
+    def iter_usernames(self) -> Iterator[str]:
+        base = (username for username, _ in self.base.usernames()) if self.base else iter(())
+        previous = None
+        for username in heapq.merge(base, super().iter_usernames()):
+            # A user changed since the snapshot is in both
+            if username != previous and (username not in self.deleted or username in self.users_by_username):
+                yield username
+            previous = username
+
+    def count(self) -> int:
+        return self._count
+
+    @WRITE_SECONDS.time(backend="snapshot", operation="add")
+    def add(self, user):
+        with self._changing():
+            self._check_new(user)
+            self.deleted.discard(user.username)
+            self._index_user(user)
+            self._count += 1
+            ticket = self._persist("register", user)
+        self._commit(ticket)
+
+    @WRITE_SECONDS.time(backend="snapshot", operation="add_many")
+    def add_many(self, users: List):
+        with self._changing():
+            order = self._check_new_many(users)
+            for user in users:
+                self.deleted.discard(user.username)
+                self._index_user(user, keep_sorted=False)
+            self.sorted_usernames = order
+            self._count += len(users)
+            ticket = self._persist_many(users)
+        self._commit(ticket)
+
+    @WRITE_SECONDS.time(backend="snapshot", operation="delete")
+    def delete(self, user):
+        with self._changing():
+            ticket = self._persist("delete", user)
+            self._remove_user(user)
+        self._commit(ticket)
+
+    def _remove_user(self, user):
+        self._unindex_user(user)
+        self.deleted.add(user.username)
+        self._count -= 1
+
+    def _index_record(self, record: Dict):
+        if record["op"] == "delete":
+            user = self._get(record["username"])
+            if user is not None:
+                self._unindex_user(user)
+                self.deleted.add(user.username)
+                self._count -= 1
+            return
+        user = self.user_factory(record["user"])
+        existing = self._get(user.username)
+        if existing is not None:
+            self._unindex_user(existing)
+        else:
+            self._count += 1
+        self.deleted.discard(user.username)
+        self._index_user(user)
+
+    def _all_users(self):
+        """A cheap point-in-time capture for the snapshot writer"""
+        return self.base, dict(self.users_by_username), set(self.deleted)
+
+    def _capture(self):
+        # The JSON file and snapshot are always rewritten whole
+        return self._all_users()
+
+    @WRITE_SECONDS.time(backend="snapshot", operation="snapshot")
+    def _write_snapshot(self, capture):
+        base, memory, deleted = capture
+
+        def records() -> Iterator[Tuple[str, bytes]]:
+            names = sorted(memory)
+            base_names = base.usernames() if base else iter(())
+            base_next = next(base_names, None)
+            for username in names + [None]:
+                while base_next is not None and (username is None or base_next[0] < username):
+                    if base_next[0] not in deleted:
+                        yield base_next[0], base.raw_record(base_next[1])
+                    base_next = next(base_names, None)
+                if username is None:
+                    break
+                if base_next is not None and base_next[0] == username:
+                    base_next = next(base_names, None)
+                yield username, json.dumps(memory[username].to_dict(), separators=(",", ":")).encode()
+
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, "wb") as json_file:
+            def tee() -> Iterator[Tuple[str, bytes]]:
+                """Write each record to the JSON file on its way to the snapshot"""
+                json_file.write(b"[")
+                for number, (username, record) in enumerate(records()):
+                    json_file.write((b",\n" if number else b"\n") + record)
+                    yield username, record
+                json_file.write(b"\n]\n")
+
+            def finish_json() -> Tuple[int, int]:
+                json_file.close()
+                os.replace(tmp_file, self.path)
+                return source_signature(self.path)
+
+            write_snapshot(self.snapshot_path, tee(), finish_json)
+        # Readers holding the old map keep using it; new lookups see the new one.
+        # Users deleted before the capture are not in it, so stop hiding them.
+        index = SnapshotIndex(self.snapshot_path)
+        with self.lock.write():
+            self.base = index
+            self.deleted -= deleted
+        logger.debug("Saved %d users to %s and %s", self.base.count, self.path, self.snapshot_path)
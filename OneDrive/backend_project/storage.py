@@ -0,0 +1,812 @@
+import bisect
+import heapq
+import logging
+import queue
+import sqlite3
+import threading
+import weakref
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from concurrency import GroupCommit, ReadWriteLock
+from journal import UserJournal
+from metrics import REGISTRY
+from migration import iter_json_array
+from shards import open_layout, read_shards, shard_of, write_records
+
+logger = logging.getLogger(__name__)
+
+LOAD_SECONDS = REGISTRY.histogram("storage_load_seconds", "Time to open the user store", ["backend"])
+WRITE_SECONDS = REGISTRY.histogram("storage_write_seconds", "Time spent persisting user changes",
+                                   ["backend", "operation"])
+
+
+class DuplicateUserError(Exception):
+    """Raised when a username or email is already taken"""
+    pass
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def encode_timestamp(value: Optional[str]) -> Union[int, str, None]:
+    """Store an ISO timestamp as integer microseconds since the epoch.
+
+    Timestamps are naive local times and stay that way: the integer counts
+    wall-clock time, so there is no timezone or DST conversion. Strings that
+    would not come back unchanged are kept as they are.
+    """
+    if not isinstance(value, str):
+        return value
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return value
+    if parsed.tzinfo is not None or parsed.isoformat() != value:
+        return value
+    delta = parsed - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def decode_timestamp(value: Union[int, str, None]) -> Optional[str]:
+    """The ISO string for a value produced by ``encode_timestamp``"""
+    if not isinstance(value, int):
+        return value
+    return (_EPOCH + timedelta(microseconds=value)).isoformat()
+
+
+class StorageBackend(ABC):
+    """Where UserRepository keeps its users.
+
+    Backends hand out ``User`` objects built by ``user_factory`` from a stored
+    record (the dict produced by ``User.to_dict``). Callers must not mutate
+    returned users directly; changes go through ``update`` so every index and
+    the persistent copy stay in sync.
+
+    ``on_remote_change(usernames)`` is called after changes made by another
+    worker process have been applied, with the usernames they touched, or
+    None if the whole store was reloaded.
+    """
+
+    on_remote_change: Optional[Callable[[Optional[Set[str]]], None]] = None
+
+    def __init__(self, user_factory: Callable[[Dict], Any]):
+        self.user_factory = user_factory
+
+    @abstractmethod
+    def load(self) -> bool:
+        """Open the storage. Returns True if it was newly created"""
+
+    @abstractmethod
+    def get(self, username: str):
+        """Return the user with this username, or None"""
+
+    @abstractmethod
+    def get_by_email(self, email: str):
+        """Return the user with this (case-insensitive) email, or None"""
+
+    @abstractmethod
+    def users_with_role(self, role) -> List:
+        """Return every user that has the given role"""
+
+    @abstractmethod
+    def iter_users(self, after: Optional[str] = None) -> Iterator:
+        """Iterate over users in username order, starting after ``after``"""
+
+    def iter_usernames(self) -> Iterator[str]:
+        """Every username, in username order"""
+        return (user.username for user in self.iter_users())
+
+    @abstractmethod
+    def count(self) -> int:
+        """Number of stored users"""
+
+    @abstractmethod
+    def add(self, user):
+        """Store a new user, raising DuplicateUserError if it clashes"""
+
+    def add_many(self, users: List):
+        """Store several new users with a single write where possible"""
+        for user in users:
+            self.add(user)
+
+    @abstractmethod
+    def update(self, user, changes: Dict):
+        """Apply attribute changes to a stored user and persist them"""
+
+    @abstractmethod
+    def delete(self, user):
+        """Remove a stored user"""
+
+    def apply_batch(self, changes: List[Tuple[str, str, Optional[Dict]]]):
+        """Apply ``("update", username, changes)`` and ``("delete", username, None)`` together.
+
+        Each username appears at most once. Backends that can apply the batch
+        atomically and with a single write do; raises DuplicateUserError if
+        an email would be taken twice and LookupError if a user is missing.
+        """
+        for op, username, fields in changes:
+            user = self.get(username)
+            if user is None:
+                raise LookupError(f"User {username} not found")
+            if op == "delete":
+                self.delete(user)
+            else:
+                self.update(user, fields)
+
+    def sync(self):
+        """Pick up changes other worker processes have made"""
+
+    def flush(self):
+        """Make sure everything written so far is in durable storage"""
+
+    def close(self):
+        """Release any resources held by the backend"""
+
+
+class JsonFileBackend(StorageBackend):
+    """All users in memory, persisted to a JSON file or to shards of one.
+
+    Lookups are served from dictionaries keyed by username, normalized email
+    and role. With a journal, each change is appended to the log and the JSON
+    files are rewritten only during compaction; without one, they are
+    rewritten after every burst of changes. Either way only the shards
+    holding changed users are written (see shards.py); an unsharded store is
+    a single shard.
+
+    Lookups share ``lock`` and changes take it exclusively, so a user is
+    never seen half-updated and uniqueness checks cannot race. Changes are
+    made durable after the lock is released: concurrent writers share one
+    journal write (or one file rewrite), and each call returns once its own
+    change is on disk.
+
+    Several worker processes can share one journal. Each change is made
+    under the journal's exclusive lock after catching up with what other
+    workers have logged, and a background thread applies their records as
+    they appear. A lookup that misses also catches up first, so a user
+    registered through another worker can log in straight away.
+    """
+
+    def __init__(self, path: str, user_factory: Callable[[Dict], Any], journal: Optional[UserJournal] = None,
+                 shards: int = 1, load_workers: int = 0):
+        super().__init__(user_factory)
+        self.path = path
+        self.journal = journal
+        # Shards for a new store; an existing one keeps its layout
+        self.shard_count = shards
+        self.load_workers = load_workers
+        self.files: List[str] = [path]
+        # Usernames per shard, only kept when there are several
+        self.shard_members: Optional[List[Set[str]]] = None
+        # Shards changed since they were last written
+        self._dirty: Set[int] = set()
+        self._dirty_lock = threading.Lock()
+        self.users_by_username: Dict[str, Any] = {}
+        self.users_by_email: Dict[str, Any] = {}
+        self.users_by_role: Dict[str, Set] = {}
+        # Sorted usernames give listings a stable order to resume from
+        self.sorted_usernames: List[str] = []
+        self.lock = ReadWriteLock()
+        self._saves = GroupCommit(self._save_batch, "json")
+
+    @LOAD_SECONDS.time(backend="json")
+    def load(self) -> bool:
+        try:
+            # Another worker must not compact between reading the file and the log
+            with self.journal.loading() if self.journal else nullcontext():
+                created = self._load_file()
+                self._replay()
+            if self.journal:
+                self.journal.start(self._capture, self._write_snapshot, self._changing, self.sync)
+            return created
+
+        except Exception as e:
+            logger.error("Error loading users: %s", e)
+            raise
+
+    def _load_file(self) -> bool:
+        logger.debug("Attempting to load users from %s", self.path)
+
+        self.files, created = open_layout(self.path, self.shard_count)
+        if len(self.files) > 1:
+            self.shard_members = [set() for _ in self.files]
+        if not created:
+            debug = logger.isEnabledFor(logging.DEBUG)
+            # Index each shard while the following ones are still being parsed
+            for users in read_shards(self.files, self.load_workers):
+                for user_data in users:
+                    try:
+                        user = self.user_factory(user_data)
+                        self._index_user(user, keep_sorted=False)
+                        if debug:
+                            logger.debug("Loaded user: %s", user.username)
+                    except Exception as e:
+                        logger.warning("Error loading user data: %s (%r)", e, user_data)
+            self.sorted_usernames.sort()
+            logger.info("Loaded %d users from %s", len(self.users_by_username),
+                        self.path if len(self.files) == 1 else f"{len(self.files)} shards of {self.path}")
+        return created
+
+    def _replay(self):
+        if not self.journal:
+            return
+        replayed = 0
+        for record in self.journal.replay():
+            self._apply_record(record)
+            replayed += 1
+        if replayed:
+            logger.info("Replayed %d journal records from %s", replayed, self.journal.path)
+
+    def get(self, username: str):
+        return self._find(self._get, username)
+
+    def get_by_email(self, email: str):
+        return self._find(self._get_by_email, email)
+
+    def _find(self, lookup: Callable[[str], Any], key: str):
+        user = lookup(key)
+        if user is None and self.journal and not self.lock.held() and self.journal.behind():
+            # Maybe another worker has just added it
+            self.sync()
+            user = lookup(key)
+        return user
+
+    def _get(self, username: str):
+        with self.lock.read():
+            return self.users_by_username.get(username)
+
+    def _get_by_email(self, email: str):
+        with self.lock.read():
+            return self.users_by_email.get(normalize_email(email))
+
+    def users_with_role(self, role) -> List:
+        with self.lock.read():
+            return list(self.users_by_role.get(role, ()))
+
+    def iter_users(self, after: Optional[str] = None) -> Iterator:
+        # Walk the sorted names in chunks, re-finding our place each time so
+        # concurrent inserts and deletes cannot make us skip or repeat users.
+        # The lock is only held while a chunk is collected, never across a yield.
+        chunk_size = 256
+        while True:
+            with self.lock.read():
+                if after is None:
+                    chunk = self.sorted_usernames[:chunk_size]
+                else:
+                    start = bisect.bisect_right(self.sorted_usernames, after)
+                    chunk = self.sorted_usernames[start:start + chunk_size]
+                users = [self.users_by_username.get(username) for username in chunk]
+            if not chunk:
+                return
+            for user in users:
+                if user is not None:
+                    yield user
+            after = chunk[-1]
+
+    def iter_usernames(self) -> Iterator[str]:
+        with self.lock.read():
+            return iter(list(self.sorted_usernames))
+
+    def count(self) -> int:
+        return len(self.users_by_username)
+
+    @WRITE_SECONDS.time(backend="json", operation="add")
+    def add(self, user):
+        with self._changing():
+            self._check_new(user)
+            self._index_user(user)
+            ticket = self._persist("register", user)
+        self._commit(ticket)
+
+    @WRITE_SECONDS.time(backend="json", operation="add_many")
+    def add_many(self, users: List):
+        with self._changing():
+            order = self._check_new_many(users)
+            for user in users:
+                self._index_user(user, keep_sorted=False)
+            self.sorted_usernames = order
+            ticket = self._persist_many(users)
+        self._commit(ticket)
+
+    @WRITE_SECONDS.time(backend="json", operation="update")
+    def update(self, user, changes: Dict):
+        with self._changing():
+            if "email" in changes:
+                owner = self.get_by_email(changes["email"])
+                if owner is not None and owner.username != user.username:
+                    raise DuplicateUserError("Email already registered")
+            self._unindex_user(user)
+            for field, value in changes.items():
+                setattr(user, field, value)
+            self._index_user(user)
+            ticket = self._persist("update", user)
+        self._commit(ticket)
+
+    @WRITE_SECONDS.time(backend="json", operation="delete")
+    def delete(self, user):
+        with self._changing():
+            ticket = self._persist("delete", user)
+            self._remove_user(user)
+        self._commit(ticket)
+
+    @WRITE_SECONDS.time(backend="json", operation="batch")
+    def apply_batch(self, changes: List[Tuple[str, str, Optional[Dict]]]):
+        with self._changing():
+            users = {}
+            for op, username, fields in changes:
+                users[username] = self.get(username)
+                if users[username] is None:
+                    raise LookupError(f"User {username} not found")
+            # Emails that stay with their current owner, then the new ones
+            released = {normalize_email(users[username].email) for op, username, fields in changes
+                        if op == "delete" or "email" in (fields or {})}
+            claimed = set()
+            for op, username, fields in changes:
+                if op == "delete" or "email" not in fields:
+                    continue
+                email_key = normalize_email(fields["email"])
+                owner = self.get_by_email(email_key)
+                taken = owner is not None and owner.username != username and email_key not in released
+                if taken or email_key in claimed:
+                    raise DuplicateUserError(f"Email already registered: {fields['email']}")
+                claimed.add(email_key)
+
+            records = []
+            for op, username, fields in changes:
+                self._touch(username)
+                if op == "delete":
+                    records.append({"op": "delete", "username": username})
+                    self._remove_user(users[username])
+            for op, username, fields in changes:
+                if op != "delete":
+                    user = users[username]
+                    self._unindex_user(user)
+                    for field, value in fields.items():
+                        setattr(user, field, value)
+                    self._index_user(user)
+                    records.append({"op": "update", "user": user.to_dict()})
+            ticket = self.journal.append_many(records) if self.journal else self._saves.submit("batch")
+        self._commit(ticket)
+
+    def sync(self):
+        if self.journal:
+            with self.lock.write():
+                self._catch_up()
+
+    @WRITE_SECONDS.time(backend="json", operation="flush")
+    def flush(self):
+        try:
+            if self.journal:
+                self.journal.compact()
+            else:
+                self._commit(self._saves.submit(None))
+        except Exception as e:
+            logger.error("Error saving to file: %s", e)
+            raise
+
+    @contextmanager
+    def _changing(self):
+        """Hold the data against every other writer, in this process and others, and catch up"""
+        with self.lock.write():
+            if not self.journal:
+                yield
+                return
+            with self.journal.exclusive():
+                self._catch_up()
+                yield
+
+    def _catch_up(self):
+        """Apply records other workers have logged; call with the write lock held"""
+        touched: Optional[Set[str]] = set()
+
+        def apply(record: Dict):
+            self._apply_record(record)
+            if touched is not None:
+                touched.add(record["username"] if record["op"] == "delete" else record["user"]["username"])
+
+        def resync(rotated: List[Dict]):
+            nonlocal touched
+            self._resync(rotated)
+            touched = None
+
+        if self.journal.follow(apply, resync) and self.on_remote_change:
+            self.on_remote_change(touched)
+
+    def _resync(self, rotated: List[Dict]):
+        """Rebuild from the JSON files after missing a whole journal generation.
+
+        Called with the write lock held; ``rotated`` are the records of the
+        log being compacted, if any, which the files may not include yet.
+        """
+        records = []
+        for name in self.files:
+            with open(name, "r", encoding="utf-8") as file:
+                records.extend({"op": "register", "user": data} for data in iter_json_array(file)
+                               if isinstance(data, dict) and "username" in data)
+        present = {record["user"]["username"] for record in records}
+        gone = [user.username for user in self.iter_users() if user.username not in present]
+        for username in gone:
+            self._apply_record({"op": "delete", "username": username})
+        for record in records + rotated:
+            self._apply_record(record)
+
+    def _remove_user(self, user):
+        """Drop a user from memory; call with the write lock held"""
+        self._unindex_user(user)
+
+    def _check_new(self, user):
+        """Raise DuplicateUserError if a new user clashes; call with the write lock held"""
+        if self.get(user.username) is not None:
+            raise DuplicateUserError("Username already exists")
+        if self.get_by_email(user.email) is not None:
+            raise DuplicateUserError("Email already registered")
+
+    def _check_new_many(self, users: List) -> List[str]:
+        """``_check_new`` for several users, also against each other.
+
+        Returns ``sorted_usernames`` with the new names merged in. Everything
+        that can fail is done here, before any index changes.
+        """
+        usernames = [user.username for user in users]
+        if len(set(usernames)) != len(usernames):
+            raise DuplicateUserError("Username already exists")
+        email_keys = {normalize_email(user.email) for user in users}
+        if len(email_keys) != len(users):
+            raise DuplicateUserError("Email already registered")
+        for user in users:
+            self._check_new(user)
+        return list(heapq.merge(self.sorted_usernames, sorted(usernames)))
+
+    def _all_users(self) -> List:
+        """Every stored user, as handed to snapshot writes"""
+        return list(self.users_by_username.values())
+
+    def _users_of(self, usernames: Set[str]) -> List:
+        """Like ``_all_users`` for some of the users"""
+        return [self.users_by_username[username] for username in usernames]
+
+    def _touch(self, username: str):
+        """Mark the shard holding ``username`` for the next write"""
+        with self._dirty_lock:
+            self._dirty.add(shard_of(username, len(self.files)))
+
+    def _capture(self) -> Dict[int, List]:
+        """Users of every shard changed since it was last written, by shard; call with the lock held"""
+        with self._dirty_lock:
+            shards, self._dirty = self._dirty, set()
+        if self.shard_members is None:
+            return {0: self._all_users()} if shards else {}
+        return {shard: self._users_of(self.shard_members[shard]) for shard in shards}
+
+    def _add_sorted(self, username: str, keep_sorted: bool = True):
+        if keep_sorted:
+            bisect.insort(self.sorted_usernames, username)
+        else:
+            self.sorted_usernames.append(username)
+        if self.shard_members is not None:
+            self.shard_members[shard_of(username, len(self.files))].add(username)
+
+    def _remove_sorted(self, username: str):
+        position = bisect.bisect_left(self.sorted_usernames, username)
+        if position < len(self.sorted_usernames) and self.sorted_usernames[position] == username:
+            del self.sorted_usernames[position]
+        if self.shard_members is not None:
+            self.shard_members[shard_of(username, len(self.files))].discard(username)
+
+    def _index_user(self, user, keep_sorted: bool = True):
+        """Add a user to every index"""
+        if user.username not in self.users_by_username:
+            self._add_sorted(user.username, keep_sorted)
+        self.users_by_username[user.username] = user
+        self.users_by_email[normalize_email(user.email)] = user
+        self.users_by_role.setdefault(user.role, set()).add(user)
+
+    def _unindex_user(self, user):
+        """Remove a user from every index"""
+        if self.users_by_username.pop(user.username, None) is not None:
+            self._remove_sorted(user.username)
+        email_key = normalize_email(user.email)
+        if self.users_by_email.get(email_key) is user:
+            del self.users_by_email[email_key]
+        self.users_by_role.get(user.role, set()).discard(user)
+
+    def _apply_record(self, record: Dict):
+        """Apply one journal record and mark its shard for the next write"""
+        self._touch(record["username"] if record["op"] == "delete" else record["user"]["username"])
+        self._index_record(record)
+
+    def _index_record(self, record: Dict):
+        """Apply one journal record to the in-memory indexes"""
+        if record["op"] == "delete":
+            user = self.users_by_username.get(record["username"])
+            if user:
+                self._unindex_user(user)
+            return
+        user = self.user_factory(record["user"])
+        existing = self.users_by_username.get(user.username)
+        if existing:
+            self._unindex_user(existing)
+        self._index_user(user)
+
+    def _persist(self, op: str, user):
+        """Queue a single mutation for the next write; call with the write lock held.
+
+        Returns a ticket for ``_commit``.
+        """
+        self._touch(user.username)
+        if not self.journal:
+            return self._saves.submit(op)
+        if op == "delete":
+            return self.journal.append(op, username=user.username)
+        return self.journal.append(op, user=user.to_dict())
+
+    def _persist_many(self, users: List):
+        """Like ``_persist`` for several new users, as one write"""
+        for user in users:
+            self._touch(user.username)
+        if not self.journal:
+            return self._saves.submit("register")
+        return self.journal.append_many([{"op": "register", "user": user.to_dict()} for user in users])
+
+    def _commit(self, ticket):
+        """Wait until the change behind ``ticket`` is durable"""
+        if self.journal:
+            self.journal.wait(ticket)
+        else:
+            self._saves.wait(ticket)
+
+    def _save_batch(self, changes: List):
+        # One rewrite of the changed shards covers every change queued before it
+        with self.lock.read():
+            capture = self._capture()
+        self._write_snapshot(capture)
+
+    @WRITE_SECONDS.time(backend="json", operation="snapshot")
+    def _write_snapshot(self, capture: Dict[int, List]):
+        """Write each captured shard to its file atomically"""
+        try:
+            for shard, users in capture.items():
+                data = self._records(users)
+                logger.debug("Saving %d users to %s", len(data), self.files[shard])
+                write_records(self.files[shard], data)
+        except BaseException:
+            # Keep them marked so the next write retries them
+            with self._dirty_lock:
+                self._dirty.update(capture)
+            raise
+
+    def _records(self, users: List) -> List[Dict]:
+        """Stored form of users captured by ``_capture``"""
+        return [user.to_dict() for user in users]
+
+
+class _Lease:
+    """Holds a pooled connection for the lifetime of one thread"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+
+class ConnectionPool:
+    """Per-thread SQLite connections.
+
+    Each thread gets its own connection on first use. When the thread exits,
+    its thread-local lease is collected and the connection goes back to the
+    idle queue for the next thread, so thread-per-request servers reuse a
+    small set of connections instead of reopening the database every time.
+    Beyond ``size`` idle connections, released ones are closed.
+    """
+
+    def __init__(self, path: str, size: int = 16, timeout: float = 10.0):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        lease = getattr(self._local, "lease", None)
+        if lease is None:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            lease = _Lease(conn)
+            weakref.finalize(lease, self._release, conn)
+            self._local.lease = lease
+        return lease.conn
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3 keeps a per-connection cache of prepared statements keyed by
+        # SQL text, so the constant queries below are only compiled once.
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, cached_statements=128)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _release(self, conn: sqlite3.Connection):
+        if self._idle.qsize() >= self.size:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+    def close(self):
+        self._local = threading.local()
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class SQLiteBackend(StorageBackend):
+    """Users stored in an SQLite database and fetched on demand.
+
+    Nothing is loaded up front; every lookup is a single indexed query, so
+    memory use does not grow with the number of users.
+    """
+
+    _COLUMNS = "username, password_hash, email, role, created_at"
+    _UPDATABLE = ("password_hash", "email", "role")
+
+    _SQL_SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password_hash TEXT NOT NULL,
+            email TEXT NOT NULL,
+            email_key TEXT NOT NULL,
+            role TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS users_email_key ON users (email_key)",
+        "CREATE INDEX IF NOT EXISTS users_role ON users (role)",
+    )
+    _SQL_GET = f"SELECT {_COLUMNS} FROM users WHERE username = ?"
+    _SQL_GET_BY_EMAIL = f"SELECT {_COLUMNS} FROM users WHERE email_key = ?"
+    _SQL_BY_ROLE = f"SELECT {_COLUMNS} FROM users WHERE role = ? ORDER BY username"
+    _SQL_ALL = f"SELECT {_COLUMNS} FROM users ORDER BY username"
+    _SQL_AFTER = f"SELECT {_COLUMNS} FROM users WHERE username > ? ORDER BY username"
+    _SQL_USERNAMES = "SELECT username FROM users ORDER BY username"
+    _SQL_COUNT = "SELECT COUNT(*) FROM users"
+    _SQL_INSERT = "INSERT INTO users (username, password_hash, email, email_key, role, created_at) VALUES (?, ?, ?, ?, ?, ?)"
+    _SQL_DELETE = "DELETE FROM users WHERE username = ?"
+
+    def __init__(self, path: str, user_factory: Callable[[Dict], Any], pool_size: int = 16):
+        super().__init__(user_factory)
+        self.path = path
+        self.pool = ConnectionPool(path, pool_size)
+
+    @LOAD_SECONDS.time(backend="sqlite")
+    def load(self) -> bool:
+        logger.debug("Opening user database %s", self.path)
+        conn = self.pool.connection()
+        with conn:
+            for statement in self._SQL_SCHEMA:
+                conn.execute(statement)
+        return self.count() == 0
+
+    def _row_to_user(self, row: Optional[sqlite3.Row]):
+        if row is None:
+            return None
+        return self.user_factory(dict(row))
+
+    def get(self, username: str):
+        return self._row_to_user(self.pool.connection().execute(self._SQL_GET, (username,)).fetchone())
+
+    def get_by_email(self, email: str):
+        row = self.pool.connection().execute(self._SQL_GET_BY_EMAIL, (normalize_email(email),)).fetchone()
+        return self._row_to_user(row)
+
+    def users_with_role(self, role) -> List:
+        rows = self.pool.connection().execute(self._SQL_BY_ROLE, (_value(role),))
+        return [self._row_to_user(row) for row in rows]
+
+    def iter_users(self, after: Optional[str] = None) -> Iterator:
+        if after is None:
+            rows = self.pool.connection().execute(self._SQL_ALL)
+        else:
+            rows = self.pool.connection().execute(self._SQL_AFTER, (after,))
+        for row in rows:
+            yield self._row_to_user(row)
+
+    def iter_usernames(self) -> Iterator[str]:
+        for (username,) in self.pool.connection().execute(self._SQL_USERNAMES):
+            yield username
+
+    def count(self) -> int:
+        return self.pool.connection().execute(self._SQL_COUNT).fetchone()[0]
+
+    @WRITE_SECONDS.time(backend="sqlite", operation="add")
+    def add(self, user):
+        data = user.to_dict()
+        conn = self.pool.connection()
+        try:
+            with conn:
+                conn.execute(self._SQL_INSERT, (
+                    data["username"], data["password_hash"], data["email"],
+                    normalize_email(data["email"]), _value(data["role"]), data["created_at"]
+                ))
+        except sqlite3.IntegrityError:
+            if self.get(user.username):
+                raise DuplicateUserError("Username already exists")
+            raise DuplicateUserError("Email already registered")
+
+    @WRITE_SECONDS.time(backend="sqlite", operation="add_many")
+    def add_many(self, users: List):
+        rows = []
+        for user in users:
+            data = user.to_dict()
+            rows.append((data["username"], data["password_hash"], data["email"],
+                         normalize_email(data["email"]), _value(data["role"]), data["created_at"]))
+        conn = self.pool.connection()
+        try:
+            with conn:
+                conn.executemany(self._SQL_INSERT, rows)
+        except sqlite3.IntegrityError:
+            raise DuplicateUserError("Username or email already exists")
+
+    @WRITE_SECONDS.time(backend="sqlite", operation="update")
+    def update(self, user, changes: Dict):
+        fields = [field for field in self._UPDATABLE if field in changes]
+        if not fields:
+            return
+        conn = self.pool.connection()
+        try:
+            with conn:
+                conn.execute(*self._update_statement(user.username, changes))
+        except sqlite3.IntegrityError:
+            raise DuplicateUserError("Email already registered")
+        for field in fields:
+            setattr(user, field, changes[field])
+
+    @WRITE_SECONDS.time(backend="sqlite", operation="batch")
+    def apply_batch(self, changes: List[Tuple[str, str, Optional[Dict]]]):
+        conn = self.pool.connection()
+        ordered = sorted(changes, key=lambda change: change[0] != "delete")
+        moving = [(f"\0{username}", username) for op, username, fields in ordered
+                  if op != "delete" and "email" in fields]
+        try:
+            with conn:
+                # Free every email being changed first, so swaps within the
+                # batch do not trip the unique index halfway through
+                conn.executemany("UPDATE users SET email_key = ? WHERE username = ?", moving)
+                for op, username, fields in ordered:
+                    if op == "delete":
+                        cursor = conn.execute(self._SQL_DELETE, (username,))
+                    else:
+                        cursor = conn.execute(*self._update_statement(username, fields))
+                    if cursor.rowcount == 0:
+                        raise LookupError(f"User {username} not found")
+        except sqlite3.IntegrityError:
+            raise DuplicateUserError("Email already registered")
+
+    def _update_statement(self, username: str, changes: Dict) -> Tuple[str, List]:
+        fields = [field for field in self._UPDATABLE if field in changes]
+        assignments = [f"{field} = ?" for field in fields]
+        params = [_value(changes[field]) for field in fields]
+        if "email" in changes:
+            assignments.append("email_key = ?")
+            params.append(normalize_email(changes["email"]))
+        params.append(username)
+        return f"UPDATE users SET {', '.join(assignments)} WHERE username = ?", params
+
+    @WRITE_SECONDS.time(backend="sqlite", operation="delete")
+    def delete(self, user):
+        conn = self.pool.connection()
+        with conn:
+            conn.execute(self._SQL_DELETE, (user.username,))
+
+    def close(self):
+        self.pool.close()
+
+
+def _value(role) -> str:
+    """Plain string value of a role enum or string"""
+    return getattr(role, "value", role)
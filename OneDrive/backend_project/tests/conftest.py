@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import user_auth  # noqa: E402
+from user_auth import Config, password_hasher  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def fast_hasher():
+    """Cheap hashes, computed in the test process"""
+    Config.HASH_WORKERS = 0
+    Config.SCRYPT_N = 2 ** 10
+    user_auth._password_hasher = None
+    yield
+    password_hasher().shutdown()
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Run each test in its own directory, with nothing shared between runs"""
+    monkeypatch.chdir(tmp_path)
+    # Absolute, so background threads of earlier tests keep to their own files
+    for name, file in [("USER_FILE", "users.json"), ("JOURNAL_FILE", "users.log"), ("SNAPSHOT_FILE", "users.snap"),
+                       ("SQLITE_FILE", "users.db"), ("SESSION_FILE", "sessions.db"),
+                       ("TOKEN_SECRET_FILE", "token_secret.key")]:
+        monkeypatch.setattr(Config, name, str(tmp_path / file))
+    monkeypatch.setattr(Config, "SESSION_BACKEND", "memory")
+    monkeypatch.setattr(Config, "AUDIT_FILE", None)
+    monkeypatch.setattr(Config, "BREACHED_PASSWORD_FILTER", str(tmp_path / "missing.bloom"))
+    return tmp_path
@@ -0,0 +1,119 @@
+import gzip
+import json
+import os
+import threading
+
+from audit import AuditLog, EventStream
+from service import UserService
+from user_auth import UserRepository
+
+
+def read_log(path):
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        return [json.loads(line) for line in file]
+
+
+def test_ring_buffer_overwrites_oldest():
+    log = AuditLog(None, capacity=3)
+    for n in range(5):
+        log.record("login", f"user{n}")
+    events, newest, dropped = log.since(0)
+    assert (newest, dropped) == (5, 2)
+    assert [event["username"] for event in events] == ["user2", "user3", "user4"]
+    assert log.since(4)[0][0]["id"] == f"{log.pid}-5"
+    assert log.since(5) == ([], 5, 0)
+
+
+def test_flush_writes_gzip_json_lines(tmp_path):
+    path = str(tmp_path / "audit.log.gz")
+    log = AuditLog(path, capacity=3)
+    log.record("login", "ann", client="10.0.0.1", reason=None)
+    log.flush()
+    for n in range(5):
+        log.record("register", f"user{n}")
+    log.flush()
+    events = read_log(path)
+    # Two events were overwritten before the second flush
+    assert [event["username"] for event in events] == ["ann", "user2", "user3", "user4"]
+    assert events[0]["client"] == "10.0.0.1" and "reason" not in events[0]
+    log.flush()
+    assert len(read_log(path)) == 4
+
+
+def test_rotation_at_size_limit(tmp_path):
+    path = str(tmp_path / "audit.log.gz")
+    log = AuditLog(path, max_bytes=200, backups=2)
+    for n in range(5):
+        log.record("login", f"user{n}", padding="x" * 50)
+        log.flush()
+    assert os.path.getsize(path) <= 200
+    assert [event["username"] for event in read_log(path)] == ["user4"]
+    assert [event["username"] for event in read_log(path + ".1")] == ["user3"]
+    assert [event["username"] for event in read_log(path + ".2")] == ["user2"]
+    assert not os.path.exists(path + ".3")
+
+
+def test_background_writer_flushes_on_close(tmp_path):
+    path = str(tmp_path / "audit.log.gz")
+    log = AuditLog(path, flush_interval=60)
+    log.start()
+    log.record("logout", "ann")
+    log.close()
+    assert [event["event"] for event in read_log(path)] == ["logout"]
+
+
+def test_stream_follows_new_events():
+    log = AuditLog(None, capacity=10)
+    log.record("login", "ann")
+    log.record("login", "ben")
+    stream = EventStream(log, backlog=1, last_event_id=None, authorized=lambda: True, heartbeat=5)
+    chunks = iter(stream)
+    assert next(chunks) == "retry: 3000\n\n"
+    assert next(chunks) == f'id: {log.pid}-2\nevent: login\ndata: {json.dumps(log.since(1)[0][0])}\n\n'
+
+    threading.Timer(0.05, log.record, ("delete", "cat")).start()
+    chunk = next(chunks)
+    assert chunk.startswith(f"id: {log.pid}-3\nevent: delete\n")
+    assert json.loads(chunk.split("data: ", 1)[1])["username"] == "cat"
+
+    threading.Timer(0.05, stream.close).start()
+    assert next(chunks, None) is None
+
+
+def test_stream_resumes_and_reports_gaps():
+    log = AuditLog(None, capacity=3)
+    for n in range(6):
+        log.record("login", f"user{n}")
+    stream = EventStream(log, backlog=0, last_event_id=f"{log.pid}-1", authorized=lambda: True, heartbeat=5)
+    chunks = iter(stream)
+    next(chunks)
+    chunk = next(chunks)
+    assert chunk.startswith('event: dropped\ndata: {"count": 2}\n\n')
+    assert chunk.count("event: login") == 3
+    stream.close()
+
+
+def test_stream_ends_without_access():
+    log = AuditLog(None)
+    allowed = [True]
+    stream = EventStream(log, backlog=0, last_event_id=None, authorized=lambda: allowed[0], heartbeat=0.01)
+    chunks = iter(stream)
+    next(chunks)
+    assert next(chunks) == ": keep-alive\n\n"
+    allowed[0] = False
+    assert next(chunks, None) is None
+
+
+def test_admin_stream_sees_logins():
+    service = UserService(UserRepository())
+    token = service.login({"username": "admin", "password": "Admin123!"})[0]["token"]
+    stream, status, headers = service.audit_stream(token, {"backlog": "0"})
+    assert status == 200 and ("Cache-Control", "no-cache") in headers
+    chunks = iter(stream)
+    next(chunks)
+    threading.Timer(0.05, service.login, ({"username": "admin", "password": "wrong"},)).start()
+    chunk = next(chunks)
+    event = json.loads(chunk.split("data: ", 1)[1])
+    assert (event["event"], event["outcome"], event["username"]) == ("login", "failure", "admin")
+    stream.close()
+    assert service.audit_stream(None, {})[1] == 403
@@ -0,0 +1,86 @@
+import pytest
+
+from storage import DuplicateUserError
+from user_auth import Config, User, UserRepository, UserRole, ValidationError
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def repo(request, monkeypatch):
+    monkeypatch.setattr(Config, "STORAGE_BACKEND", request.param)
+    monkeypatch.setattr(Config, "PERSISTENCE_MODE", "journal")
+    monkeypatch.setattr(Config, "MEMORY_LAYOUT", "objects")
+    repo = UserRepository()
+    for name in ("ann", "ben", "cat"):
+        assert repo.register(User(name, "Passw0rd!x", f"{name}@example.com"))
+    return repo
+
+
+def emails(repo):
+    return {name: repo.get_user(name).email for name in ("ann", "ben", "cat") if repo.get_user(name)}
+
+
+def test_email_handover(repo):
+    # ann comes first in the plan but takes the email ben gives up after her
+    applied, results = repo.apply_batch([
+        {"op": "reset_password", "username": "ann", "password": "N3wPassw0rd!"},
+        {"op": "update_email", "username": "ben", "email": "ben2@example.com"},
+        {"op": "update_email", "username": "ann", "email": "ben@example.com"},
+    ])
+    assert applied, results
+    assert emails(repo) == {"ann": "ben@example.com", "ben": "ben2@example.com", "cat": "cat@example.com"}
+    assert repo.get_user_by_email("ben@example.com").username == "ann"
+    assert repo.get_user("ann").verify_password("N3wPassw0rd!")
+
+
+def test_email_of_deleted_user_is_free(repo):
+    applied, results = repo.apply_batch([
+        {"op": "change_role", "username": "ann", "role": "admin"},
+        {"op": "delete", "username": "cat"},
+        {"op": "update_email", "username": "ann", "email": "cat@example.com"},
+        {"op": "update_email", "username": "ben", "email": "ann@example.com"},
+    ])
+    assert applied, results
+    assert emails(repo) == {"ann": "cat@example.com", "ben": "ann@example.com"}
+    assert repo.get_user("ann").role == UserRole.ADMIN
+
+
+def test_invalid_operation_changes_nothing(repo):
+    applied, results = repo.apply_batch([
+        {"op": "delete", "username": "ann"},
+        {"op": "change_role", "username": "ben", "role": "admin"},
+        {"op": "update_email", "username": "cat", "email": "ben@example.com"},
+    ])
+    assert not applied
+    assert [result["status"] for result in results] == ["skipped", "skipped", "failed"]
+    assert results[2]["error"] == "Email already registered"
+    assert repo.get_user("ann") is not None
+    assert repo.get_user("ben").role == UserRole.USER
+    assert emails(repo)["cat"] == "cat@example.com"
+
+
+def test_backend_rolls_back_on_error(repo):
+    ann = repo.get_user("ann")
+    with pytest.raises(LookupError):
+        repo.backend.apply_batch([("delete", "ben", None),
+                                  ("update", "ann", {"email": "new@example.com"}),
+                                  ("update", "ghost", {"role": UserRole.ADMIN})])
+    with pytest.raises(DuplicateUserError):
+        repo.backend.apply_batch([("update", "ann", {"email": "cat@example.com"})])
+    assert repo.get_user("ben") is not None
+    assert repo.get_user("ann").email == ann.email == "ann@example.com"
+    assert repo.get_user_by_email("new@example.com") is None
+
+
+def test_concurrent_change_is_a_validation_error(repo, monkeypatch):
+    # Another worker deletes the user between the checks and the write
+    real_apply = repo.backend.apply_batch
+
+    def racing_apply(changes):
+        repo.backend.delete(repo.backend.get("ben"))
+        real_apply(changes)
+
+    monkeypatch.setattr(repo.backend, "apply_batch", racing_apply)
+    with pytest.raises(ValidationError):
+        repo.apply_batch([{"op": "change_role", "username": "ben", "role": "admin"},
+                          {"op": "delete", "username": "ann"}])
+    assert repo.get_user("ann") is not None
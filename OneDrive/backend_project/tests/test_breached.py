@@ -0,0 +1,62 @@
+import hashlib
+
+import pytest
+
+import user_auth
+from breached import BreachedPasswords, build_filter, corpus_digests, main, open_filter
+from service import UserService
+from user_auth import Config, User, UserRepository
+
+BREACHED = ["Summer2024!", "Passw0rd!", "Welcome123"]
+
+
+@pytest.fixture
+def filter_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "breached.bloom")
+    build_filter(path, corpus_digests(BREACHED, plaintext=True), len(BREACHED))
+    monkeypatch.setattr(Config, "BREACHED_PASSWORD_FILTER", path)
+    monkeypatch.setattr(user_auth, "_breached_passwords", None)
+    monkeypatch.setattr(user_auth, "_breached_loaded", False)
+    return path
+
+
+def test_filter_lookup(filter_path):
+    breached = BreachedPasswords(filter_path)
+    assert breached.count == len(BREACHED)
+    assert all(password in breached for password in BREACHED)
+    assert "Correct-Horse-Battery-9" not in breached
+
+
+def test_corpus_formats():
+    digest = hashlib.sha1(b"Summer2024!").digest()
+    lines = [digest.hex().upper() + ":42\n", "not hex\n", "abcd\n", "\n"]
+    assert list(corpus_digests(lines)) == [digest]
+    assert list(corpus_digests(["Summer2024!\r\n", "\n"], plaintext=True)) == [digest]
+
+
+def test_unusable_filter_is_ignored(tmp_path):
+    assert open_filter(str(tmp_path / "missing.bloom")) is None
+    garbage = tmp_path / "garbage.bloom"
+    garbage.write_bytes(b"x" * 64)
+    assert open_filter(str(garbage)) is None
+
+
+def test_breached_password_rejected_at_register(filter_path):
+    service = UserService(UserRepository())
+    body, status = service.register({"username": "ann", "password": "Summer2024!", "email": "ann@example.com"})
+    assert (body, status) == ({"error": "Weak password"}, 400)
+    assert service.repo.get_user("ann") is None
+    assert not User.validate_password("Welcome123")
+
+
+def test_normal_password_passes(filter_path):
+    service = UserService(UserRepository())
+    status = service.register({"username": "ann", "password": "Correct-Horse-9", "email": "ann@example.com"})[1]
+    assert status == 201
+    assert service.repo.get_user("ann").verify_password("Correct-Horse-9")
+
+
+def test_check_command(filter_path, capsys):
+    assert main(["check", "-f", filter_path, "Correct-Horse-9"]) == 0
+    assert main(["check", "-f", filter_path, "Passw0rd!", "Correct-Horse-9"]) == 1
+    assert capsys.readouterr().out.splitlines()[-2:] == ["Passw0rd!: breached", "Correct-Horse-9: not found"]
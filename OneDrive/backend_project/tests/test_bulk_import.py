@@ -0,0 +1,145 @@
+import asyncio
+import io
+import json
+
+import pytest
+
+from bulk_import import import_users
+from service import UserService
+from storage import DuplicateUserError
+from user_auth import Config, User, UserRepository, UserRole
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def repo(request, monkeypatch):
+    monkeypatch.setattr(Config, "STORAGE_BACKEND", request.param)
+    monkeypatch.setattr(Config, "PERSISTENCE_MODE", "journal")
+    monkeypatch.setattr(Config, "MEMORY_LAYOUT", "objects")
+    repo = UserRepository()
+    assert repo.register(User("ann", "Passw0rd!x", "ann@example.com"))
+    return repo
+
+
+def jsonl(*rows) -> io.StringIO:
+    return io.StringIO("".join((row if isinstance(row, str) else json.dumps(row)) + "\n" for row in rows))
+
+
+def test_valid_rows(repo):
+    stream = io.StringIO("username,password,email,role\n"
+                         "ben,Passw0rd!x,ben@example.com,\n"
+                         "cat,Passw0rd!y,Cat@Example.com,admin\n")
+    report = import_users(repo, stream, "csv").to_dict()
+    assert (report["imported"], report["failed"], report["errors"]) == (2, 0, [])
+    assert repo.get_user("ben").verify_password("Passw0rd!x")
+    assert repo.get_user("ben").role == UserRole.USER
+    assert repo.get_user("cat").role == UserRole.ADMIN
+    assert repo.get_user_by_email("cat@example.com").username == "cat"
+    assert repo.search_usernames("c", 10) == ["cat"]
+
+
+def test_duplicates(repo):
+    report = import_users(repo, jsonl(
+        {"username": "ben", "password": "Passw0rd!x", "email": "ben@example.com"},
+        {"username": "ben", "password": "Passw0rd!x", "email": "ben2@example.com"},
+        {"username": "bea", "password": "Passw0rd!x", "email": "BEN@example.com"},
+        {"username": "ann", "password": "Passw0rd!x", "email": "ann2@example.com"},
+        {"username": "al", "password": "Passw0rd!x", "email": "Ann@Example.com"},
+    ), "jsonl").to_dict()
+    assert report["imported"] == 1
+    assert [(error["row"], error["error"]) for error in report["errors"]] == [
+        (2, "Username already exists"),
+        (3, "Email already registered"),
+        (4, "Username already exists"),
+        (5, "Email already registered"),
+    ]
+    assert repo.get_user("ben").email == "ben@example.com"
+    assert repo.get_user("bea") is None and repo.get_user("al") is None
+
+
+def test_invalid_rows(repo):
+    report = import_users(repo, jsonl(
+        {"username": "ben", "password": "Passw0rd!x"},
+        {"username": "ben", "password": 12345678, "email": "ben@example.com"},
+        {"username": 123, "password": "Passw0rd!x", "email": "n@example.com"},
+        {"username": "ben", "password": "Passw0rd!x", "email": ["ben@example.com"]},
+        {"username": "ben", "password": "Passw0rd!x", "email": "ben@example.com", "role": 1},
+        {"username": "ben", "password": "Passw0rd!x", "email": "ben@example.com", "role": "root"},
+        {"username": "ben", "password": "Passw0rd!x", "email": "not-an-email"},
+        {"username": "ben", "password": "password", "email": "ben@example.com"},
+        "{not json",
+        "[1, 2]",
+        {"username": "ben", "password": "Passw0rd!x", "email": "ben@example.com"},
+    ), "jsonl").to_dict()
+    assert [(error["row"], error["error"]) for error in report["errors"]] == [
+        (1, "Missing fields"),
+        (2, "Fields must be strings"),
+        (3, "Fields must be strings"),
+        (4, "Fields must be strings"),
+        (5, "Fields must be strings"),
+        (6, "Invalid role"),
+        (7, "Invalid email"),
+        (8, "Weak password"),
+        (9, "Invalid JSON"),
+        (10, "Row is not an object"),
+    ]
+    assert (report["imported"], report["failed"]) == (1, 10)
+    assert sorted(user.username for user in repo.backend.iter_users()) == ["admin", "ann", "ben"]
+
+
+def test_failed_add_many_leaves_indexes_alone(repo):
+    backend = repo.backend
+    for users in ([User("ben", "Passw0rd!x", "ben@example.com"), User("ben", "Passw0rd!x", "ben2@example.com")],
+                  [User("ben", "Passw0rd!x", "ben@example.com"), User("bea", "Passw0rd!x", "BEN@example.com")],
+                  [User("ben", "Passw0rd!x", "ben@example.com"), User("cat", "Passw0rd!x", "ann@example.com")]):
+        with pytest.raises(DuplicateUserError):
+            backend.add_many(users)
+    if Config.STORAGE_BACKEND == "json":
+        # A name that cannot be sorted with the others fails while building the index
+        odd = User("ben", "Passw0rd!x", "ben@example.com")
+        odd.username = 123
+        with pytest.raises(TypeError):
+            backend.add_many([User("bea", "Passw0rd!x", "bea@example.com"), odd])
+
+    assert [user.username for user in backend.iter_users()] == ["admin", "ann"]
+    assert backend.get("ben") is None and backend.get("bea") is None
+    assert backend.get_by_email("ben@example.com") is None
+    body, status = UserService(repo).list_users({})[:2]
+    assert status == 200
+    assert [user["username"] for user in json.loads(body)["users"]] == ["admin", "ann"]
+
+
+def test_asgi_upload_is_read_as_it_arrives(repo, monkeypatch):
+    import asgi_api
+    monkeypatch.setattr(asgi_api, "service", UserService(repo))
+    token = asgi_api.service.login({"username": "admin", "password": "Admin123!"})[0]["token"]
+    checked = []
+    get_user = repo.get_user
+    monkeypatch.setattr(repo, "get_user", lambda username: checked.append(username) or get_user(username))
+
+    rows = "".join(json.dumps({"username": f"zoë{n}", "password": "Passw0rd!x", "email": f"z{n}@example.com"},
+                              ensure_ascii=False) + "\n" for n in range(3)).encode()
+    # Split inside a line and inside the two bytes of "ë"
+    cut = rows.index("ë".encode()) + 1
+    chunks = [rows[:cut], rows[cut:len(rows) // 2], rows[len(rows) // 2:]]
+    messages = []
+
+    async def receive():
+        if len(messages) == len(chunks) - 1:
+            # The first line is complete, and already checked, before the rest arrives
+            assert checked == ["zoë0"]
+        body = chunks[len(messages)]
+        messages.append(body)
+        return {"type": "http.request", "body": body, "more_body": len(messages) < len(chunks)}
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/users/bulk", "query_string": b"",
+             "headers": [(b"authorization", f"Bearer {token}".encode())]}
+    asyncio.run(asgi_api.app(scope, receive, send))
+    assert sent[0]["status"] == 200
+    report = json.loads(sent[1]["body"])
+    assert (report["imported"], report["failed"]) == (3, 0)
+    assert repo.get_user("zoë2").email == "z2@example.com"
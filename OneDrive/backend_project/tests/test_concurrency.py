@@ -0,0 +1,116 @@
+import threading
+import time
+
+import pytest
+
+from concurrency import GroupCommit, ReadWriteLock
+
+
+def run_all(targets):
+    threads = [threading.Thread(target=target) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert not any(thread.is_alive() for thread in threads)
+
+
+def test_readers_share_and_writers_exclude():
+    lock = ReadWriteLock()
+    state = {"readers": 0, "most_readers": 0, "writing": False}
+    guard = threading.Lock()
+    errors = []
+
+    def reader():
+        for _ in range(50):
+            with lock.read():
+                with guard:
+                    if state["writing"]:
+                        errors.append("read during write")
+                    state["readers"] += 1
+                    state["most_readers"] = max(state["most_readers"], state["readers"])
+                time.sleep(0.0005)
+                with guard:
+                    state["readers"] -= 1
+
+    def writer():
+        for _ in range(20):
+            with lock.write():
+                with guard:
+                    if state["readers"] or state["writing"]:
+                        errors.append("write not exclusive")
+                    state["writing"] = True
+                time.sleep(0.0005)
+                with guard:
+                    state["writing"] = False
+
+    run_all([reader] * 4 + [writer] * 2)
+    assert errors == []
+    assert state["most_readers"] > 1
+
+
+def test_reentry():
+    lock = ReadWriteLock()
+    with lock.write():
+        with lock.write():
+            with lock.read():
+                assert lock.held()
+    with lock.read():
+        with lock.read():
+            assert lock.held()
+    assert not lock.held()
+
+    def write():
+        with lock.write():
+            pass
+
+    # Fully released, so another thread can write
+    run_all([write])
+
+
+def test_waiting_writer_holds_back_new_readers():
+    lock = ReadWriteLock()
+    order = []
+    lock.acquire_read()
+    writer = threading.Thread(target=lambda: (lock.acquire_write(), order.append("write"), lock.release_write()))
+    writer.start()
+    while not lock._writers_waiting:
+        time.sleep(0.001)
+    reader = threading.Thread(target=lambda: (lock.acquire_read(), order.append("read"), lock.release_read()))
+    reader.start()
+    time.sleep(0.05)
+    assert order == []
+    lock.release_read()
+    writer.join(5)
+    reader.join(5)
+    assert order == ["write", "read"]
+
+
+def test_group_commit_batches_concurrent_writes():
+    batches = []
+
+    def write(items):
+        time.sleep(0.01)
+        batches.append(list(items))
+
+    commits = GroupCommit(write, "test")
+
+    def writer(number):
+        return lambda: commits.wait(commits.submit(number))
+
+    run_all([writer(number) for number in range(20)])
+    assert sorted(item for batch in batches for item in batch) == list(range(20))
+    assert len(batches) < 20
+
+
+def test_group_commit_reports_errors_to_the_batch():
+    def write(items):
+        if "bad" in items:
+            raise OSError("disk full")
+
+    commits = GroupCommit(write, "test")
+    ticket = commits.submit("bad")
+    with pytest.raises(OSError):
+        commits.wait(ticket)
+    commits.wait(commits.submit("good"))
+    commits.drain()
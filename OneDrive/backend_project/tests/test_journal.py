@@ -0,0 +1,75 @@
+import json
+import time
+
+import pytest
+
+from user_auth import Config, User, UserRepository
+
+LAYOUTS = ["objects", "columnar", "mmap"]
+
+
+@pytest.fixture(params=LAYOUTS)
+def layout(request, monkeypatch):
+    monkeypatch.setattr(Config, "STORAGE_BACKEND", "json")
+    monkeypatch.setattr(Config, "PERSISTENCE_MODE", "journal")
+    monkeypatch.setattr(Config, "MEMORY_LAYOUT", request.param)
+    return request.param
+
+
+def open_backend():
+    backend = UserRepository._create_backend()
+    backend.load()
+    return backend
+
+
+def saved_usernames():
+    with open(Config.USER_FILE, encoding="utf-8") as file:
+        return sorted(data["username"] for data in json.load(file))
+
+
+def test_replayed_records_survive_compaction(layout):
+    # A worker that exits before compacting leaves its changes in the log only
+    first = open_backend()
+    first.add(User("alice", "Passw0rd!x", "alice@example.com"))
+    first.add(User("bob", "Passw0rd!x", "bob@example.com"))
+    first.delete(first.get("bob"))
+
+    second = open_backend()
+    assert [user.username for user in second.iter_users()] == ["alice"]
+    second.flush()
+    assert saved_usernames() == ["alice"]
+
+    third = open_backend()
+    assert third.get("alice").email == "alice@example.com"
+    assert third.get("bob") is None
+
+
+def test_followed_records_survive_compaction(layout):
+    # Changes picked up from another worker are written by whoever compacts
+    writer = open_backend()
+    follower = open_backend()
+    writer.add(User("carol", "Passw0rd!x", "carol@example.com"))
+    follower.sync()
+    assert follower.get("carol") is not None
+    follower.flush()
+    assert saved_usernames() == ["carol"]
+    assert open_backend().get("carol") is not None
+
+
+def test_background_compaction_keeps_every_change(layout, monkeypatch):
+    monkeypatch.setattr(Config, "JOURNAL_COMPACT_THRESHOLD", 3)
+    backend = open_backend()
+    for number in range(10):
+        backend.add(User(f"user{number}", "Passw0rd!x", f"user{number}@example.com"))
+    backend.delete(backend.get("user4"))
+    backend.update(backend.get("user5"), {"email": "five@example.com"})
+    deadline = time.monotonic() + 5
+    while backend.journal.pending >= 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(saved_usernames()) >= 3  # Compacted at least once
+
+    reloaded = open_backend()
+    assert sorted(user.username for user in reloaded.iter_users()) == [
+        f"user{number}" for number in range(10) if number != 4]
+    assert reloaded.get("user5").email == "five@example.com"
+    assert reloaded.get_by_email("user5@example.com") is None
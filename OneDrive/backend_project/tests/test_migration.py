@@ -0,0 +1,115 @@
+import io
+import json
+import os
+
+import pytest
+
+import user_auth
+from migration import LegacyMigration, has_format_marker, iter_json_array, marker_path
+from passwords import PBKDF2_SHA256, PasswordHasher, verify_password
+from user_auth import Config, UserRepository
+
+LEGACY = [{"username": f"user{n}", "password": f"Passw0rd!{n}", "email": f"user{n}@example.com"}
+          for n in range(7)]
+
+
+class FlakyHasher(PasswordHasher):
+    """Fails on the ``fail_on``-th batch, like a crash part way through"""
+
+    def __init__(self, fail_on=None):
+        super().__init__(PBKDF2_SHA256, {"iterations": 1000})
+        self.fail_on = fail_on
+        self.batches = []
+
+    def hash_many(self, passwords):
+        passwords = list(passwords)
+        self.batches.append(passwords)
+        if len(self.batches) == self.fail_on:
+            raise OSError("Killed")
+        return super().hash_many(passwords)
+
+
+def write_legacy(path, users):
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(users, file)
+
+
+def read_output(path):
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def test_converts_legacy_file(tmp_path):
+    source, target = str(tmp_path / "legacy.json"), str(tmp_path / "users.json")
+    write_legacy(source, LEGACY[:3] + [{"username": "bad", "email": "bad@example.com"},
+                                       {"username": "odd", "password": "Passw0rd!x", "email": "o@example.com",
+                                        "role": "root"}])
+    stats = LegacyMigration(source, target, FlakyHasher(), batch_size=2).run()
+    assert (stats["processed"], stats["written"], stats["failed"]) == (5, 3, 2)
+    users = read_output(target + ".migrating")
+    assert [user["username"] for user in users] == ["user0", "user1", "user2"]
+    for user, legacy in zip(users, LEGACY):
+        assert "password" not in user
+        assert verify_password(legacy["password"], user["password_hash"])
+        assert (user["email"], user["role"]) == (legacy["email"], "user")
+
+
+def test_resumes_from_checkpoint(tmp_path):
+    source, target = str(tmp_path / "legacy.json"), str(tmp_path / "users.json")
+    write_legacy(source, LEGACY)
+    with pytest.raises(OSError):
+        LegacyMigration(source, target, FlakyHasher(fail_on=3), batch_size=2).run()
+
+    hasher = FlakyHasher()
+    migration = LegacyMigration(source, target, hasher, batch_size=2)
+    stats = migration.run()
+    # The two finished batches are not hashed again
+    assert hasher.batches == [["Passw0rd!4", "Passw0rd!5"], ["Passw0rd!6"]]
+    assert (stats["processed"], stats["written"], stats["failed"]) == (3, 7, 0)
+    users = read_output(migration.output_path)
+    assert [user["username"] for user in users] == [user["username"] for user in LEGACY]
+    assert all(verify_password(legacy["password"], user["password_hash"]) for user, legacy in zip(users, LEGACY))
+
+
+def test_changed_source_starts_over(tmp_path):
+    source, target = str(tmp_path / "legacy.json"), str(tmp_path / "users.json")
+    write_legacy(source, LEGACY)
+    with pytest.raises(OSError):
+        LegacyMigration(source, target, FlakyHasher(fail_on=2), batch_size=2).run()
+    write_legacy(source, LEGACY[:5])
+    hasher = FlakyHasher()
+    stats = LegacyMigration(source, target, hasher, batch_size=2).run()
+    assert stats["processed"] == 5 and len(hasher.batches) == 3
+    assert len(read_output(target + ".migrating")) == 5
+
+
+def test_iter_json_array_across_chunks():
+    text = json.dumps([{"a": "x" * 10}, 12345, [1, 2], "é"])
+    assert list(iter_json_array(io.StringIO(text), chunk_size=3)) == [{"a": "x" * 10}, 12345, [1, 2], "é"]
+    assert list(iter_json_array(io.StringIO("  "))) == []
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO('{"a": 1}')))
+
+
+def test_startup_migrates_once(monkeypatch):
+    monkeypatch.setattr(Config, "STORAGE_BACKEND", "json")
+    monkeypatch.setattr(Config, "MEMORY_LAYOUT", "objects")
+    write_legacy(Config.USER_FILE, LEGACY)
+    repo = UserRepository()
+    assert repo.get_user("user3").verify_password("Passw0rd!3")
+    assert has_format_marker(Config.USER_FILE)
+    assert os.path.exists(Config.USER_FILE + ".backup")
+    assert not os.path.exists(Config.USER_FILE + ".migrating")
+    repo.backend.flush()
+
+    # With the marker in place the users file is not even opened
+    def fail(*args, **kwargs):
+        raise AssertionError("migration ran again")
+    monkeypatch.setattr(user_auth, "first_element", fail)
+    monkeypatch.setattr(user_auth, "LegacyMigration", fail)
+    with open(marker_path(Config.USER_FILE), encoding="utf-8") as file:
+        marker = file.read()
+    repo = UserRepository()
+    assert repo.get_user("user3").verify_password("Passw0rd!3")
+    with open(marker_path(Config.USER_FILE), encoding="utf-8") as file:
+        assert file.read() == marker
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from service import UserService, decode_cursor, encode_cursor
+from user_auth import User, UserRepository
+
+
+@pytest.fixture
+def service():
+    repo = UserRepository()
+    for name in ("ann", "ben", "cat", "dan"):
+        assert repo.register(User(name, "Passw0rd!x", f"{name}@example.com"))
+    return UserService(repo)
+
+
+def page(service, **args):
+    body, status = service.list_users(args)[:2]
+    assert status == 200
+    page = json.loads(body)
+    return [user["username"] for user in page["users"]], page["next_cursor"]
+
+
+def test_pages_follow_the_cursor(service):
+    names, cursor = page(service, limit="2")
+    assert names == ["admin", "ann"]
+    names, cursor = page(service, limit="2", cursor=cursor)
+    assert names == ["ben", "cat"]
+    names, cursor = page(service, limit="2", cursor=cursor)
+    assert (names, cursor) == (["dan"], None)
+
+
+def test_cursor_round_trip():
+    for username in ("ann", "a", "zoë/?+", "x" * 40):
+        assert decode_cursor(encode_cursor(username)) == username
+    assert decode_cursor("") is None
+
+
+@pytest.mark.parametrize("cursor", ["!!!", "YW5", "YW5=", "YW5u=", "YW5uX", "YW 5u", "/w"])
+def test_malformed_cursor_is_rejected(service, cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+    body, status = service.list_users({"cursor": cursor})[:2]
+    assert status == 400
+    assert body == {"error": "Invalid limit or cursor"}
@@ -0,0 +1,61 @@
+import hashlib
+
+import pytest
+
+from passwords import PBKDF2_SHA256, SCRYPT, PasswordHasher, hash_password, needs_rehash, pack_hash, \
+    unpack_hash, verify_password
+from user_auth import Config, User, UserRepository
+
+PARAMS = {SCRYPT: {"n": 2 ** 10, "r": 8, "p": 1}, PBKDF2_SHA256: {"iterations": 1000}}
+
+
+@pytest.mark.parametrize("algorithm", [SCRYPT, PBKDF2_SHA256])
+def test_round_trip(algorithm):
+    encoded = hash_password("Passw0rd!x", algorithm, PARAMS[algorithm])
+    assert encoded.startswith(algorithm + "$")
+    assert verify_password("Passw0rd!x", encoded)
+    assert not verify_password("Passw0rd!y", encoded)
+    assert not verify_password("", encoded)
+    # Fresh salt every time
+    assert hash_password("Passw0rd!x", algorithm, PARAMS[algorithm]) != encoded
+    assert not needs_rehash(encoded, algorithm, PARAMS[algorithm])
+    assert unpack_hash(pack_hash(encoded)) == encoded
+
+
+def test_settings_change_needs_rehash():
+    encoded = hash_password("Passw0rd!x", SCRYPT, PARAMS[SCRYPT])
+    assert needs_rehash(encoded, SCRYPT, {"n": 2 ** 11, "r": 8, "p": 1})
+    assert needs_rehash(encoded, PBKDF2_SHA256, PARAMS[PBKDF2_SHA256])
+    assert needs_rehash("abcd:" + "00" * 32, SCRYPT, PARAMS[SCRYPT])
+
+
+def test_garbage_hashes_do_not_verify():
+    for encoded in ("", "scrypt$x", "pbkdf2_sha256$1000$zz$zz", "no-colon", "ab:not-hex"):
+        assert not verify_password("Passw0rd!x", encoded)
+
+
+def test_hash_many_matches_hash():
+    hasher = PasswordHasher(PBKDF2_SHA256, PARAMS[PBKDF2_SHA256])
+    hashes = hasher.hash_many(["Passw0rd!a", "Passw0rd!b"])
+    assert [hasher.verify(password, encoded) for password, encoded in zip(["Passw0rd!a", "Passw0rd!b"], hashes)] \
+        == [True, True]
+    assert not hasher.verify("Passw0rd!a", hashes[1])
+
+
+def test_legacy_hash_upgraded_on_login():
+    repo = UserRepository()
+    assert repo.register(User("ann", "Passw0rd!x", "ann@example.com"))
+    salt = "00ff" * 8
+    legacy = f"{salt}:{hashlib.sha256(('Passw0rd!x' + salt).encode()).hexdigest()}"
+    repo.backend.update(repo.get_user("ann"), {"password_hash": legacy})
+    assert repo.get_user("ann").password_hash == legacy
+
+    assert repo.authenticate("ann", "Wr0ngPassw0rd") is None
+    assert repo.get_user("ann").password_hash == legacy
+
+    assert repo.authenticate("ann", "Passw0rd!x") is not None
+    upgraded = repo.get_user("ann").password_hash
+    assert upgraded.startswith(f"{SCRYPT}${Config.SCRYPT_N}$")
+    assert repo.get_user("ann").verify_password("Passw0rd!x")
+    assert repo.authenticate("ann", "Passw0rd!x") is not None
+    assert repo.get_user("ann").password_hash == upgraded
@@ -0,0 +1,101 @@
+import time
+
+import pytest
+
+from permissions import Authorizer, Grant, Permission, PermissionEngine
+
+ENGINE = PermissionEngine({"admin": ["list_users", "manage_users", "change_roles"], "user": []})
+
+
+def test_roles_compile_to_masks():
+    assert ENGINE.mask("admin") == Permission.LIST_USERS | Permission.MANAGE_USERS | Permission.CHANGE_ROLES
+    assert ENGINE.mask("user") == 0
+    assert ENGINE.mask("unknown") == 0
+    grant = Grant("ann", ENGINE.mask("admin"), time.time() + 60)
+    assert grant.allows(Permission.MANAGE_USERS)
+    assert grant.allows(Permission.LIST_USERS | Permission.CHANGE_ROLES)
+    assert not grant.allows(Permission.IMPORT_USERS)
+    assert not grant.allows(Permission.LIST_USERS | Permission.IMPORT_USERS)
+
+
+def test_unknown_permission_names_are_rejected():
+    with pytest.raises(ValueError):
+        PermissionEngine({"admin": ["rule_the_world"]})
+
+
+class Identities:
+    def __init__(self):
+        self.roles = {"t-ann": ("ann", "admin"), "t-ben": ("ben", "user")}
+        self.calls = 0
+        self.expires = time.time() + 60
+
+    def __call__(self, token):
+        self.calls += 1
+        if token not in self.roles:
+            return None
+        username, role = self.roles[token]
+        return username, role, self.expires, {"jti": token}
+
+
+def test_grants_are_cached_per_token():
+    identify = Identities()
+    access = Authorizer(ENGINE, identify)
+    assert access.allows("t-ann", Permission.MANAGE_USERS)
+    assert access.allows("t-ann", Permission.LIST_USERS)
+    assert not access.allows("t-ben", Permission.LIST_USERS)
+    assert not access.allows("t-nobody", Permission.LIST_USERS)
+    assert not access.allows(None, Permission.LIST_USERS)
+    assert identify.calls == 3
+
+
+def test_role_changes_take_effect_after_forget_user():
+    identify = Identities()
+    access = Authorizer(ENGINE, identify)
+    assert access.allows("t-ann", Permission.MANAGE_USERS)
+    identify.roles["t-ann"] = ("ann", "user")
+    assert access.allows("t-ann", Permission.MANAGE_USERS)  # Still cached
+    access.forget_user("ann")
+    assert not access.allows("t-ann", Permission.MANAGE_USERS)
+
+
+def test_revocation_is_checked_on_every_use():
+    revoked = set()
+    access = Authorizer(ENGINE, Identities(), lambda claims: claims["jti"] in revoked)
+    assert access.grant("t-ann") is not None
+    revoked.add("t-ann")
+    assert access.grant("t-ann") is None
+
+
+def test_expired_grants_and_cache_size():
+    identify = Identities()
+    identify.expires = time.time() + 0.05
+    access = Authorizer(ENGINE, identify, cache_size=1)
+    assert access.grant("t-ann") is not None
+    time.sleep(0.1)
+    assert access.grant("t-ann") is None
+    identify.expires = time.time() + 60
+    access.grant("t-ann")
+    access.grant("t-ben")
+    assert list(access._grants) == ["t-ben"]
+    assert "ann" not in access._tokens_by_user
+
+
+def test_demotion_revokes_access_through_the_service(monkeypatch):
+    from service import UserService
+    from user_auth import Config, User, UserRepository, UserRole
+
+    monkeypatch.setattr(Config, "STORAGE_BACKEND", "json")
+    monkeypatch.setattr(Config, "MEMORY_LAYOUT", "objects")
+    repo = UserRepository()
+    service = UserService(repo)
+    repo.register(User("ann", "Passw0rd!x", "ann@example.com", UserRole.ADMIN))
+    repo.register(User("ben", "Passw0rd!x", "ben@example.com"))
+    token = service.login({"username": "ann", "password": "Passw0rd!x"})[0]["token"]
+    user_token = service.login({"username": "ben", "password": "Passw0rd!x"})[0]["token"]
+
+    assert service.admin_users(token, {})[1] == 200
+    assert service.admin_users(user_token, {})[1] == 403
+    assert service.delete_user(user_token, "ann")[1] == 403
+    repo.set_user_role(repo.get_user("ann"), UserRole.USER)
+    assert service.admin_users(token, {})[1] == 403
+    assert service.delete_user(token, "ben")[1] == 403
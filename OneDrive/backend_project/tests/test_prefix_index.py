@@ -0,0 +1,86 @@
+import pytest
+
+from prefix_index import PrefixIndex
+from service import UserService
+from user_auth import Config, User, UserRepository
+
+NAMES = ["Alice", "alex", "ALBERT", "al", "bob", "Bobby", "carol"]
+
+
+def test_prefix_search():
+    index = PrefixIndex(lambda: NAMES)
+    assert index.search("al", 10) == ["al", "ALBERT", "alex", "Alice"]
+    assert index.search("bob", 10) == ["bob", "Bobby"]
+    assert index.search("z", 10) == []
+    assert index.search("", 3) == ["al", "ALBERT", "alex"]
+
+
+def test_case_folding():
+    index = PrefixIndex(lambda: NAMES)
+    assert index.search("AL", 10) == index.search("aL", 10) == ["al", "ALBERT", "alex", "Alice"]
+    assert index.search("BOBB", 10) == ["Bobby"]
+
+
+def test_limit():
+    index = PrefixIndex(lambda: NAMES)
+    assert index.search("al", 2) == ["al", "ALBERT"]
+    assert index.search("al", 1) == ["al"]
+
+
+def test_delete_and_rename():
+    index = PrefixIndex(lambda: NAMES)
+    index.search("a", 1)
+    index.discard("alex")
+    index.discard("nobody")
+    assert index.search("al", 10) == ["al", "ALBERT", "Alice"]
+    # A rename is the old name going and the new one arriving
+    index.discard("Bobby")
+    index.add("Alfred")
+    assert index.search("bo", 10) == ["bob"]
+    assert index.search("alf", 10) == ["Alfred"]
+    index.add("Alfred")
+    assert index.search("alf", 10) == ["Alfred"]
+
+
+def test_changes_before_first_search_come_from_the_source():
+    names = list(NAMES)
+    index = PrefixIndex(lambda: names)
+    index.add("dave")  # Not built yet, nothing to update
+    names.append("dave")
+    assert index.search("d", 10) == ["dave"]
+
+
+def test_change_during_build_is_kept():
+    names = list(NAMES)
+
+    def source():
+        # Someone registers while the index is reading the backend
+        index.add("alan")
+        return names
+    index = PrefixIndex(source)
+    assert index.search("ala", 10) == ["alan"]
+
+
+def test_invalidate_rebuilds():
+    names = list(NAMES)
+    index = PrefixIndex(lambda: names)
+    assert index.search("c", 10) == ["carol"]
+    names.append("Cid")
+    index.invalidate()
+    assert index.search("c", 10) == ["carol", "Cid"]
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_repository_keeps_index_current(backend, monkeypatch):
+    monkeypatch.setattr(Config, "STORAGE_BACKEND", backend)
+    repo = UserRepository()
+    service = UserService(repo)
+    for name in ("Ann", "anna", "annie"):
+        assert repo.register(User(name, "Passw0rd!x", f"{name}@example.com"))
+    assert service.search_users({"prefix": "ANN", "limit": "2"}) == ({"usernames": ["Ann", "anna"]}, 200)
+    assert repo.delete_user("anna")
+    assert repo.search_usernames("ann", 10) == ["Ann", "annie"]
+    assert repo.register(User("Annabel", "Passw0rd!x", "annabel@example.com"))
+    assert repo.search_usernames("anna", 10) == ["Annabel"]
+    assert service.search_users({})[1] == 400
+    assert service.search_users({"prefix": "a", "limit": "x"})[1] == 400
@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+from response_cache import ResponseCache, etag_matches
+from service import UserService
+from user_auth import User, UserRepository
+
+
+@pytest.fixture
+def service():
+    repo = UserRepository()
+    for name in ("ann", "ben"):
+        assert repo.register(User(name, "Passw0rd!x", f"{name}@example.com"))
+    return UserService(repo)
+
+
+def admin_token(service):
+    return service.login({"username": "admin", "password": "Admin123!"})[0]["token"]
+
+
+def test_matching_etag_gets_304(service):
+    body, status, headers = service.list_users({})
+    etag = dict(headers)["ETag"]
+    assert status == 200
+    assert service.list_users({}, etag) == (b"", 304, headers)
+    assert service.list_users({}, f'"other", W/{etag}')[1] == 304
+    assert service.list_users({}, '"other"')[:2] == (body, 200)
+    # A different page is a different response
+    assert service.list_users({"limit": "1"}, etag)[1] == 200
+
+
+def test_write_invalidates_cached_listing(service):
+    body, _, headers = service.list_users({})
+    etag = dict(headers)["ETag"]
+    assert service.repo.register(User("cat", "Passw0rd!x", "cat@example.com"))
+    body, status, headers = service.list_users({}, etag)
+    assert status == 200
+    assert dict(headers)["ETag"] != etag
+    assert "cat" in [user["username"] for user in json.loads(body)["users"]]
+
+    etag = dict(headers)["ETag"]
+    assert service.delete_user(admin_token(service), "cat")[1] == 200
+    body, status = service.list_users({}, etag)[:2]
+    assert status == 200
+    assert "cat" not in [user["username"] for user in json.loads(body)["users"]]
+
+
+def test_admin_users_is_paged_and_cached(service):
+    token = admin_token(service)
+    body, status, headers = service.admin_users(token, {"limit": "2"})
+    page = json.loads(body)
+    assert status == 200
+    assert [user["username"] for user in page["users"]] == ["admin", "ann"]
+    assert dict(headers)["Cache-Control"] == "private, no-cache"
+    assert service.admin_users(token, {"limit": "2"}, dict(headers)["ETag"])[1] == 304
+    page = json.loads(service.admin_users(token, {"limit": "2", "cursor": page["next_cursor"]})[0])
+    assert [user["username"] for user in page["users"]] == ["ben"]
+    assert page["next_cursor"] is None
+    assert service.admin_users(token, {"cursor": "!!!"})[1] == 400
+
+
+def test_large_bodies_are_not_kept():
+    cache = ResponseCache(max_entries=2, max_bytes=10)
+    assert cache.put(1, "big", b"x" * 11).body == b"x" * 11
+    assert cache.get(1, "big") is None
+    cache.put(1, "a", b"aaaa")
+    cache.put(1, "b", b"bbbb")
+    cache.put(1, "c", b"cccc")
+    assert cache.get(1, "a") is None and cache.get(1, "c").body == b"cccc"
+    assert cache.get(2, "c") is None
+    assert etag_matches("*", cache.get(1, "c").etag)
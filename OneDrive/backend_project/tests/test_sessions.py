@@ -0,0 +1,97 @@
+import pytest
+
+import sessions
+from sessions import MemorySessionStore, SQLiteSessionStore
+from user_auth import Config
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sessions, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_store(request, clock):
+    def make(ttl=100.0, max_sessions=10):
+        if request.param == "memory":
+            return MemorySessionStore(ttl, max_sessions)
+        return SQLiteSessionStore(Config.SESSION_FILE, ttl, max_sessions, purge_interval=0)
+    return make
+
+
+def test_expiry(make_store, clock):
+    store = make_store()
+    token = store.create("ann")
+    assert store.get(token)["username"] == "ann"
+    clock.now += 99
+    # Renewed, more than half of the lifetime had passed
+    assert store.get(token)["expires"] == clock.now + 100
+    clock.now += 99
+    assert store.get(token) is not None
+    clock.now += 101
+    assert store.get(token) is None
+    assert store.purge_expired() == 0
+    assert store.count() == 0
+
+
+def test_purge_drops_only_expired(make_store, clock):
+    store = make_store()
+    old = store.create("ann")
+    clock.now += 60
+    new = store.create("ben")
+    clock.now += 50
+    assert store.get(old) is None
+    assert store.get(new)["username"] == "ben"
+    assert store.count() == 1
+
+
+def test_least_recently_used_is_evicted(make_store, clock):
+    store = make_store(max_sessions=3)
+    tokens = [store.create(name) for name in ("ann", "ben", "cat")]
+    clock.now += 60
+    # Using ann's session renews it, so ben's is now the oldest
+    assert store.get(tokens[0])["username"] == "ann"
+    dan = store.create("dan")
+    assert store.count() == 3
+    assert store.get(tokens[1]) is None
+    assert [store.get(token)["username"] for token in (tokens[0], tokens[2], dan)] == ["ann", "cat", "dan"]
+
+
+def test_delete(make_store):
+    store = make_store()
+    token = store.create("ann")
+    assert store.delete(token) == "ann"
+    assert store.delete(token) is None
+    assert store.get(token) is None
+    assert store.count() == 0
+
+
+def test_sqlite_count_follows_deletes(clock):
+    store = SQLiteSessionStore(Config.SESSION_FILE, 100.0, 4, purge_interval=3600)
+    tokens = [store.create(f"user{n}") for n in range(4)]
+    store.delete(tokens[0])
+    store.delete("no-such-token")
+    assert store.count() == 3
+    clock.now += 60
+    store.create("late")
+    store.create("later")  # evicts the oldest to stay at the cap
+    assert store.count() == 4
+    clock.now += 50
+    assert store.purge_expired() == 2
+    assert store.count() == 2
+
+    # The total survives reopening the database
+    reopened = SQLiteSessionStore(Config.SESSION_FILE, 100.0, 4)
+    assert reopened.count() == 2
+    rows = reopened.pool.connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+    assert rows == 2
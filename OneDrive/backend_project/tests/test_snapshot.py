@@ -0,0 +1,55 @@
+import json
+import threading
+
+from snapshot import SnapshotBackend
+from user_auth import Config, User
+
+
+def make_backend(count=200):
+    with open(Config.USER_FILE, "w", encoding="utf-8") as file:
+        json.dump([{"username": f"user{i:04d}", "password_hash": None, "email": f"user{i:04d}@example.com",
+                    "role": "user", "created_at": "2024-01-01T00:00:00"} for i in range(count)], file)
+    backend = SnapshotBackend(Config.USER_FILE, Config.SNAPSHOT_FILE, User.from_dict)
+    backend.load()
+    return backend
+
+
+def test_lookups_leave_the_indexes_alone():
+    backend = make_backend()
+    first = backend.get("user0007")
+    assert first is backend.get("user0007")
+    assert backend.get_by_email("USER0008@example.com").username == "user0008"
+    assert backend.users_by_username == {} and backend.sorted_usernames == []
+
+    backend.update(first, {"email": "changed@example.com"})
+    assert list(backend.users_by_username) == ["user0007"]
+    assert backend.get_by_email("user0007@example.com") is None
+    assert backend.get_by_email("changed@example.com") is first
+
+
+def test_lookups_and_scans_side_by_side():
+    backend = make_backend()
+    errors = []
+
+    def lookups(offset):
+        try:
+            for i in range(offset, 200, 4):
+                assert backend.get(f"user{i:04d}").username == f"user{i:04d}"
+        except Exception as e:  # Surfaced by the main thread
+            errors.append(e)
+
+    def scans():
+        try:
+            for _ in range(20):
+                assert len(list(backend.iter_users())) == 200
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=lookups, args=(offset,)) for offset in range(4)]
+    threads += [threading.Thread(target=scans) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert backend.count() == 200
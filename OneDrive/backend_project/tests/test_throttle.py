@@ -0,0 +1,88 @@
+import pytest
+
+import throttle
+from service import UserService
+from throttle import CountMinSketch, LoginThrottle, RateLimiter, retry_after_header
+from user_auth import Config, UserRepository
+
+
+class Clock:
+    def __init__(self):
+        self.now = 5000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(throttle, "time", clock)
+    return clock
+
+
+def test_limit_trips(clock):
+    limiter = RateLimiter(5, 60)
+    assert [limiter.hit("ann") for _ in range(5)] == [0.0] * 5
+    retry_after = limiter.hit("ann")
+    assert 0 < retry_after <= 12
+    # Other keys are not affected
+    assert limiter.hit("ben") == 0.0
+
+
+def test_window_slides(clock):
+    limiter = RateLimiter(5, 60)
+    for _ in range(5):
+        limiter.hit("ann")
+    retry_after = limiter.hit("ann")
+    assert retry_after
+    clock.now += retry_after
+    # One attempt's worth has slid out of the window
+    assert limiter.hit("ann") == 0.0
+    assert limiter.hit("ann") > 0
+    clock.now += 60
+    assert [limiter.hit("ann") for _ in range(5)] == [0.0] * 5
+
+
+def test_quiet_keys_stay_in_the_sketch(clock):
+    limiter = RateLimiter(10, 60, hot_keys=2)
+    for n in range(100):
+        assert limiter.hit(f"user{n}") == 0.0
+    assert len(limiter._buckets) == 0
+    for _ in range(5):
+        limiter.hit("busy")
+    assert list(limiter._buckets) == ["busy"]
+
+
+def test_sketch_never_underestimates():
+    sketch = CountMinSketch(16, 4, b"k" * 16)
+    for n in range(200):
+        sketch.add(f"key{n}", n % 3 + 1)
+    assert all(sketch.estimate(f"key{n}") >= n % 3 + 1 for n in range(200))
+
+
+def test_client_limit_comes_first(clock):
+    login_throttle = LoginThrottle(RateLimiter(100, 60), RateLimiter(2, 60))
+    assert login_throttle.check("ann", "10.0.0.1") == 0
+    assert login_throttle.check("ben", "10.0.0.1") == 0
+    assert login_throttle.check("cat", "10.0.0.1") > 0
+    assert login_throttle.check("cat", "10.0.0.2") == 0
+
+
+def test_login_gets_429_with_retry_after(clock, monkeypatch):
+    monkeypatch.setattr(Config, "LOGIN_RATE_PER_USER", 3)
+    service = UserService(UserRepository())
+    for _ in range(3):
+        assert service.login({"username": "admin", "password": "wrong"}, "10.0.0.1")[1] == 401
+    body, status, headers = service.login({"username": "admin", "password": "Admin123!"}, "10.0.0.1")
+    assert status == 429
+    assert body == {"error": "Too many login attempts"}
+    assert headers == [("Retry-After", "20")]
+
+    clock.now += 20
+    assert service.login({"username": "admin", "password": "Admin123!"}, "10.0.0.1")[1] == 200
+
+
+def test_retry_after_rounds_up():
+    assert retry_after_header(0.2) == ("Retry-After", "1")
+    assert retry_after_header(12.01) == ("Retry-After", "13")
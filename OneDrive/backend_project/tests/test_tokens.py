@@ -0,0 +1,63 @@
+import time
+
+from tokens import RevocationList, TokenSigner
+
+
+def signer(ttl=60, db_path=None):
+    return TokenSigner(b"k" * 32, ttl, RevocationList(db_path, sync_interval=0))
+
+
+def test_issue_and_verify():
+    tokens = signer()
+    claims = tokens.verify(tokens.issue("ann", "admin"))
+    assert claims["sub"] == "ann" and claims["role"] == "admin"
+
+
+def test_tampered_and_expired_tokens_are_rejected():
+    tokens = signer()
+    header, payload, signature = tokens.issue("ann", "user").split(".")
+    forged = signer().issue("ann", "admin").split(".")[1]
+    assert tokens.verify(f"{header}.{forged}.{signature}") is None
+    assert tokens.verify("not a token") is None
+    assert signer(ttl=-1).verify(signer(ttl=-1).issue("ann", "user")) is None
+
+
+def test_revoking_one_token_keeps_the_others():
+    tokens = signer()
+    first, second = tokens.issue("ann", "user"), tokens.issue("ann", "user")
+    tokens.revoke(tokens.verify(first))
+    assert tokens.verify(first) is None
+    assert tokens.verify(second) is not None
+
+
+def test_revoking_a_user_covers_tokens_issued_before():
+    tokens = signer()
+    old = tokens.issue("ann", "user")
+    other = tokens.issue("ben", "user")
+    tokens.revocations.revoke_user("ann", tokens.ttl)
+    time.sleep(0.01)
+    assert tokens.verify(old) is None
+    assert tokens.verify(other) is not None
+    assert tokens.verify(tokens.issue("ann", "user")) is not None
+
+
+def test_revocations_reach_other_processes(tmp_path):
+    db_path = str(tmp_path / "sessions.db")
+    here, there = signer(db_path=db_path), signer(db_path=db_path)
+    token, user_token = here.issue("ann", "user"), here.issue("ben", "user")
+    assert there.verify(token) is not None
+    here.revoke(here.verify(token))
+    here.revocations.revoke_user("ben", here.ttl)
+    assert there.verify(token) is None
+    assert there.verify(user_token) is None
+
+
+def test_expired_revocations_are_pruned():
+    revocations = RevocationList(capacity=4)
+    now = time.time()
+    for number in range(3):
+        revocations.revoke_token(f"old{number}", now - 1)
+    revocations.revoke_token("live", now + 60)
+    assert set(revocations._tokens) == {"live"}
+    assert revocations.is_revoked({"sub": "ann", "iat": now, "jti": "live"})
+    assert not revocations.is_revoked({"sub": "ann", "iat": now, "jti": "old0"})
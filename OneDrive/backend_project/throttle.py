@@ -0,0 +1,147 @@
+"""Login rate limiting in fixed memory.
+
+Every attempt is counted in a count-min sketch over a sliding window, so
+tracking a million distinct usernames or addresses costs the same few
+hundred kilobytes as tracking ten. The sketch can only overestimate; once
+a key's estimate reaches half its limit, the key moves to a bounded table
+of exact token buckets, and the decision to reject is always made there.
+Attackers cannot aim collisions at a victim, because the sketch hashes
+with a per-process random key.
+
+Limits are per process. With several server workers, each one enforces
+its own limits.
+"""
+import hashlib
+import math
+import secrets
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from metrics import REGISTRY
+
+THROTTLED = REGISTRY.counter("login_throttled_total", "Login attempts rejected by rate limiting", ["scope"])
+
+
+class CountMinSketch:
+    """Approximate counts per key in ``depth`` rows of ``width`` counters"""
+
+    def __init__(self, width: int, depth: int, key: bytes):
+        self.width = width
+        self.depth = depth
+        self._key = key
+        self._rows = [array("I", bytes(4 * width)) for _ in range(depth)]
+
+    def _slots(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16, key=self._key).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, item: str, amount: int = 1) -> int:
+        """Count ``item`` and return its new estimate"""
+        estimate = None
+        for row, slot in zip(self._rows, self._slots(item)):
+            value = min(row[slot] + amount, 0xFFFFFFFF)
+            row[slot] = value
+            estimate = value if estimate is None else min(estimate, value)
+        return estimate
+
+    def estimate(self, item: str) -> int:
+        return min(row[slot] for row, slot in zip(self._rows, self._slots(item)))
+
+    def clear(self):
+        for row in self._rows:
+            row[:] = array("I", bytes(4 * self.width))
+
+
+class RateLimiter:
+    """Allows ``limit`` events per key in any ``window`` seconds.
+
+    ``hit`` counts an event and returns 0 if it is allowed, or how many
+    seconds to wait before the key is allowed again.
+    """
+
+    def __init__(self, limit: int, window: float, width: int = 4096, depth: int = 4, hot_keys: int = 10_000):
+        self.limit = limit
+        self.window = window
+        self.rate = limit / window
+        self.hot_keys = hot_keys
+        key = secrets.token_bytes(16)
+        # The current and previous window; the previous one is weighted by
+        # how much of it still overlaps the sliding window
+        self._current = CountMinSketch(width, depth, key)
+        self._previous = CountMinSketch(width, depth, key)
+        self._window_start = time.monotonic()
+        # key -> [tokens, last refill time], least recently used first
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _rotate(self, now: float):
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return
+        if elapsed < 2 * self.window:
+            self._previous, self._current = self._current, self._previous
+            self._window_start += self.window
+        else:
+            self._previous.clear()
+            self._window_start = now
+        self._current.clear()
+
+    def _estimate(self, key: str, now: float) -> float:
+        overlap = 1 - (now - self._window_start) / self.window
+        return self._current.estimate(key) + self._previous.estimate(key) * max(overlap, 0.0)
+
+    def hit(self, key: str) -> float:
+        now = time.monotonic()
+        with self._lock:
+            self._rotate(now)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                estimate = self._estimate(key, now) + 1
+                self._current.add(key)
+                if estimate < self.limit / 2:
+                    return 0.0
+                # Getting busy: track this key exactly from here on
+                bucket = self._buckets[key] = [max(self.limit - estimate + 1, 0.0), now]
+                if len(self._buckets) > self.hot_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                self._current.add(key)
+            tokens = min(self.limit, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0.0
+            bucket[0] = tokens
+            return (1 - tokens) / self.rate
+
+
+class LoginThrottle:
+    """Per-username and per-client limits on login attempts"""
+
+    def __init__(self, per_user: RateLimiter, per_client: RateLimiter):
+        self.per_user = per_user
+        self.per_client = per_client
+
+    def check(self, username: Optional[str], client: Optional[str]) -> float:
+        """Count an attempt; returns seconds to wait, or 0 if it may proceed"""
+        retry_after = 0.0
+        if client:
+            retry_after = self.per_client.hit(client)
+            if retry_after:
+                THROTTLED.inc(scope="client")
+                return retry_after
+        if username:
+            retry_after = self.per_user.hit(username)
+            if retry_after:
+                THROTTLED.inc(scope="user")
+        return retry_after
+
+
+def retry_after_header(seconds: float) -> Tuple[str, str]:
+    """Retry-After takes whole seconds; round up so clients never come back early"""
+    return "Retry-After", str(max(1, math.ceil(seconds)))
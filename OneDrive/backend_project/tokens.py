@@ -0,0 +1,234 @@
+import base64
+import hashlib
+import hmac
+import json
+import math
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from storage import ConnectionPool
+
+
+def load_or_create_secret(path: str) -> bytes:
+    """Read the signing key from ``path``, creating it on first use.
+
+    Every worker process must sign with the same key, so it lives in a file
+    rather than being generated per process. ``AUTH_TOKEN_SECRET`` in the
+    environment takes precedence.
+    """
+    env_secret = os.environ.get("AUTH_TOKEN_SECRET")
+    if env_secret:
+        return env_secret.encode()
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, "r", encoding="utf-8") as file:
+            return file.read().strip().encode()
+    with os.fdopen(fd, "w", encoding="utf-8") as file:
+        secret = secrets.token_hex(32)
+        file.write(secret)
+    return secret.encode()
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class BloomFilter:
+    """Fixed-size set membership test with no false negatives"""
+
+    def __init__(self, capacity: int = 10_000, error_rate: float = 0.001):
+        # Standard sizing: m = -n ln p / (ln 2)^2 bits, k = m/n ln 2 hashes
+        self.size = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class RevocationList:
+    """Revoked tokens, checked in memory on every request.
+
+    Individually revoked token ids sit in a bloom filter backed by an exact
+    dict (id -> token expiry); the filter answers the common "not revoked"
+    case and the dict confirms hits. Revoking every token of a user (role
+    change, deletion) stores a single not-before time for that user. Entries
+    are only kept until the tokens they cover would have expired anyway.
+
+    With a database path, revocations are also written to a shared table and
+    pulled in from other processes at most once every ``sync_interval``
+    seconds, so a logout on one worker is honoured by all of them.
+    """
+
+    _SQL_SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS revocations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            jti TEXT,
+            username TEXT,
+            not_before REAL,
+            expires REAL NOT NULL
+        )""",
+    )
+    _SQL_INSERT = "INSERT INTO revocations (jti, username, not_before, expires) VALUES (?, ?, ?, ?)"
+    _SQL_SINCE = "SELECT id, jti, username, not_before, expires FROM revocations WHERE id > ? AND expires > ? ORDER BY id"
+    _SQL_PRUNE = "DELETE FROM revocations WHERE expires <= ?"
+
+    def __init__(self, db_path: Optional[str] = None, sync_interval: float = 1.0, capacity: int = 10_000):
+        self.capacity = capacity
+        self.sync_interval = sync_interval
+        self._tokens: Dict[str, float] = {}
+        self._users: Dict[str, Tuple[float, float]] = {}
+        self._bloom = BloomFilter(capacity)
+        self._lock = threading.Lock()
+        self._last_sync = 0.0
+        self._last_id = 0
+        self.pool = ConnectionPool(db_path) if db_path else None
+        if self.pool:
+            conn = self.pool.connection()
+            with conn:
+                for statement in self._SQL_SCHEMA:
+                    conn.execute(statement)
+
+    def revoke_token(self, jti: str, expires: float):
+        self._add_token(jti, expires)
+        self._publish(jti, None, None, expires)
+
+    def revoke_user(self, username: str, ttl: float):
+        """Revoke every token issued to ``username`` up to now"""
+        now = time.time()
+        self._add_user(username, now, now + ttl)
+        self._publish(None, username, now, now + ttl)
+
+    def is_revoked(self, claims: Dict) -> bool:
+        now = time.time()
+        if self.pool and now - self._last_sync >= self.sync_interval:
+            self._sync(now)
+        user_entry = self._users.get(claims["sub"])
+        if user_entry and claims["iat"] <= user_entry[0]:
+            return True
+        jti = claims["jti"]
+        return jti in self._bloom and jti in self._tokens
+
+    def _add_token(self, jti: str, expires: float):
+        with self._lock:
+            self._tokens[jti] = expires
+            self._bloom.add(jti)
+            if len(self._tokens) >= self.capacity:
+                self._prune(time.time())
+
+    def _add_user(self, username: str, not_before: float, expires: float):
+        with self._lock:
+            current = self._users.get(username)
+            if not current or current[0] < not_before:
+                self._users[username] = (not_before, expires)
+
+    def _prune(self, now: float):
+        """Forget entries for tokens that have expired anyway; rebuilds the filter"""
+        self._tokens = {jti: exp for jti, exp in self._tokens.items() if exp > now}
+        self._users = {name: entry for name, entry in self._users.items() if entry[1] > now}
+        # Grow the filter if live revocations alone are filling it
+        self.capacity = max(self.capacity, 2 * len(self._tokens))
+        self._bloom = BloomFilter(self.capacity)
+        for jti in self._tokens:
+            self._bloom.add(jti)
+
+    def _publish(self, jti: Optional[str], username: Optional[str], not_before: Optional[float], expires: float):
+        if not self.pool:
+            return
+        conn = self.pool.connection()
+        with conn:
+            conn.execute(self._SQL_INSERT, (jti, username, not_before, expires))
+
+    def _sync(self, now: float):
+        self._last_sync = now
+        conn = self.pool.connection()
+        for row in conn.execute(self._SQL_SINCE, (self._last_id, now)).fetchall():
+            self._last_id = max(self._last_id, row["id"])
+            if row["jti"]:
+                self._add_token(row["jti"], row["expires"])
+            else:
+                self._add_user(row["username"], row["not_before"], row["expires"])
+        with conn:
+            conn.execute(self._SQL_PRUNE, (now,))
+
+
+class TokenSigner:
+    """Issues and verifies HMAC-SHA256 signed access tokens (JWT, HS256).
+
+    Tokens carry the username, role and expiry, so checking one needs no
+    user or session lookup. Verified tokens are kept in a small LRU cache so
+    repeat requests with the same token skip decoding and the HMAC.
+    """
+
+    _HEADER = _b64encode(json.dumps({"alg": "HS256", "typ": "JWT"}, separators=(",", ":")).encode())
+
+    def __init__(self, secret: bytes, ttl: float, revocations: RevocationList, cache_size: int = 10_000):
+        self.secret = secret
+        self.ttl = ttl
+        self.revocations = revocations
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Dict]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def _sign(self, signing_input: str) -> str:
+        return _b64encode(hmac.new(self.secret, signing_input.encode(), hashlib.sha256).digest())
+
+    def issue(self, username: str, role: str) -> str:
+        now = time.time()
+        claims = {"sub": username, "role": role, "iat": now, "exp": now + self.ttl, "jti": secrets.token_hex(12)}
+        payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+        signing_input = f"{self._HEADER}.{payload}"
+        return f"{signing_input}.{self._sign(signing_input)}"
+
+    def verify(self, token: str) -> Optional[Dict]:
+        """Return the token's claims if it is authentic, unexpired and not revoked"""
+        with self._cache_lock:
+            claims = self._cache.get(token)
+            if claims is not None:
+                self._cache.move_to_end(token)
+        if claims is None:
+            claims = self._decode(token)
+            if claims is None:
+                return None
+            with self._cache_lock:
+                self._cache[token] = claims
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        if claims["exp"] <= time.time() or self.revocations.is_revoked(claims):
+            return None
+        return claims
+
+    def revoke(self, claims: Dict):
+        self.revocations.revoke_token(claims["jti"], claims["exp"])
+
+    def _decode(self, token: str) -> Optional[Dict]:
+        try:
+            header, payload, signature = token.split(".")
+            if not hmac.compare_digest(signature, self._sign(f"{header}.{payload}")):
+                return None
+            claims = json.loads(_b64decode(payload))
+        except (ValueError, TypeError):
+            return None
+        if not all(key in claims for key in ("sub", "role", "iat", "exp", "jti")):
+            return None
+        return claims
@@ -1,12 +1,30 @@
-import json
+import itertools
+import logging
 import os
 import re
-import hashlib
-import secrets
-from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Union
+import functools
+import sys
+from datetime import datetime
+from typing import Optional, Dict, List, Set, Tuple, Union
 from enum import Enum
 
+from audit import AuditLog
+from breached import BREACHED_REJECTIONS, BreachedPasswords, open_filter
+from columnar import ColumnarBackend
+from journal import UserJournal
+from migration import LegacyMigration, first_element, has_format_marker, write_format_marker
+from passwords import PasswordHasher, pack_hash, unpack_hash
+from permissions import Authorizer, Permission, PermissionEngine
+from prefix_index import PrefixIndex
+from shards import read_manifest
+from sessions import SessionStore, MemorySessionStore, SQLiteSessionStore
+from snapshot import SnapshotBackend
+from throttle import LoginThrottle, RateLimiter
+from tokens import TokenSigner, RevocationList, load_or_create_secret
+from storage import StorageBackend, JsonFileBackend, SQLiteBackend, DuplicateUserError, encode_timestamp, decode_timestamp
+
+logger = logging.getLogger(__name__)
+
 # ANSI color codes
 class Colors:
     HEADER = '\033[95m'
@@ -24,9 +42,99 @@ def color_text(text: str, color: str) -> str:
 
 class Config:
     """Configuration settings"""
+    # "json" keeps every user in memory and persists to USER_FILE;
+    # "sqlite" stores users in SQLITE_FILE and queries them on demand
+    STORAGE_BACKEND = "json"
     USER_FILE = "users.json"
+    SQLITE_FILE = "users.db"
+    SQLITE_POOL_SIZE = 16
+    # With the json backend: "objects" keeps a User object per user,
+    # "columnar" packs users into arrays (less memory, faster full scans),
+    # "mmap" maps SNAPSHOT_FILE and decodes users on first use (near-instant
+    # start-up; needs a POSIX system, as the mapped file is replaced on save)
+    MEMORY_LAYOUT = "objects"
+    SNAPSHOT_FILE = "users.snap"
+    # Split a new json store into this many files by username hash (see
+    # shards.py, which also reshards an existing store); not for "mmap"
+    USER_SHARDS = 1
+    # Worker processes parsing shards at startup; 0 parses them in turn
+    SHARD_LOAD_WORKERS = os.cpu_count() or 1
+    # "journal" appends each change to JOURNAL_FILE and compacts it into
+    # USER_FILE in the background; "snapshot" rewrites USER_FILE every time
+    PERSISTENCE_MODE = "journal"
+    JOURNAL_FILE = "users.log"
+    JOURNAL_COMPACT_THRESHOLD = 1000
+    JOURNAL_FSYNC = False
+    # Seconds between checks for changes logged by other worker processes
+    JOURNAL_POLL_INTERVAL = 0.05
+    # Legacy users hashed per batch during migration
+    MIGRATION_BATCH_SIZE = 500
     MIN_PASSWORD_LENGTH = 8
+    # Bloom filter of breached passwords built with "python breached.py build";
+    # passwords found in it are rejected. Without the file the check is skipped
+    BREACHED_PASSWORD_FILTER = "breached_passwords.bloom"
+    # "scrypt" or "pbkdf2_sha256"; stored hashes that use other settings are
+    # upgraded on the user's next successful login
+    PASSWORD_HASH_ALGORITHM = "scrypt"
+    SCRYPT_N = 2 ** 14
+    SCRYPT_R = 8
+    SCRYPT_P = 1
+    PBKDF2_ITERATIONS = 600_000
+    # Worker processes for hashing; 0 hashes on the calling thread
+    HASH_WORKERS = os.cpu_count() or 1
     TOKEN_EXPIRY_MINUTES = 30
+    # "sqlite" shares sessions between worker processes through SESSION_FILE;
+    # "memory" keeps them in this process only
+    SESSION_BACKEND = "sqlite"
+    SESSION_FILE = "sessions.db"
+    MAX_SESSIONS = 100_000
+    # Signed access tokens used by the API; sessions act as refresh tokens
+    ACCESS_TOKEN_MINUTES = 15
+    TOKEN_SECRET_FILE = "token_secret.key"
+    TOKEN_CACHE_SIZE = 10_000
+    # Permission names (see permissions.Permission) granted to each role,
+    # compiled to bitsets at startup
+    ROLE_PERMISSIONS = {
+        "admin": ["list_users", "manage_users", "change_roles", "import_users", "view_audit"],
+        "user": [],
+    }
+    # Login attempts allowed per username and per client address in any
+    # LOGIN_RATE_WINDOW seconds, counted before the password is checked
+    LOGIN_RATE_PER_USER = 10
+    LOGIN_RATE_PER_CLIENT = 50
+    LOGIN_RATE_WINDOW = 60
+    LOGIN_THROTTLE_HOT_KEYS = 10_000
+    # Take the client address from X-Forwarded-For (only behind a trusted proxy)
+    TRUST_FORWARDED_FOR = False
+    USERS_PAGE_SIZE = 100
+    USERS_MAX_PAGE_SIZE = 1000
+    # Most operations accepted by one /admin/users/batch request
+    ADMIN_BATCH_MAX = 10_000
+    # Matches returned by /users/search when no limit is given
+    USERS_SEARCH_LIMIT = 10
+    # Logins, registrations, deletions and role changes are kept in a ring
+    # buffer of AUDIT_BUFFER_SIZE events and appended to AUDIT_FILE (gzipped
+    # JSON lines) every AUDIT_FLUSH_INTERVAL seconds; None keeps them in
+    # memory only. The file is rotated at AUDIT_MAX_BYTES, keeping
+    # AUDIT_BACKUPS old ones
+    AUDIT_FILE = "audit.jsonl.gz"
+    AUDIT_BUFFER_SIZE = 10_000
+    AUDIT_FLUSH_INTERVAL = 1.0
+    AUDIT_MAX_BYTES = 10 * 1024 * 1024
+    AUDIT_BACKUPS = 5
+    # /admin/audit/stream: events sent on connect, and seconds between
+    # keep-alive comments
+    AUDIT_STREAM_BACKLOG = 100
+    AUDIT_STREAM_HEARTBEAT = 15
+    # Serialized user listings kept per repository version. The sqlite
+    # backend does not see other workers' changes, so with several workers
+    # on one database set RESPONSE_CACHE_ENTRIES to 0.
+    RESPONSE_CACHE_ENTRIES = 256
+    RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+    # Threads the ASGI server uses for blocking work (hashing, I/O)
+    ASGI_EXECUTOR_WORKERS = 32
+    # Servers only log warnings and errors; the interactive CLI logs INFO too
+    LOG_LEVEL = "WARNING"
 
 class UserRole(str, Enum):
     """User roles enum"""
@@ -37,7 +145,39 @@ class ValidationError(Exception):
     """Custom exception for validation errors"""
     pass
 
+def configure_logging(level: Optional[str] = None):
+    """Send log records to stderr at ``level`` (default: Config.LOG_LEVEL)"""
+    logging.basicConfig(level=level or Config.LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+_password_hasher: Optional[PasswordHasher] = None
+
+def password_hasher() -> PasswordHasher:
+    """Shared password hasher built from Config on first use"""
+    global _password_hasher
+    if _password_hasher is None:
+        if Config.PASSWORD_HASH_ALGORITHM == "scrypt":
+            params = {"n": Config.SCRYPT_N, "r": Config.SCRYPT_R, "p": Config.SCRYPT_P}
+        else:
+            params = {"iterations": Config.PBKDF2_ITERATIONS}
+        _password_hasher = PasswordHasher(Config.PASSWORD_HASH_ALGORITHM, params, Config.HASH_WORKERS)
+    return _password_hasher
+
+_breached_passwords: Optional[BreachedPasswords] = None
+_breached_loaded = False
+
+def breached_passwords() -> Optional[BreachedPasswords]:
+    """Shared breached password filter from Config, or None if there is none"""
+    global _breached_passwords, _breached_loaded
+    if not _breached_loaded:
+        _breached_passwords = open_filter(Config.BREACHED_PASSWORD_FILTER)
+        _breached_loaded = True
+    return _breached_passwords
+
 class User:
+    # No per-instance __dict__; the hash and timestamp are kept packed (raw
+    # salt/digest bytes, integer microseconds) and decoded on access
+    __slots__ = ("username", "email", "role", "_password_hash", "_created_at")
+
     def __init__(self, username: str, password: str, email: str, role: Union[UserRole, str] = UserRole.USER):
         self.username = username
         self.password_hash = self._hash_password(password) if password else None
@@ -46,16 +186,30 @@ class User:
         self.role = role if isinstance(role, UserRole) else UserRole(role)
         self.created_at = datetime.now().isoformat()
 
+    @property
+    def password_hash(self) -> Optional[str]:
+        return unpack_hash(self._password_hash)
+
+    @password_hash.setter
+    def password_hash(self, value: Optional[str]):
+        self._password_hash = pack_hash(value)
+
+    @property
+    def created_at(self) -> str:
+        return decode_timestamp(self._created_at)
+
+    @created_at.setter
+    def created_at(self, value: str):
+        self._created_at = encode_timestamp(value)
+
     @staticmethod
     def _hash_password(password: str) -> str:
-        """Hash password using SHA-256 with salt"""
-        salt = secrets.token_hex(16)
-        return f"{salt}:{hashlib.sha256((password + salt).encode()).hexdigest()}"
+        """Hash password with the configured key derivation function"""
+        return password_hasher().hash(password)
 
     def verify_password(self, password: str) -> bool:
         """Verify password against stored hash"""
-        salt = self.password_hash.split(':')[0]
-        return self.password_hash.split(':')[1] == hashlib.sha256((password + salt).encode()).hexdigest()
+        return password_hasher().verify(password, self.password_hash)
 
     def to_dict(self) -> Dict:
         return {
@@ -68,13 +222,18 @@ class User:
     
     @staticmethod
     def from_dict(data):
-        return User(
-            username=data["username"],
-            password=data["password_hash"],
-            email=data["email"],
-            role=UserRole(data["role"]),
-            created_at=datetime.fromisoformat(data["created_at"])  # burada geri dönüşüm
-        )
+        if "password_hash" not in data:
+            # Old format - should not happen after migration
+            return User(data["username"], data["password"], data["email"], UserRole.USER)
+        # Skip __init__: there is nothing to hash and no need for the clock
+        user = User.__new__(User)
+        user.username = data["username"]
+        user.email = data["email"]
+        role = data.get("role", UserRole.USER)
+        user.role = role if isinstance(role, UserRole) else UserRole(role)
+        user.password_hash = data["password_hash"]
+        user.created_at = data["created_at"] if "created_at" in data else datetime.now().isoformat()
+        return user
 
 
     @staticmethod
@@ -88,6 +247,10 @@ class User:
             return False
         if not re.search(r"\d", password):
             return False
+        breached = breached_passwords()
+        if breached is not None and password in breached:
+            BREACHED_REJECTIONS.inc()
+            return False
         return True
 
     @staticmethod
@@ -96,234 +259,323 @@ class User:
         email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
         return bool(re.match(email_pattern, email))
 
+def menu_requires(permission: Permission):
+    """Deny a ``UserRepository`` menu action unless the session token has ``permission``"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, token: str, *args, **kwargs):
+            if not self.menu_access.allows(token, permission):
+                print(color_text("Access denied: Admin privileges required", Colors.RED))
+                return None
+            return method(self, token, *args, **kwargs)
+        return wrapper
+    return decorator
+
 class UserRepository:
-    def __init__(self):
-        self.users: List[User] = []
-        self.active_sessions: Dict[str, Dict] = {}
-        self.migrate_legacy_users()
+    def __init__(self, backend: Optional[StorageBackend] = None, sessions: Optional[SessionStore] = None):
+        self.sessions = sessions or self._create_session_store()
+        self.tokens = self._create_token_signer()
+        self.throttle = self._create_login_throttle()
+        self.audit = AuditLog(Config.AUDIT_FILE, Config.AUDIT_BUFFER_SIZE, Config.AUDIT_FLUSH_INTERVAL,
+                              Config.AUDIT_MAX_BYTES, Config.AUDIT_BACKUPS)
+        self.audit.start()
+        self.backend = backend or self._create_backend()
+        # Bumped after every change to the users; cached listings are keyed by it
+        self._versions = itertools.count(1)
+        self.version = 0
+        # Built on the first search. The sqlite backend does not report other
+        # workers' changes, so there it only sees this worker's registrations
+        self.usernames = PrefixIndex(self.backend.iter_usernames)
+        self.backend.on_remote_change = self._remote_changed
+        # Grants are cached per token: API access tokens (still checked
+        # against revocations on every use) and CLI sessions
+        self.permissions = PermissionEngine(Config.ROLE_PERMISSIONS)
+        self.access = Authorizer(self.permissions, self._token_identity,
+                                 self.tokens.revocations.is_revoked, Config.TOKEN_CACHE_SIZE)
+        self.menu_access = Authorizer(self.permissions, self._session_identity, cache_size=Config.MAX_SESSIONS)
+        if isinstance(self.backend, JsonFileBackend):
+            self.migrate_legacy_users()
         self.loadUsers()
 
+    @staticmethod
+    def _create_backend() -> StorageBackend:
+        """Build the storage backend selected in Config"""
+        if Config.STORAGE_BACKEND == "sqlite":
+            return SQLiteBackend(Config.SQLITE_FILE, User.from_dict, Config.SQLITE_POOL_SIZE)
+        journal = None
+        if Config.PERSISTENCE_MODE == "journal":
+            journal = UserJournal(Config.JOURNAL_FILE, Config.JOURNAL_COMPACT_THRESHOLD, Config.JOURNAL_FSYNC,
+                                  Config.JOURNAL_POLL_INTERVAL)
+        if Config.MEMORY_LAYOUT == "mmap":
+            return SnapshotBackend(Config.USER_FILE, Config.SNAPSHOT_FILE, User.from_dict, journal)
+        if Config.MEMORY_LAYOUT == "columnar":
+            return ColumnarBackend(Config.USER_FILE, User.from_dict, User, journal,
+                                   Config.USER_SHARDS, Config.SHARD_LOAD_WORKERS)
+        return JsonFileBackend(Config.USER_FILE, User.from_dict, journal, Config.USER_SHARDS, Config.SHARD_LOAD_WORKERS)
+
+    @staticmethod
+    def _create_session_store() -> SessionStore:
+        """Build the session store selected in Config"""
+        ttl = Config.TOKEN_EXPIRY_MINUTES * 60
+        if Config.SESSION_BACKEND == "sqlite":
+            return SQLiteSessionStore(Config.SESSION_FILE, ttl, Config.MAX_SESSIONS)
+        return MemorySessionStore(ttl, Config.MAX_SESSIONS)
+
+    @staticmethod
+    def _create_token_signer() -> TokenSigner:
+        """Build the access token signer, sharing revocations like sessions"""
+        db_path = Config.SESSION_FILE if Config.SESSION_BACKEND == "sqlite" else None
+        return TokenSigner(
+            load_or_create_secret(Config.TOKEN_SECRET_FILE),
+            Config.ACCESS_TOKEN_MINUTES * 60,
+            RevocationList(db_path),
+            Config.TOKEN_CACHE_SIZE
+        )
+
+    @staticmethod
+    def _create_login_throttle() -> LoginThrottle:
+        window = Config.LOGIN_RATE_WINDOW
+        return LoginThrottle(
+            RateLimiter(Config.LOGIN_RATE_PER_USER, window, hot_keys=Config.LOGIN_THROTTLE_HOT_KEYS),
+            RateLimiter(Config.LOGIN_RATE_PER_CLIENT, window, hot_keys=Config.LOGIN_THROTTLE_HOT_KEYS)
+        )
+
+    @property
+    def users(self) -> List[User]:
+        return list(self.backend.iter_users())
+
     def get_all_users(self):
         return self.users
+
+    def iter_users(self, after: Optional[str] = None):
+        """Iterate over users in username order, starting after ``after``"""
+        return self.backend.iter_users(after)
     
     def migrate_legacy_users(self):
         """Migrate existing users to the new secure format"""
+        # A format marker written after a migration (or a check) lets normal
+        # startup skip this without opening the users file.
+        if has_format_marker(Config.USER_FILE) or read_manifest(Config.USER_FILE) is not None:
+            # Sharded stores are only written in the current format
+            return
         try:
-            print("Starting user data migration...")
+            logger.info("Starting user data migration...")
             backup_file = Config.USER_FILE + '.backup'
             
             # If users.json is empty but backup exists, restore from backup
             if (not os.path.exists(Config.USER_FILE) or os.path.getsize(Config.USER_FILE) == 0) and os.path.exists(backup_file):
-                print("Found backup file with user data, will migrate from backup")
+                logger.info("Found backup file with user data, will migrate from backup")
                 source_file = backup_file
             else:
                 source_file = Config.USER_FILE
                 
             if not os.path.exists(source_file):
-                print("No users file found to migrate.")
+                logger.info("No users file found to migrate.")
                 return
             
-            # Read existing users
-            with open(source_file, 'r', encoding='utf-8') as file:
-                content = file.read().strip()
-                if not content:
-                    print("No users to migrate.")
-                    return
-                legacy_users = json.loads(content)
-            
-            # Check if migration is needed
-            if any("password_hash" in user for user in legacy_users):
-                print("Users are already in new format.")
+            # Check if migration is needed by looking at the first user only
+            first_user = first_element(source_file)
+            if first_user is None:
+                logger.info("No users to migrate.")
+                return
+            if "password_hash" in first_user:
+                logger.info("Users are already in new format.")
+                if source_file == Config.USER_FILE:
+                    write_format_marker(Config.USER_FILE)
                 return
                 
-            print("Found legacy users, starting migration...")
+            logger.info("Found legacy users, starting migration...")
+            migration = LegacyMigration(
+                source_file,
+                Config.USER_FILE,
+                password_hasher(),
+                Config.MIGRATION_BATCH_SIZE,
+                roles=[role.value for role in UserRole],
+                default_role=UserRole.USER.value
+            )
+            stats = migration.run()
+            logger.info("Migrated %d users, %d failed, %.0f users/s",
+                        stats["written"], stats["failed"], stats["users_per_second"])
             
-            # Convert each user to new format
-            migrated_users = []
-            for user_data in legacy_users:
-                try:
-                    # Create new user with secure format
-                    user = User(
-                        username=user_data["username"],
-                        password=user_data["password"],  # Will be hashed in User.__init__
-                        email=user_data["email"],
-                        role=UserRole(user_data.get("role", UserRole.USER.value))  # Preserve role
-                    )
-                    migrated_users.append(user.to_dict())
-                    print(f"Migrated user: {user.username} ({user.role.value})")
-                except Exception as e:
-                    print(f"Error migrating user {user_data.get('username')}: {str(e)}")
-            
-            if not migrated_users:
-                print("No users were successfully migrated.")
+            if not stats["written"]:
+                logger.warning("No users were successfully migrated.")
+                migration.discard()
                 return
                 
             # Create backup if it doesn't exist
             if source_file == Config.USER_FILE and not os.path.exists(backup_file):
                 os.rename(Config.USER_FILE, backup_file)
-                print(f"Original file backed up to: {backup_file}")
-            
-            # Save migrated users
-            with open(Config.USER_FILE, 'w', encoding='utf-8') as file:
-                json.dump(migrated_users, file, indent=4)
-            print("Migration completed successfully!")
+                logger.info("Original file backed up to: %s", backup_file)
             
-            # Verify the file was written correctly
-            if os.path.exists(Config.USER_FILE):
-                with open(Config.USER_FILE, 'r', encoding='utf-8') as file:
-                    content = file.read().strip()
-                    if not content:
-                        raise Exception("Migration failed: New file is empty")
-            else:
-                raise Exception("Migration failed: New file was not created")
+            # Swap in the migrated users
+            os.replace(migration.output_path, Config.USER_FILE)
+            migration.discard()
+            write_format_marker(Config.USER_FILE)
+            logger.info("Migration completed successfully!")
                 
         except Exception as e:
-            print(f"Migration failed: {str(e)}")
+            logger.error("Migration failed: %s", e)
             # Restore from backup if main file is empty or doesn't exist
             if (not os.path.exists(Config.USER_FILE) or os.path.getsize(Config.USER_FILE) == 0) and os.path.exists(backup_file):
-                print("Restoring from backup file...")
+                logger.warning("Restoring from backup file...")
                 with open(backup_file, 'r', encoding='utf-8') as backup:
                     with open(Config.USER_FILE, 'w', encoding='utf-8') as main:
                         main.write(backup.read())
-                print("Restored from backup file.")
+                logger.warning("Restored from backup file.")
 
     def loadUsers(self):
-        try:
-            print(f"Attempting to load users from {Config.USER_FILE}")
-            
-            if not os.path.exists(Config.USER_FILE):
-                print(f"File {Config.USER_FILE} does not exist, creating new file")
-                with open(Config.USER_FILE, "w", encoding="utf-8") as file:
-                    json.dump([], file)
-                # Create default admin user
-                self.register(User("admin", "Admin123!", "admin@example.com", UserRole.ADMIN))
-                return
-
-            with open(Config.USER_FILE, "r", encoding="utf-8") as file:
-                content = file.read().strip()
-                print(f"Raw file contents: {content}")
-                
-                if not content:
-                    print("File is empty, initializing with empty user list")
-                    return
-                    
-                users = json.loads(content)
-                print(f"Loaded {len(users)} users from file")
-                
-                for user_data in users:
-                    try:
-                        if "password_hash" in user_data:
-                            # New format
-                            user = User(
-                                username=user_data["username"],
-                                password="",  # Password hash is loaded directly
-                                email=user_data["email"],
-                                role=user_data.get("role", UserRole.USER)
-                            )
-                            user.password_hash = user_data["password_hash"]
-                            user.created_at = user_data.get("created_at", datetime.now().isoformat())
-                        else:
-                            # Old format - should not happen after migration
-                            user = User(
-                                username=user_data["username"],
-                                password=user_data["password"],
-                                email=user_data["email"],
-                                role=UserRole.USER
-                            )
-                        self.users.append(user)
-                        print(f"Loaded user: {user.username}")
-                    except Exception as e:
-                        print(f"Error loading user data: {str(e)}")
-                        print(f"Problematic user data: {user_data}")
-                        
-        except Exception as e:
-            print(f"Error loading users: {str(e)}")
-            raise
+        if self.backend.load():
+            # Create default admin user
+            self.register(User("admin", "Admin123!", "admin@example.com", UserRole.ADMIN))
 
     def savetoFile(self):
-        try:
-            data = [user.to_dict() for user in self.users]
-            print(f"Saving {len(data)} users to {Config.USER_FILE}")
-            print(f"Data to be saved: {json.dumps(data, indent=2)}")
-            
-            with open(Config.USER_FILE, "w", encoding="utf-8") as file:
-                json.dump(data, file, indent=4)
-            
-            # Verify the file was written
-            if os.path.exists(Config.USER_FILE):
-                with open(Config.USER_FILE, "r", encoding="utf-8") as file:
-                    saved_content = file.read()
-                print(f"File contents after save: {saved_content}")
+        self.backend.flush()
+
+    def _changed(self):
+        # next() on a count is atomic, so concurrent writers never share a version
+        self.version = next(self._versions)
+
+    def _remote_changed(self, usernames: Optional[Set[str]]):
+        # Called with the backend's write lock held, so lookups see the result
+        self._changed()
+        if usernames is None:
+            self.usernames.invalidate()
+            self._forget_grants(None)
+            return
+        for username in usernames:
+            self._forget_grants(username)
+            if self.backend.get(username) is None:
+                self.usernames.discard(username)
             else:
-                print(f"Warning: File {Config.USER_FILE} does not exist after save attempt")
-                
-        except Exception as e:
-            print(f"Error saving to file: {str(e)}")
-            raise
+                self.usernames.add(username)
 
     def register(self, user: User) -> bool:
         try:
-            if any(u.username == user.username for u in self.users):
+            if self.backend.get(user.username):
                 raise ValidationError("Username already exists")
             
             if not User.validate_email(user.email):
                 raise ValidationError("Invalid email format")
+
+            if self.get_user_by_email(user.email):
+                raise ValidationError("Email already registered")
             
-            self.users.append(user)
-            self.savetoFile()
-            print("User created successfully")
+            try:
+                self.backend.add(user)
+            except DuplicateUserError as e:
+                raise ValidationError(str(e))
+            self._changed()
+            self.usernames.add(user.username)
+            self.audit.record("register", user.username)
+            logger.info("User %s created successfully", user.username)
             return True
         except ValidationError as e:
-            print(f"Registration failed: {str(e)}")
+            self.audit.record("register", user.username, "failure", reason=str(e))
+            logger.info("Registration failed: %s", e)
             return False
 
+    def add_users(self, users: List[User]):
+        """Store already validated new users with a single persistence write"""
+        stored = False
+        try:
+            self.backend.add_many(users)
+            stored = True
+        except DuplicateUserError as e:
+            raise ValidationError(str(e))
+        finally:
+            # Backends without a single write may have stored some of them
+            self._changed()
+            for user in users:
+                if stored or self.backend.get(user.username) is not None:
+                    self.usernames.add(user.username)
+            self.audit.record("import", None, "success" if stored else "failure", count=len(users))
+
     def login(self) -> Optional[str]:
         username = input("Username: ")
         password = input("Password: ")
 
-        user = next((u for u in self.users if u.username == username), None)
-        if user and user.verify_password(password):
-            token = secrets.token_hex(32)
-            self.active_sessions[token] = {
-                "username": username,
-                "expires": datetime.now() + timedelta(minutes=Config.TOKEN_EXPIRY_MINUTES)
-            }
+        retry_after = self.throttle.check(username, None)
+        if retry_after:
+            self.audit.record("login", username, "throttled", client="cli")
+            print(f"Too many login attempts, try again in {retry_after:.0f} seconds")
+            return None
+        user = self.authenticate(username, password, "cli")
+        if user:
+            token = self.sessions.create(user.username)
             print(f"Welcome, {username}!")
             return token
         print("Invalid credentials")
         return None
 
+    def authenticate(self, username: str, password: str, client: Optional[str] = None) -> Optional[User]:
+        """Return the user if the password matches, upgrading outdated hashes"""
+        user = self.backend.get(username) if username else None
+        if not user or not password or not user.verify_password(password):
+            self.audit.record("login", username, "failure", client=client,
+                              reason="wrong password" if user else "unknown user")
+            return None
+        self.audit.record("login", username, client=client)
+        hasher = password_hasher()
+        if hasher.needs_rehash(user.password_hash):
+            self.backend.update(user, {"password_hash": hasher.hash(password)})
+        return user
+
     def logout(self, token: str):
-        if token in self.active_sessions:
-            username = self.active_sessions[token]["username"]
-            del self.active_sessions[token]
+        username = self.sessions.delete(token)
+        self.menu_access.forget(token)
+        if username:
             print(f"Goodbye, {username}")
         else:
             print("No valid session found")
 
     def get_user(self, username):
-        return next((u for u in self.users if u.username == username), None)
+        return self.backend.get(username)
+
+    def search_usernames(self, prefix: str, limit: int) -> List[str]:
+        """Up to ``limit`` usernames starting with ``prefix``, ignoring case"""
+        return self.usernames.search(prefix, limit)
+
+    def is_username_available(self, username: str) -> bool:
+        return self.backend.get(username) is None
+
+    def get_user_by_email(self, email: str) -> Optional[User]:
+        return self.backend.get_by_email(email)
+
+    def get_users_by_role(self, role: Union[UserRole, str]) -> List[User]:
+        return self.backend.users_with_role(UserRole(role))
     
     def get_current_user(self, token: str) -> Optional[User]:
-        if token not in self.active_sessions:
+        session = self.sessions.get(token) if token else None
+        if not session:
             return None
-        
-        session = self.active_sessions[token]
-        if datetime.now() > session["expires"]:
-            del self.active_sessions[token]
+        return self.backend.get(session["username"])
+
+    def _token_identity(self, token: str):
+        claims = self.tokens.verify(token)
+        if claims is None:
             return None
-            
-        return next((u for u in self.users if u.username == session["username"]), None)
-    
+        return claims["sub"], claims["role"], claims["exp"], claims
+
+    def _session_identity(self, token: str):
+        session = self.sessions.get(token)
+        user = self.backend.get(session["username"]) if session else None
+        if user is None:
+            return None
+        return user.username, user.role, session["expires"], None
+
+    def _forget_grants(self, username: Optional[str]):
+        """Drop cached grants of ``username`` (everyone's if None) after a role change"""
+        for authorizer in (self.access, self.menu_access):
+            if username is None:
+                authorizer.clear()
+            else:
+                authorizer.forget_user(username)
 
 
 
+    @menu_requires(Permission.LIST_USERS)
     def list_users(self, token: str):
         """Admin function to list all users"""
-        if not self.is_admin(token):
-            print(color_text("Access denied: Admin privileges required", Colors.RED))
-            return
-            
         print(f"\n{color_text('User List:', Colors.HEADER)}")
         header = color_text("=" * 75, Colors.BLUE)
         print(header)
@@ -339,7 +591,7 @@ class UserRepository:
         print(color_text("-" * 75, Colors.BLUE))
         
         # User rows
-        for user in self.users:
+        for user in self.backend.iter_users():
             created_date = user.created_at.split('T')[0]
             role_color = Colors.GREEN if user.role == UserRole.ADMIN else Colors.BLUE
             username = color_text(user.username, role_color)
@@ -349,17 +601,14 @@ class UserRepository:
             print(f"{username:<20} {user.email:<30} {role:<10} {created_date:<15}")
             
         print(header)
-        total = color_text(str(len(self.users)), Colors.GREEN)
+        total = color_text(str(self.backend.count()), Colors.GREEN)
         print(f"Total users: {total}")
 
+    @menu_requires(Permission.CHANGE_ROLES)
     def change_user_role(self, token: str):
         """Admin function to change user roles"""
-        if not self.is_admin(token):
-            print(color_text("Access denied: Admin privileges required", Colors.RED))
-            return
-            
         username = input(color_text("Enter username to modify: ", Colors.YELLOW))
-        user = next((u for u in self.users if u.username == username), None)
+        user = self.backend.get(username)
         
         if not user:
             print(color_text("User not found", Colors.RED))
@@ -373,43 +622,158 @@ class UserRepository:
             print(color_text("Invalid role", Colors.RED))
             return
             
-        user.role = UserRole(new_role)
-        self.savetoFile()
+        grant = self.menu_access.grant(token)
+        self.set_user_role(user, UserRole(new_role), grant.username if grant else None)
         print(color_text(f"Role updated for user {username}", Colors.GREEN))
 
-    def delete_user(self, username):
-        for i, user in enumerate(self.users):
-            if user.username == username:
-                del self.users[i]
-                self.save()
-                return True
-        return False
+    def set_user_role(self, user: User, role: UserRole, actor: Optional[str] = None):
+        """Change a user's role and persist it"""
+        previous = user.role
+        self.backend.update(user, {"role": role})
+        self._changed()
+        self.audit.record("role_change", user.username, actor=actor, old_role=previous.value, new_role=role.value)
+        self._forget_grants(user.username)
+        # Access tokens carry the old role; make the user log in again
+        self.tokens.revocations.revoke_user(user.username, self.tokens.ttl)
+
+    def delete_user(self, username, actor: Optional[str] = None):
+        user = self.backend.get(username)
+        if not user:
+            return False
+        self.backend.delete(user)
+        self._changed()
+        self.audit.record("delete", username, actor=actor)
+        self.usernames.discard(username)
+        self._forget_grants(username)
+        self.tokens.revocations.revoke_user(username, self.tokens.ttl)
+        return True
 
     def update_user(self, username, email=None, password=None):
-        for user in self.users:
-            if user.username == username:
-                if email:
-                    user.email = email
-                if password:
-                    user.password_hash = user.hash_password(password)
-                self.save()
-                return True
-        return False
-
+        user = self.backend.get(username)
+        if not user:
+            return False
+        changes = {}
+        if email:
+            owner = self.get_user_by_email(email)
+            if owner is not None and owner.username != user.username:
+                raise ValidationError("Email already registered")
+            changes["email"] = email
+        if password:
+            changes["password_hash"] = user._hash_password(password)
+        try:
+            self.backend.update(user, changes)
+        except DuplicateUserError as e:
+            raise ValidationError(str(e))
+        self._changed()
+        return True
 
+    BATCH_OPERATIONS = ("delete", "update_email", "reset_password", "change_role")
+
+    def apply_batch(self, operations: List[Dict], actor: Optional[str] = None) -> Tuple[bool, List[Dict]]:
+        """Apply admin operations all together or not at all.
+
+        Each operation is a dict with "op" (one of BATCH_OPERATIONS),
+        "username" and, depending on the op, "email", "password" or "role".
+        Operations are checked in order against the state left by the ones
+        before them. Returns whether the batch was applied and a result per
+        operation; if any operation is invalid nothing is changed. Raises
+        ValidationError if a concurrent change makes the batch clash.
+        """
+        results = []
+        # Per username: ("delete", None) or ("update", changes)
+        plan: Dict[str, Tuple[str, Optional[Dict]]] = {}
+        passwords: Dict[str, str] = {}
+        claimed: Dict[str, str] = {}
+        for index, operation in enumerate(operations):
+            error = self._check_operation(operation, plan, passwords, claimed)
+            result = {"index": index, "op": operation.get("op") if isinstance(operation, dict) else None,
+                      "username": operation.get("username") if isinstance(operation, dict) else None}
+            result.update({"status": "failed", "error": error} if error else {"status": "ok"})
+            results.append(result)
+        if any(result["status"] == "failed" for result in results):
+            for result in results:
+                if result["status"] == "ok":
+                    result["status"] = "skipped"
+            return False, results
+
+        # Hash every new password in one go on the hashing pool
+        for username, password_hash in zip(passwords, password_hasher().hash_many(passwords.values())):
+            plan[username][1]["password_hash"] = password_hash
+        changes = [(op, username, fields) for username, (op, fields) in plan.items()]
+        previous_roles = {username: self.backend.get(username).role for op, username, fields in changes
+                          if op != "delete" and "role" in fields}
+        try:
+            self.backend.apply_batch(changes)
+        except (DuplicateUserError, LookupError) as e:
+            raise ValidationError(str(e))
+        self._changed()
+        for op, username, fields in changes:
+            if op == "delete":
+                self.usernames.discard(username)
+                self.audit.record("delete", username, actor=actor, batch=True)
+            elif "role" in fields:
+                self.audit.record("role_change", username, actor=actor, batch=True,
+                                  old_role=previous_roles[username].value, new_role=fields["role"].value)
+            if op == "delete" or "role" in fields:
+                self._forget_grants(username)
+                self.tokens.revocations.revoke_user(username, self.tokens.ttl)
+        logger.info("Applied a batch of %d operations to %d users", len(operations), len(changes))
+        return True, results
+
+    def _check_operation(self, operation, plan: Dict, passwords: Dict[str, str], claimed: Dict[str, str]) -> str:
+        """Why one batch operation cannot be applied, or an empty string; records it in the plan"""
+        if not isinstance(operation, dict) or operation.get("op") not in self.BATCH_OPERATIONS:
+            return f"Unknown operation, use one of: {', '.join(self.BATCH_OPERATIONS)}"
+        op, username = operation["op"], operation.get("username")
+        if not isinstance(username, str) or not username:
+            return "Missing username"
+        if plan.get(username, ("update",))[0] == "delete":
+            return "User is deleted earlier in this batch"
+        user = self.backend.get(username)
+        if user is None:
+            return "User not found"
+
+        if op == "delete":
+            plan[username] = ("delete", None)
+            passwords.pop(username, None)
+            return ""
+        changes = plan.get(username, ("update", {}))[1]
+        if op == "update_email":
+            email = operation.get("email")
+            if not isinstance(email, str) or not User.validate_email(email):
+                return "Invalid email"
+            email_key = email.strip().lower()
+            owner = claimed.get(email_key)
+            if owner is None:
+                stored = self.backend.get_by_email(email)
+                if stored is not None:
+                    # Free if its owner is deleted or moved to another email in this batch
+                    stored_op, stored_changes = plan.get(stored.username, ("update", {}))
+                    if stored_op != "delete" and "email" not in stored_changes:
+                        owner = stored.username
+            if owner is not None and owner != username:
+                return "Email already registered"
+            claimed[email_key] = username
+            changes["email"] = email
+        elif op == "reset_password":
+            password = operation.get("password")
+            if not isinstance(password, str) or not User.validate_password(password):
+                return "Weak password"
+            passwords[username] = password
+            changes.setdefault("password_hash", None)
+        else:
+            try:
+                changes["role"] = UserRole(operation.get("role"))
+            except ValueError:
+                return "Invalid role"
+        plan[username] = ("update", changes)
+        return ""
 
     def is_admin(self, token: str) -> bool:
-        """Check if the current user is an admin"""
-        if token not in self.active_sessions:
-            return False
-            
-        session = self.active_sessions[token]
-        if datetime.now() > session["expires"]:
-            del self.active_sessions[token]
-            return False
-            
-        user = next((u for u in self.users if u.username == session["username"]), None)
-        return user is not None and user.role == UserRole.ADMIN
+        """Check if the current user has every admin permission"""
+        grant = self.menu_access.grant(token)
+        admin = self.permissions.mask(UserRole.ADMIN)
+        return grant is not None and grant.mask & admin == admin
 
 def display_menu(is_admin=False, is_logged_in=False):
     """Display the menu options"""
@@ -453,7 +817,8 @@ def main():
         try:
             # Get current user status
             current_user = repository.get_current_user(current_token) if current_token else None
-            is_admin = current_user and current_user.role == UserRole.ADMIN
+            grant = repository.menu_access.grant(current_token) if current_user else None
+            is_admin = grant is not None and bool(grant.mask)
             
             # Display menu
             display_menu(is_admin=is_admin, is_logged_in=bool(current_user))
@@ -474,7 +839,7 @@ def main():
                         break
                     print(color_text(
                         f"Password must be at least {Config.MIN_PASSWORD_LENGTH} characters long "
-                        "and contain uppercase, lowercase, and numbers", 
+                        "and contain uppercase, lowercase, and numbers, and must not appear in a known breach", 
                         Colors.RED
                     ))
                 email = input(color_text("Enter email: ", Colors.YELLOW))
@@ -518,13 +883,12 @@ def main():
                     if not User.validate_password(new_password):
                         print(color_text(
                             f"New password must be at least {Config.MIN_PASSWORD_LENGTH} characters long "
-                            "and contain uppercase, lowercase, and numbers",
+                            "and contain uppercase, lowercase, and numbers, and must not appear in a known breach",
                             Colors.RED
                         ))
                     else:
                         if current_user.verify_password(old_password):
-                            current_user.password_hash = current_user._hash_password(new_password)
-                            repository.savetoFile()
+                            repository.update_user(current_user.username, password=new_password)
                             print(color_text("Password changed successfully", Colors.GREEN))
                         else:
                             print(color_text("Current password is incorrect", Colors.RED))
@@ -532,13 +896,13 @@ def main():
                     print(color_text("Not logged in", Colors.YELLOW))
                     
             elif selection == '7':
-                if is_admin:
+                if grant is not None and grant.allows(Permission.LIST_USERS):
                     repository.list_users(current_token)
                 else:
                     print(color_text("Invalid selection or insufficient privileges", Colors.RED))
                 
             elif selection == '8':
-                if is_admin:
+                if grant is not None and grant.allows(Permission.CHANGE_ROLES):
                     repository.change_user_role(current_token)
                 else:
                     print(color_text("Invalid selection or insufficient privileges", Colors.RED))
@@ -550,5 +914,13 @@ def main():
             print(color_text(f"Error: {str(e)}", Colors.RED))
 
 if __name__ == "__main__":
-    main()
+    configure_logging("INFO")
+    if sys.argv[1:2] == ["import"]:
+        from bulk_import import main as import_main
+        import_main(sys.argv[2:])
+    elif sys.argv[1:2] == ["migrate"]:
+        # Run (or resume) a legacy migration without starting the menu
+        UserRepository()
+    else:
+        main()
 